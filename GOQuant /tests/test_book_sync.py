@@ -0,0 +1,60 @@
+import asyncio
+import json
+import zlib
+
+import pytest
+
+import trade_backend
+from trade_order_book import L2OrderBook, OrderBookOutOfSync, okx_checksum
+
+ARG = {"channel": "books", "instId": "TEST-RESYNC"}
+
+
+class FakeFeedSocket:
+    def __init__(self):
+        self.ops = []
+
+    async def send(self, message):
+        self.ops.append(json.loads(message)['op'])
+
+
+def test_checksum_matches_okx_string_format():
+    bids = [[3366.1, 7.0], [3366.0, 6.0]]
+    asks = [[3366.8, 9.0], [3368.0, 8.0], [3368.5, 0.00001]]
+    crc = zlib.crc32(b"3366.1:7:3366.8:9:3366:6:3368:8:3368.5:0.00001")
+    expected = crc - (1 << 32) if crc >= (1 << 31) else crc
+    assert okx_checksum(bids, asks) == expected
+
+
+def test_book_validates_checksum_and_sequence():
+    book = L2OrderBook('TEST')
+    asks, bids = [["101.5", "2"]], [["100", "1.5"]]
+    book.apply_snapshot(asks, bids, ts="1", seq_id=10,
+                        checksum=okx_checksum([[100.0, 1.5]], [[101.5, 2.0]]))
+    with pytest.raises(OrderBookOutOfSync):
+        book.apply_update([["101.5", "3"]], [], seq_id=12, prev_seq_id=11)
+    with pytest.raises(OrderBookOutOfSync):
+        book.apply_update([["101.5", "3"]], [], seq_id=11, prev_seq_id=10, checksum=123)
+
+
+def book_message(action, seq_id, prev_seq_id, ask_qty):
+    return json.dumps({"arg": ARG, "action": action, "data": [{
+        "asks": [["101", ask_qty]], "bids": [["100", "1"]], "seqId": seq_id, "prevSeqId": prev_seq_id}]})
+
+
+def test_gap_resubscribes_once_until_the_snapshot(monkeypatch):
+    monkeypatch.setattr(trade_backend, 'publish_tick', lambda output, symbol: None)
+    socket, symbol = FakeFeedSocket(), ARG['instId']
+
+    async def feed(*messages):
+        for message in messages:
+            assert await trade_backend.process_feed_message(message, symbol, socket)
+
+    asyncio.run(feed(book_message("snapshot", 1, -1, "1"), book_message("update", 3, 2, "2")))
+    assert socket.ops == ['unsubscribe', 'subscribe']
+    # Updates already in flight are dropped without resubscribing again
+    asyncio.run(feed(*(book_message("update", 4 + i, 3 + i, "3") for i in range(5))))
+    assert socket.ops == ['unsubscribe', 'subscribe']
+    asyncio.run(feed(book_message("snapshot", 20, -1, "4"), book_message("update", 21, 20, "5")))
+    assert trade_backend.order_books[symbol].best_ask() == (101.0, 5.0)
+    assert symbol not in trade_backend.resync_pending and len(socket.ops) == 2
@@ -0,0 +1,46 @@
+import importlib
+import json
+import sys
+import time
+
+import numpy as np
+import pytest
+
+import trade_backend
+from trade_order_book import L2OrderBook
+
+# Libraries that must be hidden for each backend to be selected
+HIDDEN = {'msgspec': (), 'orjson': ('msgspec',), 'json': ('msgspec', 'orjson')}
+
+
+def load_codec(backend, monkeypatch):
+    """Imports a fresh trade_codec that picks `backend`; skips if it is not installed."""
+    if backend != 'json':
+        pytest.importorskip(backend)
+    for name in HIDDEN[backend]:
+        monkeypatch.setitem(sys.modules, name, None) # None makes the import raise ImportError
+    monkeypatch.delitem(sys.modules, 'trade_codec')
+    codec = importlib.import_module('trade_codec')
+    monkeypatch.undo() # Restore the shared trade_codec for other tests
+    assert codec.BACKEND == backend
+    return codec
+
+
+def tick_frame():
+    book = L2OrderBook('BTC-USDT-SWAP')
+    asks = np.column_stack((100.0 + np.arange(20) * 0.5, np.full(20, 2.0)))
+    bids = np.column_stack((99.5 - np.arange(20) * 0.5, np.full(20, 2.0)))
+    book.apply_snapshot(asks, bids, ts='1700000000000')
+    frame = trade_backend.compute_tick_output(book, trade_backend.simulation_params, time.perf_counter())
+    assert type(frame['marketImpact']) is not float # A NumPy scalar, the case that must encode
+    return frame
+
+
+@pytest.mark.parametrize('backend', ['msgspec', 'orjson', 'json'])
+def test_encodes_real_tick_frame(backend, monkeypatch):
+    codec = load_codec(backend, monkeypatch)
+    frame = tick_frame()
+    expected = json.loads(json.dumps(frame, default=lambda o: o.tolist()))
+    assert json.loads(codec.dumps(frame)) == expected
+    encoder = codec.TickFrameEncoder(trade_backend.TICK_FRAME_KEYS)
+    assert json.loads(encoder.encode(frame)) == expected
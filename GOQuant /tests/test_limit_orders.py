@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+
+from trade_limit_orders import FRONT_SHARE, LevelQueue, LimitOrderSimulator
+from trade_order_book import L2OrderBook
+
+
+class ReferenceQueue:
+    """LevelQueue semantics with the volume ahead of every order stored explicitly."""
+
+    def __init__(self):
+        self.orders = [] # [order_id, ahead, remaining], front first
+
+    def consume(self, old_qty, new_qty, front_share):
+        if new_qty >= old_qty or not self.orders:
+            return {}
+        executed = front_share * (old_qty - new_qty)
+        left = old_qty - executed
+        factor = new_qty / left if left > 1e-12 else 0.0
+        fills = {}
+        for order in self.orders:
+            if order[1] < executed:
+                fill = min(order[2], executed - order[1])
+                order[2] -= fill
+                fills[order[0]] = fill
+            order[1] = max(factor * (order[1] - executed), 0.0)
+        self.orders = [order for order in self.orders if order[2] > 1e-12]
+        return fills
+
+
+def check_same(queue, reference):
+    assert queue.order_ids[:queue.n].tolist() == [order[0] for order in reference.orders]
+    assert queue.queue_ahead() == pytest.approx([order[1] for order in reference.orders], rel=1e-9, abs=1e-9)
+    assert queue.remaining[:queue.n] == pytest.approx([order[2] for order in reference.orders], rel=1e-9, abs=1e-9)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_consume_matches_reference(seed):
+    rng = np.random.default_rng(seed)
+    queue, reference = LevelQueue(100.0, capacity=2), ReferenceQueue()
+    level_qty = 10.0
+    next_id = 0
+    for _ in range(200):
+        action = rng.random()
+        if action < 0.3:
+            qty = float(rng.uniform(0.1, 3.0))
+            queue.add(next_id, level_qty, qty)
+            reference.orders.append([next_id, level_qty, qty])
+            next_id += 1
+        elif action < 0.4 and reference.orders:
+            order_id = reference.orders[int(rng.integers(len(reference.orders)))][0]
+            expected = next(order[2] for order in reference.orders if order[0] == order_id)
+            assert queue.remove(order_id) == pytest.approx(expected)
+            reference.orders = [order for order in reference.orders if order[0] != order_id]
+        elif action < 0.55:
+            level_qty += float(rng.uniform(0.0, 5.0)) # Growth queues behind us: no change
+        else:
+            new_qty = level_qty * float(rng.choice([0.0, rng.uniform(0.0, 1.0)], p=[0.05, 0.95]))
+            ids, qtys = queue.consume(level_qty, new_qty, FRONT_SHARE)
+            expected = reference.consume(level_qty, new_qty, FRONT_SHARE)
+            assert dict(zip(ids.tolist(), qtys.tolist())) == pytest.approx(expected)
+            level_qty = new_qty if new_qty > 0 else 10.0
+        check_same(queue, reference)
+
+
+def test_long_decay_rebases_without_losing_positions():
+    queue = LevelQueue(100.0)
+    queue.add(1, 50.0, 1.0)
+    queue.add(2, 80.0, 1.0)
+    level_qty = 100.0
+    for _ in range(200):
+        # Pure cancellations shrink everything ahead proportionally, far below MIN_SCALE overall
+        queue.consume(level_qty, level_qty * 0.9, 0.0)
+        level_qty *= 0.9
+    assert queue.scale >= 1e-9
+    assert queue.queue_ahead() == pytest.approx([50.0 * 0.9 ** 200, 80.0 * 0.9 ** 200], rel=1e-6)
+
+
+def test_position_of_and_fill_all():
+    queue = LevelQueue(100.0)
+    queue.add(7, 5.0, 2.0)
+    queue.add(8, 9.0, 1.0)
+    assert queue.position_of(8) == pytest.approx(9.0)
+    assert queue.position_of(99) is None
+    ids, qtys = queue.fill_all()
+    assert ids.tolist() == [7, 8] and qtys.tolist() == [2.0, 1.0]
+    assert len(queue) == 0
+
+
+def test_ui_order_cancelled_for_non_positive_quantity():
+    import trade_backend
+    book = L2OrderBook('TEST-UI-LIMIT')
+    book.order_tracker = LimitOrderSimulator(book.symbol)
+    book.apply_snapshot([[101.0, 1.0]], [[100.0, 1.0]], ts='1700000000000')
+    params = dict(trade_backend.simulation_params, order_type='limit', quantity_usd=1000.0)
+    trade_backend.sync_ui_limit_order(book, params)
+    assert len(book.order_tracker.orders) == 1
+    for quantity_usd in (0.0, -5.0):
+        trade_backend.sync_ui_limit_order(book, dict(params, quantity_usd=quantity_usd))
+        assert not book.order_tracker.orders and book.symbol not in trade_backend.ui_limit_orders
+
+
+def crossed_buy():
+    """A buy 5 @ 101 placed against 1 @ 101: 1 fills as taker, 4 rest at 101 with the ask still shown."""
+    book = L2OrderBook('TEST-CROSS')
+    tracker = book.order_tracker = LimitOrderSimulator(book.symbol)
+    book.apply_snapshot([[101.0, 1.0], [102.0, 5.0]], [[100.0, 1.0]], ts='1700000000000')
+    order_id = tracker.place(book, 'buy', 101.0, 5.0)
+    return book, tracker, tracker.orders[order_id]
+
+
+def test_crossed_depth_is_not_a_trade_through():
+    book, tracker, order = crossed_buy()
+    assert order.taker_filled == pytest.approx(1.0)
+    book.apply_update([[105.0, 10.0]], [], ts='1700000000100') # Unrelated update
+    assert order.maker_filled == 0.0 and not order.is_done()
+    assert tracker.estimate(book, order.order_id)['makerPct'] < 80.0
+    book.apply_update([[100.5, 2.0]], [], ts='1700000000200') # New depth through our price
+    assert order.is_done() and order.maker_filled == pytest.approx(4.0)
+
+
+def test_crossed_depth_released_once_it_leaves_the_book():
+    book, tracker, order = crossed_buy()
+    book.apply_update([[101.0, 0.0]], [], ts='1700000000100') # The ask we took is gone
+    assert not order.is_done() and order.order_id not in tracker.crossed
+    book.apply_update([[101.0, 0.5]], [], ts='1700000000200') # A new seller at our price
+    assert order.is_done() and order.maker_filled == pytest.approx(4.0)
@@ -0,0 +1,34 @@
+import json
+import random
+
+from trade_metrics import LatencyHistogram, PipelineMetrics
+
+
+def test_histogram_merge_is_exact():
+    rng = random.Random(3)
+    values = [rng.lognormvariate(5, 2) for _ in range(5000)]
+    whole, parts = LatencyHistogram(), [LatencyHistogram() for _ in range(3)]
+    for i, value in enumerate(values):
+        whole.record_us(value)
+        parts[i % 3].record_us(value)
+    merged = LatencyHistogram()
+    for part in parts:
+        merged.merge(json.loads(json.dumps(part.export()))) # As it crosses the metrics ring
+    assert merged.counts == whole.counts
+    assert merged.summary() == whole.summary()
+
+
+def test_pipeline_metrics_merge_sources():
+    front, worker = PipelineMetrics(), PipelineMetrics()
+    front.observe('parse', 0.001)
+    worker.observe('parse', 0.003)
+    worker.observe('model_eval', 0.002)
+    worker.increment('resyncs', 2)
+    worker.register_gauge('pending', lambda: 4)
+    front.register_gauge('pending', lambda: 1)
+    front.add_source(lambda: [dict(worker.export(), source="shard-0")])
+    summary = front.summary()
+    assert summary["stages"]["parse"]["count"] == 2 and summary["stages"]["model_eval"]["count"] == 1
+    assert summary["counters"] == {"resyncs": 2}
+    assert summary["gauges"] == {"pending": 1} and summary["sourceGauges"] == {"shard-0": {"pending": 4}}
+    assert 'trade_pending{source="shard-0"} 4' in front.render_prometheus()
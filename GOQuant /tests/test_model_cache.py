@@ -0,0 +1,26 @@
+from trade_model_cache import MISS, ModelCache
+from trade_order_book import L2OrderBook
+
+
+def book_with(ask_price):
+    book = L2OrderBook('TEST-CACHE')
+    book.apply_snapshot([[ask_price, 1.0]], [[99.0, 1.0]])
+    return book
+
+
+def test_entry_survives_deeper_changes_only():
+    cache, book = ModelCache(), book_with(100.0)
+    cache.put('slippage', book, 'key', 6.0, (('asks', book.asks.version, 100.0),))
+    book.apply_update([[105.0, 3.0]], [])
+    assert cache.get('slippage', book, 'key') == 6.0
+    assert cache.get('slippage', book.snapshot(), 'key') == 6.0 # Compute workers see the same book
+    book.apply_update([[100.0, 2.0]], [])
+    assert cache.get('slippage', book, 'key') is MISS
+
+
+def test_replacement_book_never_hits():
+    cache, old_book = ModelCache(), book_with(100.0)
+    cache.put('slippage', old_book, 'key', 6.0, (('asks', old_book.asks.version, 100.0),))
+    new_book = book_with(195.0) # Same symbol, side versions restarted
+    assert new_book.asks.version <= old_book.asks.version
+    assert cache.get('slippage', new_book, 'key') is MISS
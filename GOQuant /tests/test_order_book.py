@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from trade_order_book import BookSide
+
+
+def reference_side(levels, is_bid, capacity):
+    """Best-first [[price, qty]] of a dict book, truncated to the best `capacity` levels."""
+    ordered = sorted(levels.items(), reverse=is_bid)[:capacity]
+    levels.clear()
+    levels.update(ordered)
+    return [[p, q] for p, q in ordered]
+
+
+def side_levels(side):
+    return np.column_stack((side.prices_view(), side.qtys_view())).tolist()
+
+
+@pytest.mark.parametrize('is_bid', [True, False])
+@pytest.mark.parametrize('seed', range(20))
+def test_apply_levels_matches_dict_reference(is_bid, seed):
+    rng = np.random.default_rng(seed)
+    capacity = 40
+    side = BookSide(is_bid, capacity=capacity)
+    reference = {}
+    for _ in range(60):
+        # Few distinct prices, so deltas hit existing levels, repeat prices and delete missing ones
+        m = int(rng.integers(0, 15))
+        prices = rng.integers(0, 60, size=m) * 0.5 + 100.0
+        qtys = np.where(rng.random(m) < 0.3, 0.0, rng.uniform(0.1, 5.0, size=m))
+        levels = np.column_stack((prices, qtys)) if m else np.empty((0, 2))
+        side.apply_levels(levels)
+        for price, qty in levels.tolist():
+            if qty > 0:
+                reference[price] = qty
+            else:
+                reference.pop(price, None)
+        assert side_levels(side) == reference_side(reference, is_bid, capacity)
+        assert len(side) == len(reference)
+
+
+def test_load_keeps_last_entry_per_price_and_best_levels():
+    side = BookSide(is_bid=True, capacity=2)
+    side.load(np.array([[100.0, 1.0], [101.0, 2.0], [100.0, 3.0], [99.0, 4.0], [98.0, 0.0]]))
+    assert side_levels(side) == [[101.0, 2.0], [100.0, 3.0]]
@@ -0,0 +1,40 @@
+import asyncio
+import os
+
+import pytest
+
+from trade_recorder import FeedRecorder, FeedRecording, replay_feed
+
+
+@pytest.fixture
+def recorded(tmp_path):
+    path = str(tmp_path / 'session.l2rec')
+    records = [(1_000_000_000 + i * 1_000_000, 'BTC-USDT-SWAP' if i % 2 else 'ETH-USDT-SWAP',
+                f'{{"asks":[["{100 + i}","1"]],"bids":[],"i":{i}}}') for i in range(250)]
+    recorder = FeedRecorder(path, chunk_records=64, flush_interval_s=3600)
+    for recv_ts_ns, symbol, message in records:
+        recorder.record(symbol, message, recv_ts_ns)
+    recorder.close()
+    return path, records
+
+
+async def collect(path, **kwargs):
+    return [record async for record in replay_feed(path, speed=0, **kwargs)]
+
+
+def test_replay_round_trip(recorded):
+    path, records = recorded
+    assert len(FeedRecording(path).index) == 4
+    assert asyncio.run(collect(path)) == records
+
+
+def test_replay_time_bounds(recorded):
+    path, records = recorded
+    start, end = records[70][0], records[140][0]
+    assert asyncio.run(collect(path, start_ns=start, end_ns=end)) == records[70:141]
+
+
+def test_missing_index_is_rebuilt(recorded):
+    path, records = recorded
+    os.remove(path + '.idx')
+    assert asyncio.run(collect(path)) == records
@@ -0,0 +1,37 @@
+import time
+
+import pytest
+
+import trade_backend
+from trade_order_book import L2OrderBook
+from trade_shards import decode_book, encode_book
+from trade_tick_store import LiveEstimates
+
+
+def live_book():
+    book = L2OrderBook('TEST-GRID')
+    book.apply_snapshot([[100.5, 3.0], [101.0, 5.0]], [[100.0, 3.0], [99.5, 5.0]], ts='1700000000000')
+    book.live_estimates = LiveEstimates(0.05, 0.04, 1234.0, 5000)
+    return book
+
+
+@pytest.mark.parametrize('sharded', [False, True])
+def test_default_impact_axes_match_the_tick(sharded):
+    book = live_book()
+    params = dict(trade_backend.simulation_params, calibration='live')
+    tick = trade_backend.compute_tick_output(book, params, time.perf_counter())
+    if sharded: # Grids in the sharded front run on the book from shared memory
+        book = decode_book(book.symbol, encode_book(book))
+    grid = trade_backend.parse_scenario_grid({}, params, book)
+    reply = trade_backend.evaluate_scenario_grid(book, grid, params)
+    assert reply['calibration'] == {'volatilitySource': 'live', 'advSource': 'live'}
+    assert reply['marketImpact'][0][0][0] == tick['marketImpact']
+    assert reply['netCost'][0][0][0][0] == tick['netCost']
+
+
+def test_requested_impact_axes_are_reported():
+    book = live_book()
+    params = dict(trade_backend.simulation_params, calibration='live')
+    grid = trade_backend.parse_scenario_grid({'volatility': [30, 60]}, params, book)
+    assert grid['volatility'] == [30.0, 60.0]
+    assert grid['calibration'] == {'volatilitySource': 'request', 'advSource': 'live'}
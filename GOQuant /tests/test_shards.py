@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+
+import trade_shards
+from trade_limit_orders import LimitOrderSimulator
+from trade_order_book import L2OrderBook
+from trade_shards import SeqlockRing, decode_book, encode_book
+from trade_tick_store import LiveEstimates
+
+
+@pytest.fixture
+def ring():
+    ring = SeqlockRing(slots=4, slot_bytes=64, create=True)
+    yield ring
+    ring.close()
+
+
+def test_ring_round_trip(ring):
+    assert ring.read_latest() == (0, None)
+    reader = SeqlockRing(ring.name)
+    try:
+        for i in range(10): # Laps the 4-slot ring; readers always get the newest message
+            assert ring.publish(f"message {i}".encode()) == i + 1
+            assert reader.read_latest() == (i + 1, f"message {i}".encode())
+        assert (reader.slots, reader.slot_bytes) == (4, 64)
+    finally:
+        reader.close()
+
+
+def test_ring_rejects_oversize_payload(ring):
+    ring.publish(b"x" * 64)
+    with pytest.raises(ValueError):
+        ring.publish(b"x" * 65)
+    assert ring.read_latest() == (1, b"x" * 64)
+
+
+def test_read_retries_when_the_writer_laps_mid_copy(ring, monkeypatch):
+    ring.publish(b"old")
+    slot_header = trade_shards.SLOT_HEADER
+
+    class LappingSlotHeader:
+        """Lets the writer lap the whole ring right after the reader took a slot's sequence."""
+        size, pack_into = slot_header.size, slot_header.pack_into
+        calls = 0
+
+        def unpack_from(self, buf, offset):
+            values = slot_header.unpack_from(buf, offset)
+            LappingSlotHeader.calls += 1
+            if LappingSlotHeader.calls == 1:
+                for i in range(ring.slots):
+                    ring.publish(f"new {i}".encode())
+            return values
+
+    monkeypatch.setattr(trade_shards, 'SLOT_HEADER', LappingSlotHeader())
+    assert ring.read_latest() == (1 + ring.slots, f"new {ring.slots - 1}".encode())
+    assert LappingSlotHeader.calls == 2
+
+
+def test_read_skips_a_slot_being_written(ring, monkeypatch):
+    ring.publish(b"done")
+    offset = ring._slot_offset(0)
+    sequence = trade_shards.SEQUENCE.unpack_from(ring.shm.buf, offset)[0]
+    trade_shards.SEQUENCE.pack_into(ring.shm.buf, offset, sequence + 1) # Odd: a writer is in there
+    assert ring.read_latest() == (0, None) # Gives up after MAX_READ_RETRIES instead of returning torn data
+    trade_shards.SEQUENCE.pack_into(ring.shm.buf, offset, sequence + 2)
+    assert ring.read_latest() == (1, b"done")
+
+
+def sample_book():
+    book = L2OrderBook('TEST-SHARD')
+    book.order_tracker = LimitOrderSimulator(book.symbol)
+    book.apply_snapshot(np.column_stack((100.0 + np.arange(500) * 0.1, np.full(500, 1.5))),
+                        np.column_stack((99.9 - np.arange(500) * 0.1, np.full(500, 2.5))), ts='1700000000123')
+    return book
+
+
+def test_book_encoding_without_tracker():
+    book = sample_book()
+    decoded = decode_book(book.symbol, encode_book(book, levels=50))
+    assert decoded.okx_ts == '1700000000123' and decoded.is_ready()
+    assert decoded.top_asks(50) == book.top_asks(50)
+    assert decoded.top_bids(50) == book.top_bids(50)
+    assert len(decoded.asks) == 50 and decoded.order_tracker is None and decoded.live_estimates is None
+
+
+def test_book_encoding_with_tracker_and_estimates():
+    book = sample_book()
+    book.live_estimates = LiveEstimates(0.03, None, 1500.0, 7200)
+    tracker = book.order_tracker
+    tracker.reported_order_id = tracker.place(book, 'buy', 99.9, 1.0)
+    decoded = decode_book(book.symbol, encode_book(book, tracker=tracker.snapshot()))
+    assert decoded.live_estimates == book.live_estimates
+    expected = tracker.estimate(book, tracker.reported_order_id)
+    assert decoded.order_tracker.estimate(decoded, tracker.reported_order_id) == expected
+
+
+def test_book_encoding_drops_an_oversize_tracker(monkeypatch):
+    book = sample_book()
+    book.live_estimates = LiveEstimates(0.03, 0.02, 1500.0, 7200)
+    monkeypatch.setattr(trade_shards, 'BOOK_EXTRAS_BYTES', 200)
+    decoded = decode_book(book.symbol, encode_book(book, tracker=book.order_tracker.snapshot()))
+    assert decoded.order_tracker is None and decoded.live_estimates == book.live_estimates
@@ -0,0 +1,74 @@
+import math
+
+import numpy as np
+import pytest
+
+from trade_tick_store import MAX_RETURN_GAP_S, SECONDS_PER_DAY, TickStore
+
+# Short windows keep the stores small; the estimators behave the same at any scale
+WINDOWS = dict(volatility_window_s=600.0, ewma_half_life_s=300.0, volume_window_s=1800.0)
+START_TS = 1_700_000_000.0
+
+
+def observations(seed, count=4000):
+    """(ts, mid, volume) a few times per second, with a couple of feed outages."""
+    rng = np.random.default_rng(seed)
+    ts, mid = START_TS, 60000.0
+    for i in range(count):
+        ts += float(rng.uniform(0.1, 0.6))
+        if i in (1500, 3000):
+            ts += MAX_RETURN_GAP_S + 100.0
+        mid *= math.exp(float(rng.normal(0.0, 2e-4)))
+        yield ts, mid, float(rng.uniform(0.0, 0.2))
+
+
+def filled_store(directory=None, capacity=None, seed=0):
+    store = TickStore('TEST-TICKS', directory=directory, capacity=capacity, **WINDOWS)
+    for ts, mid, volume in observations(seed):
+        store.update(ts, mid, volume)
+    return store
+
+
+def assert_same_estimates(store, expected):
+    for name, value in expected._asdict().items():
+        assert getattr(store.estimates(), name) == pytest.approx(value, rel=1e-9), name
+
+
+def test_restart_warm_up_matches_streaming_estimates(tmp_path):
+    store = filled_store(str(tmp_path))
+    streamed = store.estimates()
+    assert streamed.ewma_daily_volatility is not None and streamed.average_daily_volume is not None
+    store.close()
+    assert_same_estimates(TickStore('TEST-TICKS', directory=str(tmp_path), **WINDOWS), streamed)
+
+
+def test_resize_keeps_newest_rows(tmp_path):
+    store = filled_store(str(tmp_path))
+    streamed, rows = store.estimates(), store.rows()
+    store.close()
+    for capacity in (5000, 1900, None): # Grow, shrink, then back to the default
+        reopened = TickStore('TEST-TICKS', directory=str(tmp_path), capacity=capacity, **WINDOWS)
+        kept = min(len(rows['ts']), reopened.capacity)
+        for name, column in reopened.rows().items():
+            assert np.array_equal(column, rows[name][-kept:]), name
+        assert_same_estimates(reopened, streamed)
+        reopened.close()
+
+
+def test_returns_across_long_gaps_are_skipped():
+    store = TickStore('TEST-TICKS', **WINDOWS)
+    ts = START_TS
+    for segment, mid in enumerate((100.0, 200.0)): # The price doubles during the outage
+        for i in range(100):
+            store.update(ts, mid * (1.0 + 1e-4 * (i % 2)))
+            ts += 1.0
+        ts += MAX_RETURN_GAP_S + 1.0
+    store.update(ts, 1.0) # Closes the last sample
+    rows = store.rows()
+    mids, gaps = rows['mid'], np.diff(rows['ts'])
+    within = gaps <= MAX_RETURN_GAP_S
+    assert (~within).sum() == 1
+    r2 = np.log(mids[1:] / mids[:-1])[within] ** 2
+    assert store.ewma_returns == within.sum()
+    expected = math.sqrt(r2.sum() / gaps[within].sum() * SECONDS_PER_DAY)
+    assert store.realized_daily_volatility() == pytest.approx(expected, rel=1e-9)
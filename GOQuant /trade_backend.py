@@ -14,14 +14,27 @@ Automatically generated by Colab.
 # 2. Connection to OKX WebSocket may require VPN and specific API handling.
 # 3. This is a conceptual script and would need significant development for production use.
 
+import argparse
 import asyncio
 import websockets
 import json
 import time
 import logging
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
+import trade_codec
+from trade_broadcast import UIBroadcaster
+from trade_compute import COMPUTE_MODES, ComputeStage, spawn_context
+from trade_limit_orders import DEFAULT_FILL_HORIZON_S, LimitOrderSimulator
+from trade_metrics import PipelineMetrics, StageTimer, serve_metrics_http
+from trade_model_cache import ModelCache
+from trade_order_book import L2OrderBook, OrderBookOutOfSync, fill_depth_price, walk_book
+from trade_recorder import FeedRecorder, replay_feed
+from trade_shards import ShardFront
+from trade_tick_store import SAMPLE_INTERVAL_S, TickStore
+
 # --- Configuration ---
 # More verbose logging format
 logging.basicConfig(
@@ -29,52 +42,128 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - [%(module)s:%(lineno)d] - %(message)s'
 )
 
-# OKX WebSocket Endpoint for L2 Order Book data
-OKX_L2_ENDPOINT = "wss://ws.gomarket-cpp.goquant.io/ws/l2-orderbook/okx/BTC-USDT-SWAP"
+# OKX WebSocket Endpoint for L2 Order Book data ({symbol} is the instrument id)
+OKX_L2_ENDPOINT_TEMPLATE = "wss://ws.gomarket-cpp.goquant.io/ws/l2-orderbook/okx/{symbol}"
+# Instruments to stream; each gets its own connection and order book
+INSTRUMENTS = ['BTC-USDT-SWAP']
+# symbol -> endpoint; override entries here to pull a symbol from a different feed
+INSTRUMENT_FEEDS = {symbol: OKX_L2_ENDPOINT_TEMPLATE.format(symbol=symbol) for symbol in INSTRUMENTS}
+# Delay between starting consecutive feeds, so dozens of symbols don't connect in one burst
+FEED_CONNECT_STAGGER_S = 0.05
+# Reconnects to resync an out-of-sync book: the first is immediate, repeated ones back off
+# exponentially up to the max. A connection that stayed up this long resets the backoff.
+RESYNC_BACKOFF_INITIAL_S = 0.5
+RESYNC_BACKOFF_MAX_S = 30.0
+RESYNC_BACKOFF_RESET_S = 60.0
+# After resubscribing an out-of-sync book, reconnect if no snapshot has arrived within this time
+RESYNC_SNAPSHOT_TIMEOUT_S = 10.0
 
 # WebSocket Server for UI communication
 UI_WEBSOCKET_HOST = "localhost"
 UI_WEBSOCKET_PORT = 8000 # Port for UI to connect to
+# How often slow-client broadcast stats are logged (seconds)
+BROADCAST_STATS_INTERVAL_S = 30
+# Local Prometheus-style metrics endpoint (http://host:port/metrics)
+METRICS_HTTP_HOST = "localhost"
+METRICS_HTTP_PORT = 8001
+# How often a latency summary message is pushed to UI clients (seconds)
+METRICS_SUMMARY_INTERVAL_S = 5
+# Where the cost models run: 'loop', 'thread' or 'process' (see trade_compute). Headless
+# backtests always evaluate every message inline so their output is reproducible.
+COMPUTE_MODE = 'thread'
+# Max model evaluation passes per second (0 = whenever a newer book is available)
+COMPUTE_MAX_RATE_HZ = 0.0
+# Most sizes a client may request in the per-tick slippage curve (it is evaluated on every tick)
+SLIPPAGE_CURVE_MAX_POINTS = 50
+# Scenario grids with at least this many cells are evaluated in a worker process
+SCENARIO_GRID_POOL_MIN_CELLS = 20000
+# Largest grid (quantity x volatility x fee tier x ADV cells) accepted per request
+SCENARIO_GRID_MAX_CELLS = 250000
+SCENARIO_POOL_WORKERS = 2
+# Rolling mid/volume history per instrument feeding the live volatility and ADV estimators.
+# With a directory it is kept in memory-mapped files and warms the estimators up on restart.
+TICK_STORE_DIR = None
+TICK_STORE_FLUSH_INTERVAL_S = 10
+# History kept per instrument (seconds); None keeps just the longest estimator window (24 h)
+TICK_STORE_RETENTION_S = None
+# Worker processes the instruments are split across (0 = everything in this process; see trade_shards)
+SHARD_COUNT = 0
+# How often the sharded front process checks the shared-memory rings for new ticks (seconds)
+SHARD_POLL_INTERVAL_S = 0.002
 
 # --- Global State ---
-current_order_book = {
-    'bids': [], 'asks': [], 'timestamp': None, 'symbol': None, 'okx_ts': None
-}
 simulation_params = {
     'spot_asset': 'BTC-USDT-SWAP',
     'order_type': 'market',
     'quantity_usd': 1000.0,
     'volatility_pct': 60.0,
     'fee_tier_data': {'maker': 0.0008, 'taker': 0.0010},
-    'average_daily_volume_asset': 50000.0
+    'average_daily_volume_asset': 50000.0,
+    'side': 'buy',                   # 'buy' walks the asks, 'sell' walks the bids
+    'slippage_model': 'walk_book',   # 'walk_book' (full-depth VWAP) or 'heuristic'
+    'limit_price': None,             # Limit orders only; None joins the best price on our side
+    'limit_horizon_s': DEFAULT_FILL_HORIZON_S, # Limit orders: fill probability horizon
+    'calibration': 'manual',         # 'manual' (volatility/ADV above) or 'live' (tick store estimates once warm)
+    'live_volatility': 'ewma',       # Live calibration: 'ewma' or 'window' (trailing realized volatility)
+    'slippage_curve_usd': [1000.0, 10000.0, 50000.0, 100000.0, 500000.0, 1000000.0]
 }
 
 # Placeholders for actual trained models
 slippage_model = None
 maker_taker_model = None
 
+# Annualized volatility -> daily volatility
+SQRT_TRADING_DAYS = np.sqrt(252)
+# Market impact model constants (shared by the per-tick and scenario grid versions)
+IMPACT_COEFFICIENT = 0.5      # NEEDS CALIBRATION
+IMPACT_SIZE_EXPONENT = 0.6    # NEEDS CALIBRATION
+IMPACT_MAX_RELATIVE_SIZE = 0.1 # Cap on order size / ADV
+
 # --- Model Functions (Simplified Placeholders) ---
+def calculate_walk_book_slippage(order_book, asset_quantities, mid_price, params):
+    """Exact slippage vs mid (USD) for one or many order sizes, from the full-depth fill VWAP.
+
+    Any quantity beyond the visible depth is assumed to fill at the worst visible level.
+    """
+    is_buy = params.get('side', 'buy') == 'buy'
+    side = order_book.asks if is_buy else order_book.bids
+    asset_quantities = np.asarray(asset_quantities, dtype=np.float64)
+    if len(side) == 0 or mid_price == 0:
+        return np.zeros(asset_quantities.shape)
+    vwap, filled = walk_book(side, asset_quantities)
+    worst_price = side.depth_arrays()[0][-1]
+    unfilled = asset_quantities - filled
+    if np.any(unfilled > 0):
+        logging.debug(f"Order size exceeds visible depth for {order_book.symbol}; pricing remainder at {worst_price}.")
+    notional = np.nan_to_num(vwap * filled) + unfilled * worst_price
+    reference = asset_quantities * mid_price
+    slippage = notional - reference if is_buy else reference - notional
+    return np.maximum(slippage, 0.0)
+
 def calculate_expected_slippage(order_book, asset_quantity, mid_price, params):
-    """CONCEPTUAL/SIMPLIFIED: Calculates expected slippage."""
-    if not order_book['asks'] or not order_book['bids'] or mid_price == 0:
+    """Calculates expected slippage, walking the book or using the CONCEPTUAL/SIMPLIFIED heuristic."""
+    if params.get('slippage_model') == 'walk_book':
+        return float(calculate_walk_book_slippage(order_book, asset_quantity, mid_price, params))
+    best_ask = order_book.best_ask()
+    if best_ask is None or order_book.best_bid() is None or mid_price == 0:
         return 0.0
-    try:
-        best_ask_qty = float(order_book['asks'][0][1])
-    except (IndexError, ValueError, TypeError):
-        # Default slippage if book data is malformed
-        return mid_price * 0.001 * asset_quantity
+    best_ask_qty = best_ask[1]
 
     slippage_factor = 0.0005 # Base slippage factor (0.05%)
     if best_ask_qty > 0 and asset_quantity > best_ask_qty:
         slippage_factor += (asset_quantity / best_ask_qty) * 0.001 # Additional 0.1%
     return mid_price * slippage_factor * asset_quantity
 
-def calculate_expected_fees(quantity_usd, params):
-    """Calculates fees based on taker rate for market orders."""
+def calculate_expected_fees(quantity_usd, params, limit_estimate=None):
+    """Calculates fees: taker rate for market orders, the expected maker/taker split for limit orders."""
     if params['order_type'] == 'market':
         taker_rate = params['fee_tier_data'].get('taker', 0.001) # Default if not found
         return quantity_usd * taker_rate
-    return 0.0 # Placeholder for non-market orders
+    if limit_estimate is not None:
+        taker_rate = params['fee_tier_data'].get('taker', 0.001)
+        maker_rate = params['fee_tier_data'].get('maker', 0.0008)
+        return quantity_usd * (limit_estimate['takerPct'] * taker_rate + limit_estimate['makerPct'] * maker_rate) / 100.0
+    return 0.0 # No simulated order (yet) for this book
 
 def calculate_market_impact(order_book, asset_quantity, quantity_usd, mid_price, params):
     """CONCEPTUAL/SIMPLIFIED: Calculates expected market impact."""
@@ -83,47 +172,263 @@ def calculate_market_impact(order_book, asset_quantity, quantity_usd, mid_price,
     adv_asset = params['average_daily_volume_asset']
     if adv_asset == 0: return 0.0
 
-    daily_volatility = annualized_volatility_decimal / np.sqrt(252)
-    impact_coefficient = 0.5  # NEEDS CALIBRATION
-    size_exponent = 0.6       # NEEDS CALIBRATION
+    daily_volatility = annualized_volatility_decimal / SQRT_TRADING_DAYS
 
     if asset_quantity < 0: asset_quantity = 0
     relative_size = asset_quantity / adv_asset
 
-    if relative_size > 0.1: # Cap relative size to avoid extreme impact
-        relative_size = 0.1
+    if relative_size > IMPACT_MAX_RELATIVE_SIZE: # Cap relative size to avoid extreme impact
+        relative_size = IMPACT_MAX_RELATIVE_SIZE
         logging.debug(f"Order size ({asset_quantity}) large vs ADV ({adv_asset}). Capping relative_size.")
 
-    price_impact_percentage = impact_coefficient * daily_volatility * (relative_size ** size_exponent)
+    price_impact_percentage = IMPACT_COEFFICIENT * daily_volatility * (relative_size ** IMPACT_SIZE_EXPONENT)
     return quantity_usd * max(0, price_impact_percentage) # Ensure non-negative impact
 
-def get_maker_taker_proportion(params):
-    """Determines Maker/Taker proportion. For market orders, it's 100% Taker."""
+def market_impact_inputs(order_book, params):
+    """Returns (volatility_pct, adv_asset, sources) for the market impact model.
+
+    With params['calibration'] == 'live' each input comes from the book's live
+    estimates once they are warm, and from the manual parameter until then.
+    """
+    volatility_pct, adv_asset = params['volatility_pct'], params['average_daily_volume_asset']
+    sources = {"volatility": "manual", "adv": "manual"}
+    estimates = order_book.live_estimates
+    if params.get('calibration') != 'live' or estimates is None:
+        return volatility_pct, adv_asset, sources
+    daily_volatility = (estimates.realized_daily_volatility if params.get('live_volatility') == 'window'
+                        else estimates.ewma_daily_volatility)
+    if daily_volatility is not None:
+        volatility_pct = float(daily_volatility * SQRT_TRADING_DAYS * 100.0)
+        sources["volatility"] = "live"
+    if estimates.average_daily_volume:
+        adv_asset = estimates.average_daily_volume
+        sources["adv"] = "live"
+    return volatility_pct, adv_asset, sources
+
+def calculate_slippage_curve(order_book, mid_price, params):
+    """Walk-the-book slippage for every USD size in params['slippage_curve_usd'], in one batched call."""
+    sizes_usd = np.asarray(params.get('slippage_curve_usd', []), dtype=np.float64)
+    if sizes_usd.size == 0 or mid_price == 0:
+        return []
+    slippage = calculate_walk_book_slippage(order_book, sizes_usd / mid_price, mid_price, params)
+    return [[float(size), round(float(slip), 2)] for size, slip in zip(sizes_usd, slippage)]
+
+def reported_limit_estimate(order_book, params):
+    """Fill estimate of the book's simulated UI limit order, or None (market orders, no order yet)."""
+    tracker = order_book.order_tracker
+    if params['order_type'] != 'limit' or tracker is None:
+        return None
+    return tracker.estimate(order_book, tracker.reported_order_id, params.get('limit_horizon_s', DEFAULT_FILL_HORIZON_S))
+
+def get_maker_taker_proportion(params, limit_estimate=None):
+    """Determines Maker/Taker proportion: 100% Taker for market orders; for limit orders the
+    filled taker share plus the expected maker share from the fill simulation."""
     if params['order_type'] == 'market':
         return {"taker_pct": 100.0, "maker_pct": 0.0}
-    # Placeholder for limit orders (would involve a model)
+    if limit_estimate is not None:
+        return {"taker_pct": limit_estimate['takerPct'], "maker_pct": limit_estimate['makerPct']}
     return {"taker_pct": 0.0, "maker_pct": 0.0}
 
+# --- Scenario Grids ---
+scenario_pool = None # ProcessPoolExecutor for large grids, created on first use
+
+def calculate_fees_grid(quantities_usd, taker_rates, maker_rates, params, limit_estimate=None):
+    """calculate_expected_fees over quantity x fee tier; returns shape (q, f).
+
+    Limit orders apply the simulated order's maker/taker split to every cell.
+    """
+    if params['order_type'] == 'market':
+        return np.outer(quantities_usd, taker_rates)
+    if limit_estimate is not None:
+        blended_rates = (limit_estimate['takerPct'] * taker_rates + limit_estimate['makerPct'] * maker_rates) / 100.0
+        return np.outer(quantities_usd, blended_rates)
+    return np.zeros((len(quantities_usd), len(taker_rates)))
+
+def calculate_market_impact_grid(asset_quantities, quantities_usd, volatilities_pct, advs_asset):
+    """calculate_market_impact over quantity x volatility x ADV; returns shape (q, v, a)."""
+    daily_volatility = volatilities_pct / 100.0 / SQRT_TRADING_DAYS
+    adv = advs_asset[None, None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative_size = np.where(adv > 0, np.maximum(asset_quantities, 0.0)[:, None, None] / adv, 0.0)
+    relative_size = np.minimum(relative_size, IMPACT_MAX_RELATIVE_SIZE)
+    price_impact_percentage = IMPACT_COEFFICIENT * daily_volatility[None, :, None] * relative_size ** IMPACT_SIZE_EXPONENT
+    return quantities_usd[:, None, None] * np.maximum(price_impact_percentage, 0.0)
+
+def parse_scenario_grid(grid_request, params, order_book):
+    """Builds the grid axes from a UI request; missing axes default to the current parameters.
+
+    Missing volatility and ADV axes default to the market impact inputs the
+    ticks of `order_book` use (live estimates under live calibration).
+    Raises ValueError if an axis is malformed or the grid is too large.
+    """
+    def axis(name, default):
+        values = grid_request.get(name, [default])
+        if not isinstance(values, list) or not values:
+            raise ValueError(f"'{name}' must be a non-empty list")
+        return [float(v) for v in values]
+
+    fee_tiers = grid_request.get('feeTiers', [params['fee_tier_data']])
+    if not isinstance(fee_tiers, list) or not fee_tiers or \
+       not all(isinstance(tier, dict) and 'maker' in tier and 'taker' in tier for tier in fee_tiers):
+        raise ValueError("'feeTiers' must be a non-empty list of {'maker', 'taker'} objects")
+    volatility_pct, adv_asset, sources = market_impact_inputs(order_book, params)
+    grid = {
+        'quantityUSD': axis('quantityUSD', params['quantity_usd']),
+        'volatility': axis('volatility', volatility_pct),
+        'feeTiers': [{'maker': float(tier['maker']), 'taker': float(tier['taker'])} for tier in fee_tiers],
+        'adv': axis('adv', adv_asset),
+        # Where each impact axis came from: 'request', or the tick's source when defaulted
+        'calibration': {
+            'volatilitySource': 'request' if 'volatility' in grid_request else sources['volatility'],
+            'advSource': 'request' if 'adv' in grid_request else sources['adv'],
+        },
+    }
+    cells = scenario_grid_cells(grid)
+    if cells > SCENARIO_GRID_MAX_CELLS:
+        raise ValueError(f"Grid has {cells} cells; the limit is {SCENARIO_GRID_MAX_CELLS}")
+    return grid
+
+def scenario_grid_cells(grid):
+    return len(grid['quantityUSD']) * len(grid['volatility']) * len(grid['feeTiers']) * len(grid['adv'])
+
+def evaluate_scenario_grid(order_book, grid, params):
+    """Evaluates slippage, fees and market impact over a quantity x volatility x fee tier x ADV grid.
+
+    Each model runs once, vectorized over just the axes it depends on, and the
+    results are broadcast into netCost[q][v][f][a]. Returns the UI reply, or
+    None if the book isn't usable.
+    """
+    if not order_book.is_ready():
+        return None
+    mid_price = (order_book.best_bid()[0] + order_book.best_ask()[0]) / 2.0
+    if mid_price == 0:
+        return None
+    quantities_usd = np.asarray(grid['quantityUSD'], dtype=np.float64)
+    volatilities = np.asarray(grid['volatility'], dtype=np.float64)
+    taker_rates = np.array([tier['taker'] for tier in grid['feeTiers']], dtype=np.float64)
+    maker_rates = np.array([tier['maker'] for tier in grid['feeTiers']], dtype=np.float64)
+    advs = np.asarray(grid['adv'], dtype=np.float64)
+    asset_quantities = quantities_usd / mid_price
+
+    if params.get('slippage_model') == 'walk_book':
+        slippage = calculate_walk_book_slippage(order_book, asset_quantities, mid_price, params)
+    else:
+        slippage = np.array([calculate_expected_slippage(order_book, q, mid_price, params) for q in asset_quantities])
+    limit_estimate = reported_limit_estimate(order_book, params)
+    fees = calculate_fees_grid(quantities_usd, taker_rates, maker_rates, params, limit_estimate)
+    impact = calculate_market_impact_grid(asset_quantities, quantities_usd, volatilities, advs)
+    net_cost = slippage[:, None, None, None] + fees[:, None, :, None] + impact[:, :, None, :]
+    maker_taker = get_maker_taker_proportion(params, limit_estimate)
+
+    return {
+        "type": "scenarioGrid",
+        "symbol": order_book.symbol,
+        "midPrice": round(mid_price, 2),
+        "axes": {name: values for name, values in grid.items() if name != 'calibration'},
+        "calibration": grid['calibration'],
+        "shape": list(net_cost.shape),
+        "slippage": np.round(slippage, 2).tolist(),   # [q]
+        "fees": np.round(fees, 2).tolist(),           # [q][f]
+        "marketImpact": np.round(impact, 2).tolist(), # [q][v][a]
+        "netCost": np.round(net_cost, 2).tolist(),    # [q][v][f][a]
+        "makerTaker": {"takerPct": maker_taker["taker_pct"], "makerPct": maker_taker["maker_pct"]}, # Fee split used
+    }
+
+def scenario_grid_message(order_book, grid, params, request_id=None):
+    """Evaluates the grid and returns the serialized UI reply (runs in a worker process for large grids)."""
+    result = evaluate_scenario_grid(order_book, grid, params)
+    if result is None:
+        result = {"type": "scenarioGrid", "symbol": order_book.symbol, "error": f"No usable order book for {order_book.symbol}"}
+    result["id"] = request_id
+    return trade_codec.dumps(result)
+
+def get_scenario_pool():
+    global scenario_pool
+    if scenario_pool is None:
+        scenario_pool = ProcessPoolExecutor(max_workers=SCENARIO_POOL_WORKERS, mp_context=spawn_context())
+    return scenario_pool
+
+# --- Metrics ---
+# Per-stage latency histograms: parse, book_update, model_eval, serialize, broadcast,
+# tick_total and exchange_to_recv (exchange 'ts' to local receive time)
+pipeline_metrics = PipelineMetrics()
+# Per-tick model outputs, reused while their inputs are unchanged
+model_cache = ModelCache()
+pipeline_metrics.register_gauge('model_cache_hit_ratio', model_cache.hit_ratio)
+
 # --- WebSocket Handlers ---
-connected_ui_clients = set()
+# Key order of the tick frames built by compute_tick_output (pre-encoded once by the encoder)
+TICK_FRAME_KEYS = (
+    "symbol", "bestBid", "bestAsk", "midPrice", "expectedSlippage", "expectedFees", "marketImpact",
+    "netCost", "slippageCurve", "makerTaker", "limitOrder", "calibration", "internalLatency", "lastUpdate", "asks", "bids",
+)
+tick_frame_encoder = trade_codec.TickFrameEncoder(TICK_FRAME_KEYS)
+# Per-client conflating outbound queues; feed processing never awaits a UI socket
+ui_broadcaster = UIBroadcaster(serializer=tick_frame_encoder.encode, metrics=pipeline_metrics)
+pipeline_metrics.register_gauge('ui_clients', lambda: len(ui_broadcaster.channels))
+pipeline_metrics.register_gauge('ui_pending_messages', ui_broadcaster.pending_count)
+pipeline_metrics.register_gauge('ui_max_client_pending', ui_broadcaster.max_pending)
 
 async def ui_communication_handler(websocket, path=None):
     """Handles WebSocket connections from the Frontend UI."""
     global simulation_params
     client_address = websocket.remote_address
-    connected_ui_clients.add(websocket)
+    # Each client starts subscribed to the default instrument only
+    channel = ui_broadcaster.register(websocket, symbols={simulation_params['spot_asset']})
     logging.info(f"UI Client connected: {client_address}")
     try:
         async for message in websocket:
             try:
-                ui_data = json.loads(message)
+                ui_data = trade_codec.loads(message)
                 logging.info(f"Received from UI ({client_address}): {ui_data}")
 
+                # Per-client instrument subscriptions: a list of symbols or "*" for all
+                if 'subscribe' in ui_data:
+                    symbols = ui_data['subscribe']
+                    if symbols == '*' or (isinstance(symbols, list) and all(isinstance(s, str) for s in symbols)):
+                        channel.symbols = {'*'} if symbols == '*' else set(symbols)
+                        logging.info(f"UI Client {client_address} subscribed to: {sorted(channel.symbols)}")
+                    else:
+                        logging.warning(f"UI Client {client_address} sent a malformed subscribe: {symbols!r}")
+                        ui_broadcaster.send_to(websocket, {"type": "subscribe", "error": "'subscribe' must be \"*\" "
+                                               "or a list of instrument ids"}, "subscribe")
+                if isinstance(ui_data.get('unsubscribe'), list):
+                    channel.symbols.difference_update(ui_data['unsubscribe'])
+                if ui_data.get('request') == 'broadcastStats':
+                    ui_broadcaster.send_to(websocket, {"type": "broadcastStats", **ui_broadcaster.stats()}, "broadcastStats")
+                    continue
+                if ui_data.get('request') == 'scenarioGrid':
+                    await handle_scenario_grid_request(websocket, ui_data)
+                    continue
+
                 # Update simulation_params based on UI input
                 if 'quantityUSD' in ui_data:
                     simulation_params['quantity_usd'] = float(ui_data['quantityUSD'])
                 if 'volatility' in ui_data:
                     simulation_params['volatility_pct'] = float(ui_data['volatility'])
+                if ui_data.get('slippageModel') in ('walk_book', 'heuristic'):
+                    simulation_params['slippage_model'] = ui_data['slippageModel']
+                if ui_data.get('side') in ('buy', 'sell'):
+                    simulation_params['side'] = ui_data['side']
+                if ui_data.get('orderType') in ('market', 'limit'):
+                    simulation_params['order_type'] = ui_data['orderType']
+                if 'limitPrice' in ui_data:
+                    # Empty/null joins the best price on our side of the book
+                    limit_price = ui_data['limitPrice']
+                    simulation_params['limit_price'] = float(limit_price) if limit_price not in (None, '') else None
+                if 'limitHorizonS' in ui_data:
+                    simulation_params['limit_horizon_s'] = float(ui_data['limitHorizonS'])
+                if ui_data.get('calibration') in ('manual', 'live'):
+                    simulation_params['calibration'] = ui_data['calibration']
+                if ui_data.get('liveVolatility') in ('ewma', 'window'):
+                    simulation_params['live_volatility'] = ui_data['liveVolatility']
+                if isinstance(ui_data.get('slippageCurveUSD'), list):
+                    curve_sizes = [float(q) for q in ui_data['slippageCurveUSD'][:SLIPPAGE_CURVE_MAX_POINTS + 1]]
+                    if len(curve_sizes) <= SLIPPAGE_CURVE_MAX_POINTS and all(np.isfinite(q) and q > 0 for q in curve_sizes):
+                        simulation_params['slippage_curve_usd'] = curve_sizes
+                    else:
+                        logging.warning(f"Rejected 'slippageCurveUSD' from UI: expected at most "
+                                        f"{SLIPPAGE_CURVE_MAX_POINTS} positive sizes")
                 if 'fee_tier_data' in ui_data:
                     if isinstance(ui_data['fee_tier_data'], dict) and \
                        'maker' in ui_data['fee_tier_data'] and \
@@ -133,7 +438,7 @@ async def ui_communication_handler(websocket, path=None):
                         logging.warning(f"Malformed 'fee_tier_data' from UI: {ui_data['fee_tier_data']}")
                 logging.info(f"Updated simulation_params: {simulation_params}")
 
-            except json.JSONDecodeError:
+            except trade_codec.JSONDecodeError:
                 logging.error(f"Invalid JSON from UI ({client_address}). Msg: {message[:200]}")
             except Exception as e:
                 logging.error(f"Error processing UI msg from {client_address}: {e}", exc_info=True)
@@ -142,205 +447,592 @@ async def ui_communication_handler(websocket, path=None):
     except Exception as e:
         logging.error(f"Unexpected error in UI handler for {client_address}: {e}", exc_info=True)
     finally:
-        if websocket in connected_ui_clients: # Check if still present before removing
-            connected_ui_clients.remove(websocket)
+        await ui_broadcaster.unregister(websocket)
         logging.info(f"UI Client {client_address} removed from active connections.")
 
-async def broadcast_to_ui(data_to_send):
-    """Broadcasts processed data to all connected UI clients."""
-    if connected_ui_clients:
-        message_json = json.dumps(data_to_send)
-        # Create a list of tasks for sending messages to avoid issues if the set changes during iteration
-        tasks = [client.send(message_json) for client in list(connected_ui_clients)]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+async def handle_scenario_grid_request(websocket, ui_data):
+    """Evaluates a scenario grid against the requested instrument's current book and replies to the client.
+
+    Request: {"request": "scenarioGrid", "symbol": ..., "id": ..., "grid": {"quantityUSD": [...],
+    "volatility": [...], "feeTiers": [{"maker", "taker"}, ...], "adv": [...]}}
+    """
+    symbol = ui_data.get('symbol', simulation_params['spot_asset'])
+    request_id = ui_data.get('id')
+    reply_key = ("scenarioGrid", request_id)
+    book = current_order_book(symbol)
+    try:
+        if book is None:
+            raise ValueError(f"No order book for {symbol}")
+        grid = parse_scenario_grid(ui_data.get('grid') or {}, simulation_params, book)
+    except (TypeError, ValueError) as e:
+        ui_broadcaster.send_to(websocket, {"type": "scenarioGrid", "symbol": symbol, "id": request_id, "error": str(e)}, reply_key)
+        return
+    params = dict(simulation_params)
+    start = time.perf_counter()
+    if scenario_grid_cells(grid) >= SCENARIO_GRID_POOL_MIN_CELLS:
+        # Large grids are evaluated and encoded on a book snapshot in a worker process
+        loop = asyncio.get_running_loop()
+        message = await loop.run_in_executor(
+            get_scenario_pool(), scenario_grid_message, book.snapshot(), grid, params, request_id)
+    else:
+        message = scenario_grid_message(book, grid, params, request_id)
+    pipeline_metrics.observe('scenario_grid', time.perf_counter() - start)
+    ui_broadcaster.send_message_to(websocket, message, reply_key)
+
+def broadcast_to_ui(data_to_send, symbol=None, key=None):
+    """Queues processed data for the UI clients subscribed to `symbol` (all clients if None).
+
+    Messages are conflated per `key` (defaults to the symbol), so a slow client
+    only ever receives the latest tick for each instrument.
+    """
+    ui_broadcaster.publish(data_to_send, key if key is not None else symbol, symbol)
+
+async def publish_metrics_summary():
+    """Periodically pushes the per-stage latency summary (microseconds) to every UI client."""
+    while True:
+        await asyncio.sleep(METRICS_SUMMARY_INTERVAL_S)
+        broadcast_to_ui({"type": "metrics", **pipeline_metrics.summary()}, key="metrics")
+
+async def log_broadcast_stats():
+    """Periodically logs UI fan-out stats, calling out slow clients."""
+    while True:
+        await asyncio.sleep(BROADCAST_STATS_INTERVAL_S)
+        stats = ui_broadcaster.stats()
+        logging.info(f"UI broadcast: {stats['clients']} clients, {stats['published']} published, "
+                     f"{stats['conflated']} conflated, {stats['slowClients']} slow")
+        for client_stats in stats['perClient']:
+            if client_stats['conflated'] or client_stats['slowSends']:
+                logging.info(f"Slow UI client: {client_stats}")
+        if compute_stage is not None:
+            logging.info(f"Compute stage: {compute_stage.stats()}")
+
+async def flush_tick_stores():
+    """Periodically writes the persisted tick stores to disk."""
+    while True:
+        await asyncio.sleep(TICK_STORE_FLUSH_INTERVAL_S)
+        for store in tick_stores.values():
+            try:
+                store.flush()
+            except OSError as e:
+                logging.error(f"Could not flush tick store for {store.symbol}: {e}")
+
+# --- Per-Instrument Processing ---
+order_books = {} # symbol -> L2OrderBook
+ui_limit_orders = {} # symbol -> (order id, parameters it was placed with) of the simulated UI limit order
+resync_pending = {} # symbol -> time.monotonic() of its resubscribe; updates are dropped until the snapshot
+tick_stores = {} # symbol -> TickStore
+tick_store_dir = TICK_STORE_DIR # Set from --tick-store
+feed_recorder = None # FeedRecorder when --record is given
+backtest_output = None # Open JSON-lines file receiving every tick during replay backtests
+compute_stage = None # ComputeStage while the backend runs; None = evaluate models inline per message
+shard_front = None # ShardFront in sharded mode: the books live in the shard worker processes
+pipeline_metrics.register_gauge('compute_pending', lambda: compute_stage.pending_count() if compute_stage else 0)
+
+def get_order_book(symbol):
+    """Returns the order book for `symbol`, creating it on first use."""
+    book = order_books.get(symbol)
+    if book is None:
+        book = order_books[symbol] = L2OrderBook(symbol=symbol)
+        book.order_tracker = LimitOrderSimulator(symbol)
+    return book
+
+def current_order_book(symbol):
+    """Returns the latest book for `symbol` from this process or, in sharded mode, from shared memory."""
+    if shard_front is not None:
+        return shard_front.book(symbol)
+    return order_books.get(symbol)
+
+def get_tick_store(symbol):
+    """Returns the tick store for `symbol`, creating (and warming up) it on first use."""
+    store = tick_stores.get(symbol)
+    if store is None:
+        capacity = int(TICK_STORE_RETENTION_S / SAMPLE_INTERVAL_S) if TICK_STORE_RETENTION_S else None
+        store = tick_stores[symbol] = TickStore(symbol, directory=tick_store_dir, capacity=capacity)
+    return store
+
+def update_tick_store(order_book):
+    """Adds the book's mid and estimated traded volume to its tick store; refreshes the live estimates."""
+    if not order_book.is_ready():
+        return
+    store = get_tick_store(order_book.symbol)
+    try:
+        ts = int(order_book.okx_ts) / 1000.0 if order_book.okx_ts else time.time()
+    except (ValueError, TypeError):
+        ts = time.time()
+    mid_price = (order_book.best_bid()[0] + order_book.best_ask()[0]) / 2.0
+    # The L2 feed carries no trades: volume is the front-of-queue execution estimate
+    volume = order_book.order_tracker.last_executed if order_book.order_tracker is not None else 0.0
+    if store.update(ts, mid_price, volume) or order_book.live_estimates is None:
+        order_book.live_estimates = store.estimates()
+
+def sync_ui_limit_order(order_book, params):
+    """Keeps one simulated limit order per book matching the UI parameters while order_type is 'limit'.
+
+    The order is placed again whenever the parameters change or it has filled completely.
+    """
+    tracker = order_book.order_tracker
+    current = ui_limit_orders.get(order_book.symbol)
+    if params['order_type'] != 'limit' or not params['quantity_usd'] > 0:
+        # Nothing to simulate (a zero or negative UI quantity is not an order)
+        if current is not None:
+            tracker.cancel(current[0])
+            del ui_limit_orders[order_book.symbol]
+        return
+    placed_with = (params['side'], params.get('limit_price'), params['quantity_usd'])
+    if current is not None and current[1] == placed_with and current[0] in tracker.orders \
+       and not tracker.orders[current[0]].is_done():
+        return
+    if not order_book.is_ready():
+        return
+    if current is not None:
+        tracker.cancel(current[0])
+    best_bid_price, best_ask_price = order_book.best_bid()[0], order_book.best_ask()[0]
+    price = params.get('limit_price')
+    if price is None:
+        price = best_bid_price if params['side'] == 'buy' else best_ask_price
+    asset_quantity = params['quantity_usd'] / ((best_bid_price + best_ask_price) / 2.0)
+    if not (np.isfinite(asset_quantity) and asset_quantity > 0 and np.isfinite(price)):
+        ui_limit_orders.pop(order_book.symbol, None) # Any previous order was cancelled above
+        return
+    order_id = tracker.place(order_book, params['side'], price, asset_quantity, report=True)
+    ui_limit_orders[order_book.symbol] = (order_id, placed_with)
+
+def parse_book_message(message_data, default_symbol):
+    """Extracts (symbol, action, data_payload) from an L2 message; payload is None if unusable."""
+    data_payload = None
+    action = None
+    symbol = default_symbol
+    # Adapt to common OKX L2 structure or the simpler prompt structure
+    if "data" in message_data and isinstance(message_data["data"], list) and message_data["data"]:
+        data_payload = message_data["data"][0] # Data is usually an array with one object
+        # Channels without an action (books5, bbo-tbt) push full books every time
+        action = message_data.get("action", "snapshot")
+        symbol = (message_data.get("arg") or {}).get("instId", default_symbol)
+    elif "asks" in message_data and "bids" in message_data : # Fallback to simpler format from prompt
+        data_payload = message_data
+        action = "snapshot" # Treat as a full snapshot
+        symbol = message_data.get("symbol", default_symbol)
+    return symbol, action, data_payload
+
+def compute_tick_output(order_book, params, tick_processing_start_time):
+    """Runs the cost models on `order_book` and builds the UI payload; None if the book isn't usable."""
+    if not order_book.is_ready():
+        logging.debug(f"Order book for {order_book.symbol} is empty or incomplete, skipping calculations.")
+        return None
+
+    best_bid_price = order_book.best_bid()[0]
+    best_ask_price = order_book.best_ask()[0]
+
+    mid_price = (best_bid_price + best_ask_price) / 2.0
+    if mid_price == 0:
+        logging.warning(f"Mid price is zero for {order_book.symbol}, skipping calculations.")
+        return None
 
-        for i, result in enumerate(results):
-            if isinstance(result, Exception):
-                # This mapping back to client can be tricky if the client set changed.
-                # For simplicity, just log the error.
-                logging.error(f"Error sending to a UI client: {result}")
+    quantity_usd = params['quantity_usd']
+    asset_quantity = quantity_usd / mid_price
+    side_name = 'asks' if params.get('side', 'buy') == 'buy' else 'bids'
+    slippage_model_name = params.get('slippage_model')
+    curve_sizes_usd = tuple(params.get('slippage_curve_usd', ()))
 
+    def walked_levels(quantity):
+        # A fill only reads the walked side down to the level that completes it
+        side = getattr(order_book, side_name)
+        return ((side_name, side.version, fill_depth_price(side, quantity)),)
 
-async def okx_market_data_listener():
-    """Connects to OKX L2 order book stream, processes data, and broadcasts to UI."""
-    global current_order_book
-    uri = OKX_L2_ENDPOINT
+    # Call model functions; each output is reused until its own inputs change
+    model_eval_start = time.perf_counter()
+    limit_estimate = reported_limit_estimate(order_book, params)
+    limit_split = (limit_estimate['takerPct'], limit_estimate['makerPct']) if limit_estimate else None
+    slippage_usd = model_cache.cached(
+        'slippage', order_book, (mid_price, quantity_usd, slippage_model_name, side_name),
+        lambda: calculate_expected_slippage(order_book, asset_quantity, mid_price, params),
+        lambda: walked_levels(asset_quantity) if slippage_model_name == 'walk_book'
+        else (('asks', order_book.asks.version, best_ask_price),)) # Heuristic reads the best ask only
+    fees_usd = model_cache.cached(
+        'fees', order_book,
+        (quantity_usd, params['order_type'], params['fee_tier_data'].get('taker'),
+         params['fee_tier_data'].get('maker'), limit_split),
+        lambda: calculate_expected_fees(quantity_usd, params, limit_estimate))
+    volatility_pct, adv_asset, calibration_sources = market_impact_inputs(order_book, params)
+    impact_params = params
+    if calibration_sources["volatility"] == "live" or calibration_sources["adv"] == "live":
+        impact_params = dict(params, volatility_pct=volatility_pct, average_daily_volume_asset=adv_asset)
+    impact_usd = model_cache.cached(
+        'market_impact', order_book, (mid_price, quantity_usd, volatility_pct, adv_asset),
+        lambda: calculate_market_impact(order_book, asset_quantity, quantity_usd, mid_price, impact_params))
+    net_cost_usd = slippage_usd + fees_usd + impact_usd
+    maker_taker_info = get_maker_taker_proportion(params, limit_estimate)
+    slippage_curve = model_cache.cached(
+        'slippage_curve', order_book, (mid_price, curve_sizes_usd, side_name),
+        lambda: calculate_slippage_curve(order_book, mid_price, params),
+        lambda: walked_levels(max(curve_sizes_usd) / mid_price) if curve_sizes_usd else ())
 
+    tick_processing_end_time = time.perf_counter()
+    pipeline_metrics.observe('model_eval', tick_processing_end_time - model_eval_start)
+    processing_latency_ms = (tick_processing_end_time - tick_processing_start_time) * 1000
+
+    # Prepare data for UI
+    iso_timestamp = "N/A"
+    if order_book.okx_ts:
+        try:
+            ts_int = int(order_book.okx_ts)
+            # Convert milliseconds to seconds for utcfromtimestamp
+            iso_timestamp = datetime.utcfromtimestamp(ts_int / 1000).isoformat() + 'Z'
+        except (ValueError, TypeError):
+            logging.warning(f"Could not parse OKX timestamp: {order_book.okx_ts}")
+
+    return {
+        "symbol": order_book.symbol,
+        "bestBid": best_bid_price, "bestAsk": best_ask_price,
+        "midPrice": round(mid_price, 2),
+        "expectedSlippage": round(slippage_usd, 2),
+        "expectedFees": round(fees_usd, 2),
+        "marketImpact": round(impact_usd, 2),
+        "netCost": round(net_cost_usd, 2),
+        "slippageCurve": slippage_curve, # [[quantityUSD, slippageUSD], ...]
+        "makerTaker": f"Taker: {maker_taker_info['taker_pct']:.0f}%, Maker: {maker_taker_info['maker_pct']:.0f}%",
+        "limitOrder": limit_estimate, # Queue position and fill estimates of the simulated limit order
+        "calibration": { # Market impact inputs actually used, and where they came from
+            "volatilityPct": round(volatility_pct, 4), "volatilitySource": calibration_sources["volatility"],
+            "adv": round(adv_asset, 4), "advSource": calibration_sources["adv"],
+        },
+        "internalLatency": round(processing_latency_ms, 2),
+        "lastUpdate": iso_timestamp,
+        "asks": order_book.top_asks(5), # Send top 5 levels to UI
+        "bids": order_book.top_bids(5)
+    }
+
+async def process_feed_message(message_raw, default_symbol, websocket, recv_ts_ns=None):
+    """Parses one raw feed message and applies it to its symbol's book.
+
+    The updated book is handed to the compute stage when one is running; otherwise
+    the models are evaluated and the tick broadcast inline, for every message.
+
+    `recv_ts_ns` is the wall-clock receive time (defaults to now; replays pass the
+    recorded one). Returns False when the connection must be re-established
+    (critical error or an out-of-sync book that cannot be resubscribed), True otherwise.
+    """
+    tick_processing_start_time = time.perf_counter()
+    if recv_ts_ns is None:
+        recv_ts_ns = time.time_ns()
+    message_data = trade_codec.loads(message_raw)
+    pipeline_metrics.observe('parse', time.perf_counter() - tick_processing_start_time)
+    # logging.debug(f"Raw from OKX: {message_data}")
+
+    # Handle OKX Ping/Pong (OKX v5 API sends "ping" as a string)
+    if isinstance(message_data, str) and message_data == "ping":
+        if websocket is not None: # No socket to answer when replaying a recording
+            await websocket.send("pong")
+            logging.debug("Sent PONG to OKX (string format)")
+        return True
+    if not isinstance(message_data, dict):
+        logging.debug(f"OKX: Ignoring non-object message: {message_raw[:200]}")
+        return True
+    # Handle other exchanges' op:ping format if necessary
+    if message_data.get("op") == "ping":
+        if websocket is not None:
+            await websocket.send(json.dumps({"op": "pong"}))
+            logging.debug("Sent PONG to OKX (op format)")
+        return True
+
+    # Handle subscription responses and errors
+    if "event" in message_data:
+        if message_data["event"] == "subscribe":
+            logging.info(f"OKX: Successfully subscribed: {message_data.get('arg')}")
+            return True
+        if message_data["event"] == "error":
+            logging.error(f"OKX WS Error: Code {message_data.get('code')}, Msg: {message_data.get('msg')}")
+            # If critical error (e.g., auth, invalid args), reconnect
+            if message_data.get('code') in ['60008', '60013', '60014']:
+                logging.error("OKX: Critical subscription/auth error. Breaking connection loop.")
+                return False
+        return True
+
+    symbol, action, data_payload = parse_book_message(message_data, default_symbol)
+    if not data_payload:
+        logging.debug(f"OKX: No usable data_payload in message: {message_raw[:200]}")
+        return True
+
+    # Apply the snapshot/delta to the symbol's incremental order book
+    order_book = get_order_book(symbol)
+    if data_payload.get('ts'):
+        try:
+            pipeline_metrics.observe('exchange_to_recv', recv_ts_ns / 1e9 - int(data_payload['ts']) / 1000)
+        except (ValueError, TypeError):
+            pass
+    if action == "update" and symbol in resync_pending:
+        # Updates already in flight when we resubscribed; the coming snapshot replaces them
+        if time.monotonic() - resync_pending[symbol] < RESYNC_SNAPSHOT_TIMEOUT_S:
+            return True
+        logging.warning(f"OKX: No snapshot for {symbol} within {RESYNC_SNAPSHOT_TIMEOUT_S}s of resubscribing. Reconnecting...")
+        del resync_pending[symbol]
+        return False
+    if action == "snapshot" or action == "update":
+        try:
+            with StageTimer(pipeline_metrics, 'book_update'):
+                order_book.apply_message(action, data_payload)
+        except OrderBookOutOfSync as e:
+            logging.warning(f"OKX: Order book for {symbol} out of sync ({e}). Resyncing...")
+            order_book.reset()
+            if "arg" in message_data and websocket is not None:
+                # Resubscribing makes OKX push a fresh snapshot on the same connection
+                await websocket.send(json.dumps({"op": "unsubscribe", "args": [message_data["arg"]]}))
+                await websocket.send(json.dumps({"op": "subscribe", "args": [message_data["arg"]]}))
+                resync_pending[symbol] = time.monotonic()
+                return True
+            return False # No subscription to renew; reconnect to get a snapshot
+        if action == "snapshot":
+            resync_pending.pop(symbol, None)
+    else:
+        logging.warning(f"OKX: Unknown action '{action}' or no relevant data fields: {message_raw[:200]}")
+        return True
+
+    # --- Core Processing Logic after order book update ---
+    # Simulated orders must be placed on the live book, whichever compute mode runs the models
+    sync_ui_limit_order(order_book, simulation_params)
+    update_tick_store(order_book)
+    if compute_stage is not None:
+        # Staged pipeline: ingestion ends here, the compute stage picks up the latest book
+        compute_stage.submit(order_book, tick_processing_start_time)
+        pipeline_metrics.observe('ingest', time.perf_counter() - tick_processing_start_time)
+        return True
+    output_for_ui = compute_tick_output(order_book, simulation_params, tick_processing_start_time)
+    if output_for_ui is not None:
+        publish_tick(output_for_ui, symbol)
+    pipeline_metrics.observe('tick_total', time.perf_counter() - tick_processing_start_time)
+    return True
+
+def publish_tick(output_for_ui, symbol):
+    """Sends a computed tick to the UI and, in backtests, appends it to the backtest output."""
+    if backtest_output is not None:
+        # Wall-clock latency is left out so repeated backtests produce identical files
+        backtest_output.write(trade_codec.dumps({k: v for k, v in output_for_ui.items() if k != "internalLatency"}) + "\n")
+    broadcast_to_ui(output_for_ui, symbol)
+
+async def run_replay(path, speed=1.0):
+    """Drives the normal processing pipeline from a recording instead of the live feeds.
+
+    speed > 0 replays at (scaled) wall-clock pace; speed <= 0 runs as fast as possible.
+    """
+    pace = f"{speed}x speed" if speed and speed > 0 else "maximum speed"
+    logging.info(f"Replaying {path} at {pace}...")
+    replay_start = time.perf_counter()
+    message_count = 0
+    async for recv_ts_ns, symbol, message_raw in replay_feed(path, speed=speed):
+        message_count += 1
+        try:
+            await process_feed_message(message_raw, symbol, None, recv_ts_ns)
+        except trade_codec.JSONDecodeError:
+            logging.warning(f"Replay: Failed to decode JSON from message: {message_raw[:200]}")
+        except Exception as e:
+            logging.error(f"Replay: Error processing message for {symbol}: {e}", exc_info=True)
+    elapsed = time.perf_counter() - replay_start
+    rate = message_count / elapsed if elapsed > 0 else 0.0
+    logging.info(f"Replay of {path} finished: {message_count} messages in {elapsed:.2f}s ({rate:,.0f} msg/s)")
+    for stage, stage_summary in pipeline_metrics.summary()["stages"].items():
+        logging.info(f"Replay latency {stage} (us): {stage_summary}")
+
+async def okx_market_data_listener(symbol, uri, start_delay=0.0):
+    """Connects to one instrument's L2 order book stream, processes data, and broadcasts to UI."""
+    if start_delay:
+        await asyncio.sleep(start_delay) # Stagger connects so many feeds don't reconnect in one burst
+
+    resync_count = 0 # Consecutive resync reconnects, for the backoff
     while True: # Outer loop for retrying connection
-        logging.info(f"Attempting to connect to OKX L2 feed: {uri}")
+        resync_requested = False
+        connected_at = time.monotonic()
+        logging.info(f"Attempting to connect to OKX L2 feed for {symbol}: {uri}")
         try:
             # ping_interval and ping_timeout help maintain the connection
             async with websockets.connect(uri, ping_interval=20, ping_timeout=20) as websocket:
-                logging.info(f"Successfully connected to OKX L2 feed: {uri}")
+                logging.info(f"Successfully connected to OKX L2 feed for {symbol}: {uri}")
 
                 # OPTIONAL: Send subscription message if the URL doesn't auto-subscribe.
                 # Verify the correct channel name and instId with OKX documentation.
                 # Example: 'books5' for 5 levels of depth.
                 # subscribe_msg = {
                 #     "op": "subscribe",
-                #     "args": [{"channel": "books5", "instId": simulation_params['spot_asset']}]
+                #     "args": [{"channel": "books5", "instId": symbol}]
                 # }
                 # await websocket.send(json.dumps(subscribe_msg))
                 # logging.info(f"Sent subscription request to OKX: {subscribe_msg}")
 
                 async for message_raw in websocket:
-                    tick_processing_start_time = time.perf_counter()
+                    recv_ts_ns = time.time_ns()
+                    if feed_recorder is not None:
+                        feed_recorder.record(symbol, message_raw, recv_ts_ns)
                     try:
-                        message_data = json.loads(message_raw)
-                        # logging.debug(f"Raw from OKX: {message_data}")
-
-                        # Handle OKX Ping/Pong (OKX v5 API sends "ping" as a string)
-                        if isinstance(message_data, str) and message_data == "ping":
-                            await websocket.send("pong")
-                            logging.debug("Sent PONG to OKX (string format)")
-                            continue
-                        # Handle other exchanges' op:ping format if necessary
-                        if isinstance(message_data, dict) and message_data.get("op") == "ping":
-                             await websocket.send(json.dumps({"op": "pong"}))
-                             logging.debug("Sent PONG to OKX (op format)")
-                             continue
-
-                        # Handle subscription responses and errors
-                        if isinstance(message_data, dict) and "event" in message_data:
-                            if message_data["event"] == "subscribe":
-                                logging.info(f"OKX: Successfully subscribed: {message_data.get('arg')}")
-                                continue
-                            if message_data["event"] == "error":
-                                logging.error(f"OKX WS Error: Code {message_data.get('code')}, Msg: {message_data.get('msg')}")
-                                # If critical error (e.g., auth, invalid args), break inner loop to force reconnect
-                                if message_data.get('code') in ['60008', '60013', '60014']:
-                                    logging.error("OKX: Critical subscription/auth error. Breaking connection loop.")
-                                    break
-                                continue
-
-                        data_payload = None
-                        action = None
-                        # Adapt to common OKX L2 structure or the simpler prompt structure
-                        if "data" in message_data and isinstance(message_data["data"], list) and message_data["data"]:
-                            data_payload = message_data["data"][0] # Data is usually an array with one object
-                            action = message_data.get("action", "update") # Default to "update" if action not present
-                        elif "asks" in message_data and "bids" in message_data : # Fallback to simpler format from prompt
-                             data_payload = message_data
-                             action = "snapshot" # Treat as a full snapshot
-
-                        if not data_payload:
-                            logging.debug(f"OKX: No usable data_payload in message: {message_raw[:200]}")
-                            continue
-
-                        # Update order book (simplified: treat updates as snapshots)
-                        if action == "snapshot" or action == "update":
-                            current_order_book['asks'] = data_payload.get('asks', [])
-                            current_order_book['bids'] = data_payload.get('bids', [])
-                            current_order_book['okx_ts'] = data_payload.get('ts', current_order_book['okx_ts']) # OKX uses 'ts' (milliseconds string)
-                            current_order_book['symbol'] = simulation_params['spot_asset'] # Assuming one symbol for now
-                            if not current_order_book['asks'] and not current_order_book['bids']:
-                                logging.debug("OKX: Received empty asks/bids in snapshot/update.")
-                                continue # No data to process
-                        else:
-                            logging.warning(f"OKX: Unknown action '{action}' or no relevant data fields: {message_raw[:200]}")
-                            continue
-
-                        # --- Core Processing Logic after order book update ---
-                        if not current_order_book['bids'] or not current_order_book['asks']:
-                            logging.debug("Order book is empty or incomplete after update, skipping calculations.")
-                            continue
-
-                        try:
-                            best_bid_price = float(current_order_book['bids'][0][0])
-                            best_ask_price = float(current_order_book['asks'][0][0])
-                        except (IndexError, ValueError, TypeError) as e:
-                            logging.warning(f"Could not extract best bid/ask from order book: {e}. Book state: Asks: {current_order_book['asks'][:1]}, Bids: {current_order_book['bids'][:1]}")
-                            continue # Skip this tick if book is malformed
-
-                        mid_price = (best_bid_price + best_ask_price) / 2.0
-                        if mid_price == 0:
-                            logging.warning("Mid price is zero, skipping calculations.")
-                            continue
-
-                        asset_quantity = simulation_params['quantity_usd'] / mid_price
-
-                        # Call model functions
-                        slippage_usd = calculate_expected_slippage(current_order_book, asset_quantity, mid_price, simulation_params)
-                        fees_usd = calculate_expected_fees(simulation_params['quantity_usd'], simulation_params)
-                        impact_usd = calculate_market_impact(current_order_book, asset_quantity, simulation_params['quantity_usd'], mid_price, simulation_params)
-                        net_cost_usd = slippage_usd + fees_usd + impact_usd
-                        maker_taker_info = get_maker_taker_proportion(simulation_params)
-
-                        tick_processing_end_time = time.perf_counter()
-                        processing_latency_ms = (tick_processing_end_time - tick_processing_start_time) * 1000
-
-                        # Prepare data for UI
-                        iso_timestamp = "N/A"
-                        if current_order_book.get('okx_ts'):
-                            try:
-                                ts_int = int(current_order_book['okx_ts'])
-                                # Convert milliseconds to seconds for utcfromtimestamp
-                                iso_timestamp = datetime.utcfromtimestamp(ts_int / 1000).isoformat() + 'Z'
-                            except (ValueError, TypeError):
-                                logging.warning(f"Could not parse OKX timestamp: {current_order_book['okx_ts']}")
-
-                        output_for_ui = {
-                            "bestBid": best_bid_price, "bestAsk": best_ask_price,
-                            "midPrice": round(mid_price, 2),
-                            "expectedSlippage": round(slippage_usd, 2),
-                            "expectedFees": round(fees_usd, 2),
-                            "marketImpact": round(impact_usd, 2),
-                            "netCost": round(net_cost_usd, 2),
-                            "makerTaker": f"Taker: {maker_taker_info['taker_pct']:.0f}%, Maker: {maker_taker_info['maker_pct']:.0f}%",
-                            "internalLatency": round(processing_latency_ms, 2),
-                            "lastUpdate": iso_timestamp,
-                            "asks": current_order_book['asks'][:5], # Send top 5 levels to UI
-                            "bids": current_order_book['bids'][:5]
-                        }
-                        await broadcast_to_ui(output_for_ui)
-
-                    except json.JSONDecodeError:
+                        if not await process_feed_message(message_raw, symbol, websocket, recv_ts_ns):
+                            resync_requested = True
+                            break
+                    except trade_codec.JSONDecodeError:
                         logging.warning(f"OKX: Failed to decode JSON from message: {message_raw[:200]}")
                     except Exception as e: # Catch-all for the inner message processing loop
-                        logging.error(f"OKX: Error processing message: {e}", exc_info=True)
+                        logging.error(f"OKX: Error processing message for {symbol}: {e}", exc_info=True)
 
         except websockets.exceptions.ConnectionClosedError as e:
-            logging.error(f"OKX: ConnectionClosedError: {e}. Server may have forcefully closed. Retrying...")
+            logging.error(f"OKX: ConnectionClosedError for {symbol}: {e}. Server may have forcefully closed. Retrying...")
         except websockets.exceptions.ConnectionClosed as e:
-            logging.warning(f"OKX: WebSocket connection closed: {e}. Code: {e.code}. Reason: {e.reason}. Retrying...")
+            logging.warning(f"OKX: WebSocket connection for {symbol} closed: {e}. Code: {e.code}. Reason: {e.reason}. Retrying...")
         except ConnectionRefusedError:
-            logging.error("OKX: Connection refused. Check network/VPN and endpoint URL. Retrying...")
+            logging.error(f"OKX: Connection refused for {symbol}. Check network/VPN and endpoint URL. Retrying...")
         except asyncio.TimeoutError: # Catch specific timeout errors if connect takes too long
-            logging.error("OKX: Connection attempt timed out. Retrying...")
+            logging.error(f"OKX: Connection attempt for {symbol} timed out. Retrying...")
         except Exception as e: # Catch-all for the connection loop
-            logging.error(f"OKX: Unexpected error in WebSocket connection loop: {e}", exc_info=True)
+            logging.error(f"OKX: Unexpected error in WebSocket connection loop for {symbol}: {e}", exc_info=True)
 
-        logging.info("Waiting 10 seconds before retrying OKX connection...")
+        get_order_book(symbol).reset() # A new connection always starts from a fresh snapshot
+        resync_pending.pop(symbol, None)
+        if resync_requested:
+            if time.monotonic() - connected_at >= RESYNC_BACKOFF_RESET_S:
+                resync_count = 0
+            delay = min(RESYNC_BACKOFF_MAX_S, RESYNC_BACKOFF_INITIAL_S * 2 ** (resync_count - 1)) if resync_count else 0.0
+            resync_count += 1
+            logging.info(f"Reconnecting to OKX in {delay:.1f}s to resync the {symbol} order book "
+                         f"(resync {resync_count} in a row)...")
+            await asyncio.sleep(delay)
+            continue
+        logging.info(f"Waiting 10 seconds before retrying OKX connection for {symbol}...")
         await asyncio.sleep(10) # Wait before retrying connection
 
-async def main_backend_loop():
-    """Main function to start the backend services."""
+class FeedManager:
+    """Runs one L2 connection (and one order book) per instrument on the shared event loop.
+
+    Each feed is its own task, so a reconnecting or bursty symbol never blocks
+    message handling for the others.
+    """
+
+    def __init__(self, feeds):
+        self.feeds = dict(feeds) # symbol -> websocket endpoint
+        self.tasks = {}
+
+    def start(self):
+        for i, (symbol, uri) in enumerate(self.feeds.items()):
+            self.add_instrument(symbol, uri, start_delay=i * FEED_CONNECT_STAGGER_S)
+        logging.info(f"FeedManager started {len(self.tasks)} L2 feeds: {', '.join(self.tasks)}")
+
+    def add_instrument(self, symbol, uri=None, start_delay=0.0):
+        """Starts streaming `symbol` (no-op if already running)."""
+        if symbol in self.tasks and not self.tasks[symbol].done():
+            return
+        uri = uri or self.feeds.get(symbol) or OKX_L2_ENDPOINT_TEMPLATE.format(symbol=symbol)
+        self.feeds[symbol] = uri
+        get_order_book(symbol)
+        self.tasks[symbol] = asyncio.create_task(
+            okx_market_data_listener(symbol, uri, start_delay), name=f"feed-{symbol}"
+        )
+
+    async def remove_instrument(self, symbol):
+        """Stops streaming `symbol` and drops its book."""
+        task = self.tasks.pop(symbol, None)
+        self.feeds.pop(symbol, None)
+        order_books.pop(symbol, None)
+        ui_limit_orders.pop(symbol, None)
+        resync_pending.pop(symbol, None)
+        model_cache.invalidate(symbol)
+        store = tick_stores.pop(symbol, None)
+        if store is not None:
+            store.close()
+        if task and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def wait(self):
+        """Waits until every feed task has finished (they normally run forever)."""
+        await asyncio.gather(*self.tasks.values())
+
+    async def stop(self):
+        for symbol in list(self.tasks):
+            await self.remove_instrument(symbol)
+        logging.info("FeedManager stopped all L2 feeds.")
+
+async def main_backend_loop(record_path=None, replay_path=None, replay_speed=1.0, backtest_output_path=None,
+                            compute_mode=COMPUTE_MODE, compute_rate_hz=COMPUTE_MAX_RATE_HZ,
+                            tick_store_path=TICK_STORE_DIR):
+    """Main function to start the backend services.
+
+    With `replay_path` the recorded feed replaces the live OKX feeds; a replay
+    speed <= 0 is a headless backtest (no UI server, runs as fast as possible).
+    """
+    global feed_recorder, backtest_output, scenario_pool, compute_stage, tick_store_dir
+    tick_store_dir = tick_store_path
+    if backtest_output_path:
+        backtest_output = open(backtest_output_path, 'w')
+    if replay_path and (not replay_speed or replay_speed <= 0):
+        try:
+            await run_replay(replay_path, speed=0)
+        finally:
+            if backtest_output is not None:
+                backtest_output.close()
+                backtest_output = None
+            close_tick_stores()
+        return
+
     # Start the WebSocket server for UI clients
     server = await websockets.serve(ui_communication_handler, UI_WEBSOCKET_HOST, UI_WEBSOCKET_PORT)
     logging.info(f"UI WebSocket server started on ws://{UI_WEBSOCKET_HOST}:{UI_WEBSOCKET_PORT}")
 
-    # Start the listener for OKX market data
-    okx_task = asyncio.create_task(okx_market_data_listener())
+    if not backtest_output_path: # Backtest files get a tick for every message
+        compute_stage = ComputeStage(compute_tick_output, publish_tick, simulation_params, mode=compute_mode,
+                                     max_rate_hz=compute_rate_hz, metrics=pipeline_metrics)
+        compute_stage.start()
 
+    # Start one OKX market data listener per configured instrument, or the replay
+    feed_manager = FeedManager(INSTRUMENT_FEEDS)
+    if replay_path:
+        source_task = asyncio.create_task(run_replay(replay_path, speed=replay_speed))
+    else:
+        if record_path:
+            feed_recorder = FeedRecorder(record_path)
+        feed_manager.start()
+        source_task = asyncio.create_task(feed_manager.wait())
+    stats_task = asyncio.create_task(log_broadcast_stats())
+    tick_store_flush_task = asyncio.create_task(flush_tick_stores())
+    metrics_summary_task = asyncio.create_task(publish_metrics_summary())
     try:
-        # Keep the tasks running. If okx_task finishes or errors,
-        # this gather will complete/raise. The server runs indefinitely until closed.
-        await asyncio.gather(okx_task)
+        metrics_server = await serve_metrics_http(pipeline_metrics, METRICS_HTTP_HOST, METRICS_HTTP_PORT)
+    except OSError as e:
+        metrics_server = None
+        logging.error(f"Could not start metrics endpoint on {METRICS_HTTP_HOST}:{METRICS_HTTP_PORT}: {e}")
+
+    try:
+        # Keep the tasks running. If the feeds finish or error,
+        # this wait will complete/raise. The server runs indefinitely until closed.
+        await source_task
     except KeyboardInterrupt:
         logging.info("Backend shutting down by user interrupt (main_backend_loop)...")
     except Exception as e:
         logging.critical(f"Critical error in main_backend_loop gather: {e}", exc_info=True)
     finally:
         logging.info("Main backend loop ending. Cleaning up...")
-        if okx_task and not okx_task.done():
-            logging.info("Cancelling OKX listener task...")
-            okx_task.cancel()
-            try:
-                await okx_task # Allow task to process cancellation
-            except asyncio.CancelledError:
-                logging.info("OKX listener task successfully cancelled.")
-            except Exception as e_cancel: # Catch any error during cancellation
-                logging.error(f"Error during OKX task cancellation: {e_cancel}", exc_info=True)
+        stats_task.cancel()
+        tick_store_flush_task.cancel()
+        metrics_summary_task.cancel()
+        if metrics_server:
+            metrics_server.close()
+        if scenario_pool is not None:
+            scenario_pool.shutdown(wait=False, cancel_futures=True)
+            scenario_pool = None
+        logging.info("Cancelling OKX listener tasks...")
+        try:
+            await feed_manager.stop() # Allow tasks to process cancellation
+        except Exception as e_cancel: # Catch any error during cancellation
+            logging.error(f"Error during OKX task cancellation: {e_cancel}", exc_info=True)
+        if not source_task.done():
+            source_task.cancel()
+        if compute_stage is not None:
+            await compute_stage.stop()
+            compute_stage = None
+        if feed_recorder is not None:
+            feed_recorder.close()
+            feed_recorder = None
+        if backtest_output is not None:
+            backtest_output.close()
+            backtest_output = None
+        close_tick_stores()
 
         if server: # Close the UI server
             server.close()
@@ -348,8 +1040,111 @@ async def main_backend_loop():
             logging.info("UI WebSocket server closed.")
         logging.info("Backend shutdown sequence complete.")
 
+async def forward_shard_ticks():
+    """Sharded mode: pushes parameter changes to the workers and forwards their ticks to the UI clients."""
+    while True:
+        shard_front.push_params(simulation_params)
+        for symbol, message in shard_front.poll():
+            ui_broadcaster.publish_message(message, symbol, symbol)
+        shard_front.supervise()
+        await asyncio.sleep(SHARD_POLL_INTERVAL_S)
+
+async def main_sharded_loop(shard_count, compute_rate_hz=COMPUTE_MAX_RATE_HZ, tick_store_path=TICK_STORE_DIR):
+    """Serves the UI from shard worker processes that each stream and model a subset of the instruments."""
+    global shard_front, scenario_pool
+    shard_front = ShardFront(INSTRUMENT_FEEDS, shard_count, compute_rate_hz=compute_rate_hz,
+                             tick_store_dir=tick_store_path)
+    pipeline_metrics.register_gauge('shard_workers_alive', shard_front.alive_count)
+    pipeline_metrics.add_source(shard_front.worker_metrics) # Per-stage latency of the workers' pipelines
+    server = None
+    tasks = []
+    metrics_server = None
+    try:
+        shard_front.start(simulation_params)
+        server = await websockets.serve(ui_communication_handler, UI_WEBSOCKET_HOST, UI_WEBSOCKET_PORT)
+        logging.info(f"UI WebSocket server started on ws://{UI_WEBSOCKET_HOST}:{UI_WEBSOCKET_PORT}")
+        forward_task = asyncio.create_task(forward_shard_ticks())
+        tasks = [forward_task, asyncio.create_task(log_broadcast_stats()),
+                 asyncio.create_task(publish_metrics_summary())]
+        try:
+            metrics_server = await serve_metrics_http(pipeline_metrics, METRICS_HTTP_HOST, METRICS_HTTP_PORT)
+        except OSError as e:
+            logging.error(f"Could not start metrics endpoint on {METRICS_HTTP_HOST}:{METRICS_HTTP_PORT}: {e}")
+        await forward_task
+    except Exception as e:
+        logging.critical(f"Critical error in main_sharded_loop: {e}", exc_info=True)
+    finally:
+        logging.info("Sharded backend ending. Stopping shard workers...")
+        for task in tasks:
+            task.cancel()
+        if metrics_server:
+            metrics_server.close()
+        if scenario_pool is not None:
+            scenario_pool.shutdown(wait=False, cancel_futures=True)
+            scenario_pool = None
+        pipeline_metrics.sources.remove(shard_front.worker_metrics)
+        await asyncio.to_thread(shard_front.stop) # Joins the workers without blocking the event loop
+        logging.info(f"Shard workers stopped: {shard_front.stats()}")
+        shard_front = None
+        if server:
+            server.close()
+            await server.wait_closed()
+            logging.info("UI WebSocket server closed.")
+        logging.info("Backend shutdown sequence complete.")
+
+def close_tick_stores():
+    """Flushes and drops every tick store (the next use reopens and warms up from disk)."""
+    for store in tick_stores.values():
+        try:
+            store.close()
+        except OSError as e:
+            logging.error(f"Could not close tick store for {store.symbol}: {e}")
+    tick_stores.clear()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Trade Simulator Backend")
+    parser.add_argument('--instruments', help="Comma-separated instrument ids to stream (default: %(default)s)",
+                        default=','.join(INSTRUMENTS))
+    parser.add_argument('--record', metavar='PATH', help="Record raw L2 feed messages to PATH")
+    parser.add_argument('--replay', metavar='PATH', help="Replay a recording instead of connecting to OKX")
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help="Replay speed multiplier; 0 = as fast as possible, headless (default: %(default)s)")
+    parser.add_argument('--backtest-output', metavar='PATH', help="Write every computed tick to PATH as JSON lines")
+    parser.add_argument('--compute-mode', choices=COMPUTE_MODES, default=COMPUTE_MODE,
+                        help="Where the cost models run, decoupled from feed ingestion (default: %(default)s)")
+    parser.add_argument('--compute-rate', type=float, default=COMPUTE_MAX_RATE_HZ, metavar='HZ',
+                        help="Max model evaluation passes per second; 0 = unlimited (default: %(default)s)")
+    parser.add_argument('--tick-store', metavar='DIR', default=TICK_STORE_DIR,
+                        help="Persist the rolling mid/volume history under DIR and warm the live "
+                             "volatility/ADV estimators up from it on restart")
+    parser.add_argument('--shards', type=int, default=SHARD_COUNT, metavar='N',
+                        help="Split the instruments across N worker processes that publish books and ticks "
+                             "through shared memory; 0 = single process (default: %(default)s)")
+    # parse_known_args: Jupyter/IPython pass their own arguments
+    return parser.parse_known_args()[0]
+
 if __name__ == "__main__":
     logging.info("Starting Trade Simulator Backend (Port 8000 v2.2)...")
+    logging.info(f"JSON codec backend: {trade_codec.BACKEND}")
+    cli_args = parse_args()
+    INSTRUMENT_FEEDS = {
+        symbol: INSTRUMENT_FEEDS.get(symbol) or OKX_L2_ENDPOINT_TEMPLATE.format(symbol=symbol)
+        for symbol in cli_args.instruments.split(',') if symbol
+    }
+    main_kwargs = dict(
+        record_path=cli_args.record, replay_path=cli_args.replay,
+        replay_speed=cli_args.replay_speed, backtest_output_path=cli_args.backtest_output,
+        compute_mode=cli_args.compute_mode, compute_rate_hz=cli_args.compute_rate,
+        tick_store_path=cli_args.tick_store,
+    )
+    main_coroutine = main_backend_loop
+    if cli_args.shards > 0:
+        if cli_args.record or cli_args.replay or cli_args.backtest_output:
+            raise SystemExit("--shards streams live feeds only; it can't be combined with --record, "
+                             "--replay or --backtest-output")
+        main_coroutine = main_sharded_loop
+        main_kwargs = dict(shard_count=cli_args.shards, compute_rate_hz=cli_args.compute_rate,
+                           tick_store_path=cli_args.tick_store)
     try:
         # Get the current event loop.
         # In some environments (like Jupyter/IPython), a loop might already be running.
@@ -361,12 +1156,12 @@ if __name__ == "__main__":
         if loop and loop.is_running():
             logging.info("Asyncio event loop is already running. Scheduling main_backend_loop as a task.")
             # If a loop is already running (e.g., in Jupyter), create a task for the main coroutine.
-            task = loop.create_task(main_backend_loop())
+            task = loop.create_task(main_coroutine(**main_kwargs))
             # In a Jupyter notebook, this task will run in the background.
             # To wait for it in a cell, you might need `await task` if the cell is async.
         else:
             logging.info("No running asyncio event loop found or loop is None. Starting new one with asyncio.run().")
-            asyncio.run(main_backend_loop())
+            asyncio.run(main_coroutine(**main_kwargs))
 
     except KeyboardInterrupt:
         logging.info("Backend process interrupted by user at startup (KeyboardInterrupt).")
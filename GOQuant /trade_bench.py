@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+"""Trade Simulator Benchmark Suite
+
+Runs entirely offline: synthetic L2 messages are generated up front and fed
+either straight into the processing pipeline or through a local stand-in
+websocket server, so results are reproducible and need no VPN/OKX access.
+
+Usage:
+    python trade_bench.py                          # full suite, writes bench_results.json
+    python trade_bench.py --quick --output b.json  # smaller sizes
+    python trade_bench.py --compare baseline.json  # exit 1 on regressions
+
+Benchmarks:
+    cost_models   per-call time of each model function
+    tick_pipeline messages/sec, per-tick latency and allocations through process_feed_message
+    ws_ingest     end-to-end messages/sec from a local websocket server through FeedManager
+    ui_fanout     UI broadcast throughput with 1/100/1000 connected websocket clients
+    limit_orders  book updates/sec with thousands of simulated resting limit orders (filled ones are re-placed)
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import websockets
+
+import trade_backend as backend
+from trade_metrics import LatencyHistogram
+from trade_order_book import okx_checksum
+
+BENCH_SYMBOL = 'BENCH-USDT-SWAP'
+# Results where bigger is better; every other numeric result is treated as lower-is-better
+HIGHER_IS_BETTER = ('messages_per_sec', 'calls_per_sec', 'delivered_per_sec', 'published_per_sec')
+DEFAULT_REGRESSION_THRESHOLD = 0.10
+
+
+# --- Synthetic L2 Data ---
+class SyntheticL2Generator:
+    """Deterministic OKX 'books'-style message stream: one snapshot, then incremental updates."""
+
+    def __init__(self, symbol=BENCH_SYMBOL, depth=400, mid=60000.0, tick=0.1,
+                 changes_per_update=20, with_checksum=False, seed=7):
+        self.symbol = symbol
+        self.depth = depth
+        self.mid = mid
+        self.tick = tick
+        self.changes_per_update = changes_per_update
+        self.with_checksum = with_checksum
+        self.rng = random.Random(seed)
+        self.seq_id = 1000
+        self.base_ts_ms = int(time.time() * 1000)
+        self.asks = {}
+        self.bids = {}
+        for i in range(depth):
+            self.asks[round(mid + tick * (i + 1), 1)] = self._random_qty()
+            self.bids[round(mid - tick * (i + 1), 1)] = self._random_qty()
+
+    def _random_qty(self):
+        return round(self.rng.uniform(0.001, 5.0), 4)
+
+    def _message(self, action, asks, bids, prev_seq_id):
+        self.seq_id += 1
+        payload = {
+            "asks": [[f"{p}", f"{q}", "0", "1"] for p, q in asks],
+            "bids": [[f"{p}", f"{q}", "0", "1"] for p, q in bids],
+            "ts": str(self.base_ts_ms),
+            "seqId": self.seq_id,
+            "prevSeqId": prev_seq_id,
+        }
+        if self.with_checksum:
+            top_bids = sorted(self.bids.items(), reverse=True)[:25]
+            top_asks = sorted(self.asks.items())[:25]
+            payload["checksum"] = okx_checksum(top_bids, top_asks)
+        return json.dumps({"arg": {"channel": "books", "instId": self.symbol}, "action": action, "data": [payload]})
+
+    def snapshot_message(self):
+        return self._message("snapshot", sorted(self.asks.items()), sorted(self.bids.items(), reverse=True), -1)
+
+    def update_message(self):
+        """Changes/deletes/inserts a few levels near the top of each side."""
+        changes = {"asks": [], "bids": []}
+        for side_name, side, sign in (("asks", self.asks, 1), ("bids", self.bids, -1)):
+            best = min(side) if sign > 0 else max(side)
+            for _ in range(self.changes_per_update // 2):
+                price = round(best + sign * self.tick * self.rng.randrange(0, 50), 1)
+                if price in side and self.rng.random() < 0.2 and len(side) > 10:
+                    del side[price]
+                    changes[side_name].append((price, 0))
+                else:
+                    side[price] = self._random_qty()
+                    changes[side_name].append((price, side[price]))
+        return self._message("update", changes["asks"], changes["bids"], self.seq_id)
+
+    def messages(self, count):
+        return [self.snapshot_message()] + [self.update_message() for _ in range(count - 1)]
+
+
+def reset_backend_state():
+    backend.order_books.clear()
+    backend.ui_limit_orders.clear()
+    backend.resync_pending.clear()
+    backend.tick_stores.clear()
+    backend.pipeline_metrics.reset()
+    backend.model_cache.invalidate()
+
+
+# --- Benchmarks ---
+def bench_cost_models(iterations):
+    """Per-call time of each cost model against a deep synthetic book."""
+    reset_backend_state()
+    generator = SyntheticL2Generator(depth=400)
+    book = backend.get_order_book(generator.symbol)
+    book.apply_message("snapshot", json.loads(generator.snapshot_message())["data"][0])
+    params = dict(backend.simulation_params)
+    mid = (book.best_bid()[0] + book.best_ask()[0]) / 2.0
+    asset_quantity = params['quantity_usd'] / mid
+    heuristic_params = dict(params, slippage_model='heuristic')
+    # 20 sizes x 10 vols x 4 fee tiers x 5 ADVs = 4,000 cells (evaluated inline, below the pool threshold)
+    grid = backend.parse_scenario_grid({
+        'quantityUSD': np.linspace(1e3, 1e6, 20).tolist(),
+        'volatility': np.linspace(20.0, 120.0, 10).tolist(),
+        'feeTiers': [{'maker': 0.0008, 'taker': taker} for taker in (0.001, 0.0008, 0.0006, 0.0005)],
+        'adv': np.linspace(1e4, 1e5, 5).tolist(),
+    }, params, book)
+    cases = {
+        "slippage_walk_book": lambda: backend.calculate_expected_slippage(book, asset_quantity, mid, params),
+        "slippage_heuristic": lambda: backend.calculate_expected_slippage(book, asset_quantity, mid, heuristic_params),
+        "slippage_curve": lambda: backend.calculate_slippage_curve(book, mid, params),
+        "market_impact": lambda: backend.calculate_market_impact(book, asset_quantity, params['quantity_usd'], mid, params),
+        "fees": lambda: backend.calculate_expected_fees(params['quantity_usd'], params),
+        "maker_taker": lambda: backend.get_maker_taker_proportion(params),
+        "scenario_grid_4k": lambda: backend.evaluate_scenario_grid(book, grid, params),
+    }
+    results = {}
+    for name, fn in cases.items():
+        fn() # Warm up caches
+        histogram = LatencyHistogram()
+        start = time.perf_counter()
+        for _ in range(iterations):
+            call_start = time.perf_counter()
+            fn()
+            histogram.record_seconds(time.perf_counter() - call_start)
+        elapsed = time.perf_counter() - start
+        results[name] = {"calls_per_sec": round(iterations / elapsed, 1), "latency_us": histogram.summary()}
+    return results
+
+
+def _process_messages(messages):
+    """Feeds pre-generated messages through process_feed_message without any sockets."""
+    async def run():
+        histogram = LatencyHistogram()
+        recv_ts_ns = time.time_ns()
+        start = time.perf_counter()
+        for message in messages:
+            tick_start = time.perf_counter()
+            await backend.process_feed_message(message, BENCH_SYMBOL, None, recv_ts_ns)
+            histogram.record_seconds(time.perf_counter() - tick_start)
+        return time.perf_counter() - start, histogram
+    return asyncio.run(run())
+
+
+def bench_tick_pipeline(message_count, depth):
+    """Throughput, per-tick latency and allocation profile of the full per-message path."""
+    messages = SyntheticL2Generator(depth=depth).messages(message_count)
+
+    reset_backend_state()
+    elapsed, histogram = _process_messages(messages)
+    stages = backend.pipeline_metrics.summary()["stages"]
+
+    # Allocation profile on a separate pass (tracemalloc slows everything down)
+    reset_backend_state()
+    alloc_messages = messages[:min(len(messages), 2000)]
+    gc.collect()
+    gc_before = sum(stat["collections"] for stat in gc.get_stats())
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    _process_messages(alloc_messages)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks_after = sys.getallocatedblocks()
+    gc_after = sum(stat["collections"] for stat in gc.get_stats())
+
+    ticks = len(alloc_messages)
+    return {
+        "messages": message_count,
+        "depth": depth,
+        "messages_per_sec": round(message_count / elapsed, 1),
+        "tick_latency_us": histogram.summary(),
+        "stage_latency_us": stages,
+        "alloc_peak_bytes": peak_bytes,
+        "retained_blocks_per_tick": round((blocks_after - blocks_before) / ticks, 3),
+        "gc_collections_per_1k_ticks": round((gc_after - gc_before) * 1000 / ticks, 3),
+    }
+
+
+def bench_limit_orders(order_count, message_count, depth):
+    """Per-message book update cost with `order_count` simulated limit orders resting near the top.
+
+    Filled orders are replaced (outside the timed updates), so every update runs
+    against the full set of resting orders.
+    """
+    reset_backend_state()
+    generator = SyntheticL2Generator(depth=depth)
+    messages = [json.loads(m)["data"][0] for m in generator.messages(message_count)]
+    book = backend.get_order_book(generator.symbol)
+    book.apply_message("snapshot", messages[0])
+    tracker = book.order_tracker
+    rng = random.Random(11)
+
+    def place_order(i):
+        side = 'buy' if i % 2 else 'sell'
+        offset = generator.tick * rng.randrange(0, 50)
+        price = round(book.best_bid()[0] - offset if side == 'buy' else book.best_ask()[0] + offset, 1)
+        return tracker.place(book, side, price, rng.uniform(0.001, 0.5))
+
+    def resting_count():
+        return sum(len(queue) for queues in tracker.levels.values() for queue in queues.values())
+
+    resting = [place_order(i) for i in range(order_count)]
+    replaced = 0
+    resting_per_update = []
+    histogram = LatencyHistogram()
+    elapsed = 0.0
+    for payload in messages[1:]:
+        resting_per_update.append(resting_count())
+        update_start = time.perf_counter()
+        book.apply_message("update", payload)
+        update_elapsed = time.perf_counter() - update_start
+        histogram.record_seconds(update_elapsed)
+        elapsed += update_elapsed
+        if resting_count() < order_count:
+            for i, order_id in enumerate(resting):
+                if tracker.orders[order_id].is_done():
+                    tracker.cancel(order_id)
+                    resting[i] = place_order(i)
+                    replaced += 1
+    estimate_start = time.perf_counter()
+    order_ids = tracker.estimate_orders(book)[0]
+    estimate_elapsed = time.perf_counter() - estimate_start
+    return {
+        "orders": order_count,
+        "messages_per_sec": round((message_count - 1) / elapsed, 1),
+        "update_latency_us": histogram.summary(),
+        # Orders resting when each timed update ran
+        "resting_orders_min": min(resting_per_update),
+        "resting_orders_avg": round(sum(resting_per_update) / len(resting_per_update), 1),
+        "orders_filled": replaced,
+        "estimate_all_us": round(estimate_elapsed * 1e6, 1),
+        "estimated_orders": len(order_ids),
+    }
+
+
+async def _bench_ws_ingest(messages, port):
+    async def stand_in_server(websocket):
+        for message in messages:
+            await websocket.send(message)
+        await websocket.close()
+
+    reset_backend_state()
+    server = await websockets.serve(stand_in_server, "localhost", port, max_size=None)
+    feed_manager = backend.FeedManager({BENCH_SYMBOL: f"ws://localhost:{port}/{BENCH_SYMBOL}"})
+    tick_total = backend.pipeline_metrics.histogram('tick_total')
+    start = time.perf_counter()
+    feed_manager.start()
+    while tick_total.count < len(messages):
+        await asyncio.sleep(0.01)
+        if time.perf_counter() - start > 600:
+            logging.error("ws_ingest: timed out waiting for messages")
+            break
+    elapsed = time.perf_counter() - start
+    await feed_manager.stop()
+    server.close()
+    await server.wait_closed()
+    return {
+        "messages": tick_total.count,
+        "messages_per_sec": round(tick_total.count / elapsed, 1),
+        "tick_latency_us": tick_total.summary(),
+    }
+
+
+def bench_ws_ingest(message_count, depth, port=8890):
+    """End-to-end ingestion from a local stand-in websocket server through FeedManager."""
+    messages = SyntheticL2Generator(depth=depth).messages(message_count)
+    return asyncio.run(_bench_ws_ingest(messages, port))
+
+
+async def _bench_ui_fanout(client_count, publish_count, port):
+    reset_backend_state()
+    server = await websockets.serve(backend.ui_communication_handler, "localhost", port)
+    received = [0] * client_count
+
+    async def client(i):
+        async with websockets.connect(f"ws://localhost:{port}") as websocket:
+            await websocket.send(json.dumps({"subscribe": "*"}))
+            try:
+                async for _ in websocket:
+                    received[i] += 1
+            except websockets.exceptions.ConnectionClosed:
+                pass
+
+    client_tasks = [asyncio.create_task(client(i)) for i in range(client_count)]
+    while len(backend.ui_broadcaster.channels) < client_count:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.2) # Let the subscribe messages land
+
+    # A realistic tick payload for a deep book
+    generator = SyntheticL2Generator(symbol=BENCH_SYMBOL, depth=400)
+    book = backend.get_order_book(BENCH_SYMBOL)
+    book.apply_message("snapshot", json.loads(generator.snapshot_message())["data"][0])
+    tick = backend.compute_tick_output(book, backend.simulation_params, time.perf_counter())
+
+    start = time.perf_counter()
+    for _ in range(publish_count):
+        backend.broadcast_to_ui(tick, BENCH_SYMBOL)
+        await asyncio.sleep(0) # Give sender tasks a chance, as the feed loop would
+    # Drain: wait until nothing is pending (or give up after 30s)
+    drain_deadline = time.perf_counter() + 30
+    while backend.ui_broadcaster.pending_count() and time.perf_counter() < drain_deadline:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.2)
+    elapsed = time.perf_counter() - start
+    stats = backend.ui_broadcaster.stats()
+    broadcast = backend.pipeline_metrics.histogram('broadcast').summary()
+    serialize = backend.pipeline_metrics.histogram('serialize').summary()
+
+    server.close()
+    for task in client_tasks:
+        task.cancel()
+    await asyncio.gather(*client_tasks, return_exceptions=True)
+    await server.wait_closed()
+    delivered = sum(received)
+    return {
+        "clients": client_count,
+        "published": publish_count,
+        "published_per_sec": round(publish_count / elapsed, 1),
+        "delivered": delivered,
+        "delivered_per_sec": round(delivered / elapsed, 1),
+        "conflated": stats["conflated"],
+        "broadcast_latency_us": broadcast,
+        "serialize_latency_us": serialize,
+    }
+
+
+def bench_ui_fanout(client_counts, publish_count, port=8891):
+    return {
+        f"clients_{count}": asyncio.run(_bench_ui_fanout(count, publish_count, port))
+        for count in client_counts
+    }
+
+
+# --- Results ---
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(_flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def compare_results(current, baseline, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    """Returns [(metric, baseline, current, change)] for metrics that regressed more than `threshold`.
+
+    Only throughput and latency percentiles are compared; counts and sizes are skipped.
+    """
+    regressions = []
+    baseline_flat = _flatten(baseline["results"])
+    for path, value in _flatten(current["results"]).items():
+        metric = path.rsplit('.', 1)[-1]
+        comparable = metric in HIGHER_IS_BETTER or metric in ("p50", "p99", "mean")
+        if not comparable or path not in baseline_flat or not baseline_flat[path]:
+            continue
+        old = baseline_flat[path]
+        change = (value - old) / old
+        worse = -change if metric in HIGHER_IS_BETTER else change
+        if worse > threshold:
+            regressions.append((path, old, value, round(change, 3)))
+    return regressions
+
+
+def run_suite(quick=False, only=None):
+    sizes = dict(
+        model_iterations=2000 if quick else 20000,
+        pipeline_messages=2000 if quick else 20000,
+        ingest_messages=2000 if quick else 20000,
+        fanout_clients=(1, 100) if quick else (1, 100, 1000),
+        fanout_publishes=200 if quick else 1000,
+        limit_orders=1000 if quick else 5000,
+        limit_order_messages=1000 if quick else 5000,
+        depth=400,
+    )
+    suites = {
+        "cost_models": lambda: bench_cost_models(sizes["model_iterations"]),
+        "tick_pipeline": lambda: bench_tick_pipeline(sizes["pipeline_messages"], sizes["depth"]),
+        "ws_ingest": lambda: bench_ws_ingest(sizes["ingest_messages"], sizes["depth"]),
+        "ui_fanout": lambda: bench_ui_fanout(sizes["fanout_clients"], sizes["fanout_publishes"]),
+        "limit_orders": lambda: bench_limit_orders(sizes["limit_orders"], sizes["limit_order_messages"], sizes["depth"]),
+    }
+    results = {}
+    for name, suite in suites.items():
+        if only and name not in only:
+            continue
+        logging.info(f"Running benchmark: {name}...")
+        results[name] = suite()
+        logging.info(f"Benchmark {name}: {json.dumps(results[name])[:400]}")
+    return {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "websockets": websockets.__version__,
+            "platform": platform.platform(),
+            "quick": quick,
+            "sizes": sizes,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trade Simulator benchmark suite")
+    parser.add_argument('--output', default='bench_results.json', help="Where to write results (default: %(default)s)")
+    parser.add_argument('--quick', action='store_true', help="Smaller sizes for a fast smoke run")
+    parser.add_argument('--only', help="Comma-separated subset: cost_models,tick_pipeline,ws_ingest,ui_fanout,limit_orders")
+    parser.add_argument('--compare', metavar='BASELINE', help="Compare against a previous results file")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help="Relative change counted as a regression (default: %(default)s)")
+    args = parser.parse_args()
+
+    # Per-message INFO logs would dominate the measurements
+    logging.getLogger().setLevel(logging.WARNING)
+    only = set(args.only.split(',')) if args.only else None
+    results = run_suite(quick=args.quick, only=only)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Benchmark results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.threshold)
+        for path, old, new, change in regressions:
+            print(f"REGRESSION {path}: {old} -> {new} ({change:+.1%})")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%} against {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""Conflating UI Broadcast Fan-Out for the Trade Simulator Backend
+
+Feed processing hands each outbound message to UIBroadcaster.publish(), which
+serializes it once and drops it into every interested client's outbound slot
+without awaiting any socket. Each client has its own sender task; if a client
+falls behind, newer messages for the same key (e.g. a symbol's tick) replace the
+unsent ones instead of queueing up behind them.
+"""
+
+import asyncio
+import json
+import logging
+import time
+
+import websockets
+
+# A send slower than this marks the client as slow in the stats
+SLOW_SEND_MS = 50.0
+
+
+class UIClientChannel:
+    """Outbound queue for one UI websocket with latest-value conflation per key."""
+
+    def __init__(self, websocket, symbols=None, metrics=None):
+        self.websocket = websocket
+        self.metrics = metrics # Optional PipelineMetrics; records offer-to-sent latency as 'broadcast'
+        self.address = websocket.remote_address
+        self.symbols = symbols # Subscribed symbols; None = everything, '*' entry = everything
+        self.pending = {} # key -> (latest serialized message not yet sent, perf_counter when offered)
+        self.wakeup = asyncio.Event()
+        self.sender_task = None
+        # Stats
+        self.sent = 0
+        self.conflated = 0
+        self.errors = 0
+        self.slow_sends = 0
+        self.last_send_ms = 0.0
+        self.max_send_ms = 0.0
+
+    def wants(self, symbol):
+        """True if this client should receive messages for `symbol` (None = messages for everyone)."""
+        return symbol is None or self.symbols is None or symbol in self.symbols or '*' in self.symbols
+
+    def offer(self, key, message):
+        """Queues `message` under `key`, replacing any unsent message with the same key."""
+        if key in self.pending:
+            self.conflated += 1
+        self.pending[key] = (message, time.perf_counter())
+        self.wakeup.set()
+
+    async def run(self):
+        """Sender loop: drains the latest message per key whenever something is pending."""
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                batch, self.pending = self.pending, {}
+                for message, offered_at in batch.values():
+                    send_start = time.perf_counter()
+                    try:
+                        await self.websocket.send(message)
+                    except websockets.exceptions.ConnectionClosed:
+                        return # The UI handler cleans up the channel
+                    except Exception as e:
+                        self.errors += 1
+                        logging.error(f"Error sending to UI client {self.address}: {e}")
+                        continue
+                    self.last_send_ms = (time.perf_counter() - send_start) * 1000
+                    self.max_send_ms = max(self.max_send_ms, self.last_send_ms)
+                    if self.last_send_ms > SLOW_SEND_MS:
+                        self.slow_sends += 1
+                    self.sent += 1
+                    if self.metrics is not None:
+                        self.metrics.observe('broadcast', time.perf_counter() - offered_at)
+        except asyncio.CancelledError:
+            pass
+
+    def is_slow(self):
+        return self.conflated > 0 or self.slow_sends > 0
+
+    def stats(self):
+        return {
+            "client": str(self.address),
+            "sent": self.sent,
+            "conflated": self.conflated,
+            "errors": self.errors,
+            "slowSends": self.slow_sends,
+            "pending": len(self.pending),
+            "lastSendMs": round(self.last_send_ms, 3),
+            "maxSendMs": round(self.max_send_ms, 3),
+        }
+
+
+class UIBroadcaster:
+    """Registry of UI client channels; publishes each message to all interested clients."""
+
+    def __init__(self, serializer=json.dumps, metrics=None):
+        self.serializer = serializer
+        self.metrics = metrics
+        self.channels = {} # websocket -> UIClientChannel
+        self.published = 0
+
+    def register(self, websocket, symbols=None):
+        channel = UIClientChannel(websocket, symbols, self.metrics)
+        channel.sender_task = asyncio.create_task(channel.run())
+        self.channels[websocket] = channel
+        return channel
+
+    async def unregister(self, websocket):
+        channel = self.channels.pop(websocket, None)
+        if channel and channel.sender_task and not channel.sender_task.done():
+            channel.sender_task.cancel()
+            try:
+                await channel.sender_task
+            except asyncio.CancelledError:
+                pass
+        return channel
+
+    def publish(self, data, key, symbol=None):
+        """Serializes `data` once and offers it to every client subscribed to `symbol`.
+
+        Never awaits: slow clients only ever hold the latest message per key.
+        Returns the number of clients the message was offered to.
+        """
+        recipients = [channel for channel in self.channels.values() if channel.wants(symbol)]
+        if not recipients:
+            return 0
+        serialize_start = time.perf_counter()
+        message = self.serializer(data)
+        if self.metrics is not None:
+            self.metrics.observe('serialize', time.perf_counter() - serialize_start)
+        for channel in recipients:
+            channel.offer(key, message)
+        self.published += 1
+        return len(recipients)
+
+    def publish_message(self, message, key, symbol=None):
+        """Like publish, for a message that is already serialized (e.g. by a shard worker process)."""
+        recipients = [channel for channel in self.channels.values() if channel.wants(symbol)]
+        if not recipients:
+            return 0
+        for channel in recipients:
+            channel.offer(key, message)
+        self.published += 1
+        return len(recipients)
+
+    def send_to(self, websocket, data, key):
+        """Queues a message for a single client (e.g. a reply to a request)."""
+        channel = self.channels.get(websocket)
+        if channel:
+            channel.offer(key, self.serializer(data))
+
+    def send_message_to(self, websocket, message, key):
+        """Like send_to, for a message that is already serialized (e.g. by a worker process)."""
+        channel = self.channels.get(websocket)
+        if channel:
+            channel.offer(key, message)
+
+    def pending_count(self):
+        return sum(len(channel.pending) for channel in self.channels.values())
+
+    def max_pending(self):
+        return max((len(channel.pending) for channel in self.channels.values()), default=0)
+
+    def stats(self):
+        clients = [channel.stats() for channel in self.channels.values()]
+        return {
+            "clients": len(clients),
+            "published": self.published,
+            "slowClients": sum(1 for channel in self.channels.values() if channel.is_slow()),
+            "conflated": sum(c["conflated"] for c in clients),
+            "pending": sum(c["pending"] for c in clients),
+            "perClient": clients,
+        }
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""JSON Codec Layer for the Trade Simulator Backend
+
+Picks the fastest JSON library that is installed (msgspec, then orjson, then the
+stdlib json module) behind one small interface:
+
+    loads(raw)            -> Python object
+    dumps(obj)            -> compact JSON text (str, ready for websocket text frames)
+    decode_levels(levels) -> (n, 2) float64 array of [price, qty] from feed levels
+    TickFrameEncoder      -> encodes UI tick frames from a pre-encoded key template
+
+Install `msgspec` or `orjson` to enable the fast paths; nothing else changes.
+"""
+
+import json
+from typing import List
+
+import numpy as np
+
+try:
+    import msgspec
+except ImportError: # Optional dependency
+    msgspec = None
+
+try:
+    import orjson
+except ImportError: # Optional dependency
+    orjson = None
+
+EMPTY_LEVELS = np.empty((0, 2), dtype=np.float64)
+
+
+def _encode_numpy(obj):
+    # Model outputs can be NumPy scalars (np.float64 from np.sqrt etc.) or arrays
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    raise NotImplementedError(f"Cannot encode objects of type {type(obj).__name__}")
+
+
+if msgspec is not None:
+    BACKEND = "msgspec"
+    _msgspec_decoder = msgspec.json.Decoder()
+    _msgspec_encoder = msgspec.json.Encoder(enc_hook=_encode_numpy)
+    JSONDecodeError = (json.JSONDecodeError, msgspec.DecodeError)
+
+    def loads(raw):
+        return _msgspec_decoder.decode(raw)
+
+    def dumps(obj):
+        return _msgspec_encoder.encode(obj).decode('utf-8')
+
+elif orjson is not None:
+    BACKEND = "orjson"
+    JSONDecodeError = json.JSONDecodeError # orjson.JSONDecodeError subclasses it
+
+    def loads(raw):
+        return orjson.loads(raw)
+
+    def dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+
+else:
+    BACKEND = "json"
+    JSONDecodeError = json.JSONDecodeError
+    _stdlib_encoder = json.JSONEncoder(separators=(',', ':'), default=_encode_numpy)
+
+    def loads(raw):
+        return json.loads(raw)
+
+    def dumps(obj):
+        return _stdlib_encoder.encode(obj)
+
+
+def decode_levels(levels):
+    """Converts feed levels ([[price, qty, ...], ...], strings or numbers) to an (n, 2) float64 array."""
+    if isinstance(levels, np.ndarray):
+        return levels[:, :2].astype(np.float64, copy=False) if len(levels) else EMPTY_LEVELS
+    if not levels:
+        return EMPTY_LEVELS
+    if msgspec is not None:
+        try:
+            # Lax conversion parses numeric strings in C
+            return np.array(msgspec.convert(levels, List[List[float]], strict=False), dtype=np.float64)[:, :2]
+        except (msgspec.ValidationError, ValueError):
+            pass # Ragged or malformed rows: fall back to the per-level path below
+    return np.array([(float(level[0]), float(level[1])) for level in levels], dtype=np.float64)
+
+
+def _encode_number(value):
+    # float repr is valid JSON except for nan/inf, which JSON cannot represent
+    if value != value or value in (float('inf'), float('-inf')):
+        return 'null'
+    return repr(value)
+
+
+class TickFrameEncoder:
+    """Encodes flat dicts with a fixed key order using a pre-encoded template.
+
+    The keys (and the punctuation between values) are encoded once; each frame
+    only encodes the values. Numbers are written with repr(), everything else
+    goes through dumps(). Frames with other keys, and every frame when a fast
+    JSON library is installed, go through a plain dumps().
+    """
+
+    def __init__(self, keys):
+        self.keys = tuple(keys)
+        self._key_set = frozenset(self.keys)
+        self._prefixes = [('{' if i == 0 else ',') + json.dumps(key) + ':' for i, key in enumerate(self.keys)]
+
+    def encode(self, frame):
+        if BACKEND != "json" or frame.keys() != self._key_set:
+            # msgspec/orjson encode a whole dict faster than any Python-level template
+            return dumps(frame)
+        parts = []
+        for prefix, key in zip(self._prefixes, self.keys):
+            value = frame[key]
+            parts.append(prefix)
+            if type(value) is float or type(value) is int:
+                parts.append(_encode_number(value))
+            else:
+                parts.append(dumps(value))
+        parts.append('}')
+        return ''.join(parts)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""Model Compute Stage for the Trade Simulator Backend
+
+Feed ingestion only parses messages and applies them to the order books, then
+hands the book to ComputeStage.submit(). The stage keeps one slot per symbol
+holding just the latest book (newer submissions replace pending ones, so the
+queue is bounded by the number of instruments and intermediate books are
+dropped) and evaluates the cost models on it from its own task:
+
+    'loop'    - on the event loop, between feed messages
+    'thread'  - in a worker thread, on a snapshot of the book
+    'process' - in a worker process, on a snapshot of the book
+
+An optional rate cap limits how often the models run, however fast the feed is.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+
+COMPUTE_MODES = ('loop', 'thread', 'process')
+
+
+def spawn_context():
+    """Multiprocessing context for the backend's worker processes.
+
+    Workers are spawned, not forked: a forked worker would inherit (and keep
+    open) the UI and feed sockets of the process that started it.
+    """
+    return multiprocessing.get_context('spawn')
+
+
+class ComputeStage:
+    """Coalescing latest-book-per-symbol queue feeding a model evaluation task."""
+
+    def __init__(self, compute_fn, publish_fn, params, mode='loop', max_rate_hz=0.0, metrics=None):
+        if mode not in COMPUTE_MODES:
+            raise ValueError(f"Unknown compute mode '{mode}' (expected one of {COMPUTE_MODES})")
+        self.compute_fn = compute_fn # (order_book, params, start_time) -> tick or None; module-level for 'process'
+        self.publish_fn = publish_fn # (tick, symbol), always called on the event loop
+        self.params = params # Live parameter dict; worker modes get a copy per evaluation
+        self.mode = mode
+        self.min_interval_s = 1.0 / max_rate_hz if max_rate_hz and max_rate_hz > 0 else 0.0
+        self.metrics = metrics # Optional PipelineMetrics
+        self.pending = {} # symbol -> (order_book, start_time of the newest message applied to it)
+        self.wakeup = asyncio.Event()
+        self.executor = None
+        self.task = None
+        # Stats
+        self.submitted = 0
+        self.coalesced = 0
+        self.computed = 0
+        self.errors = 0
+
+    def submit(self, order_book, start_time):
+        """Marks `order_book` as changed; never blocks and never queues more than one book per symbol."""
+        self.submitted += 1
+        if order_book.symbol in self.pending:
+            self.coalesced += 1
+            # Keep the oldest start time so tick latency covers the time spent coalescing
+            start_time = self.pending[order_book.symbol][1]
+        self.pending[order_book.symbol] = (order_book, start_time)
+        self.wakeup.set()
+
+    def _create_executor(self):
+        if self.mode == 'thread':
+            return ThreadPoolExecutor(max_workers=1, thread_name_prefix='compute')
+        if self.mode == 'process':
+            return ProcessPoolExecutor(max_workers=1, mp_context=spawn_context())
+        return None
+
+    def start(self):
+        self.executor = self._create_executor()
+        self.task = asyncio.create_task(self.run())
+        logging.info(f"Compute stage started (mode: {self.mode}, "
+                     f"max rate: {1.0 / self.min_interval_s if self.min_interval_s else 'unlimited'} Hz)")
+
+    async def stop(self):
+        if self.task and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        self.pending.clear()
+
+    async def run(self):
+        """Evaluates the latest book of every changed symbol, at most once per rate interval."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            batch_start = time.perf_counter()
+            batch, self.pending = self.pending, {}
+            for symbol, (order_book, start_time) in batch.items():
+                try:
+                    tick = await self._evaluate(loop, order_book, start_time)
+                except BrokenExecutor as e:
+                    self.errors += 1
+                    logging.error(f"Compute stage: worker died ({e}); starting a new one.")
+                    self.executor.shutdown(wait=False, cancel_futures=True)
+                    self.executor = self._create_executor()
+                    continue
+                except Exception as e:
+                    self.errors += 1
+                    logging.error(f"Compute stage: model evaluation failed for {symbol}: {e}", exc_info=True)
+                    continue
+                self.computed += 1
+                if tick is None:
+                    continue
+                try:
+                    self.publish_fn(tick, symbol)
+                    if self.metrics is not None:
+                        self.metrics.observe('tick_total', time.perf_counter() - start_time)
+                except Exception as e:
+                    # One bad tick must not stop the stage for every symbol
+                    self.errors += 1
+                    logging.error(f"Compute stage: publishing the tick for {symbol} failed: {e}", exc_info=True)
+            if self.min_interval_s:
+                await asyncio.sleep(max(0.0, batch_start + self.min_interval_s - time.perf_counter()))
+
+    async def _evaluate(self, loop, order_book, start_time):
+        compute_start = time.perf_counter()
+        if self.metrics is not None:
+            self.metrics.observe('compute_wait', compute_start - start_time)
+        if self.executor is None:
+            tick = self.compute_fn(order_book, self.params, start_time)
+        else:
+            # Workers get a detached copy: the ingest task keeps mutating the live book
+            tick = await loop.run_in_executor(
+                self.executor, self.compute_fn, order_book.snapshot(), dict(self.params), start_time)
+        if self.metrics is not None:
+            self.metrics.observe('compute', time.perf_counter() - compute_start)
+        return tick
+
+    def pending_count(self):
+        return len(self.pending)
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "submitted": self.submitted,
+            "coalesced": self.coalesced,
+            "computed": self.computed,
+            "errors": self.errors,
+            "pending": len(self.pending),
+        }
@@ -3,6 +3,9 @@
         const quantityUSDEl = document.getElementById('quantityUSD');
         const volatilityEl = document.getElementById('volatility');
         const feeTierEl = document.getElementById('feeTier');
+        const orderTypeEl = document.getElementById('orderType');
+        const limitPriceEl = document.getElementById('limitPrice');
+        const calibrationEl = document.getElementById('calibration');
         const sendParamsBtn = document.getElementById('sendParams');
         const connectionStatusEl = document.getElementById('connectionStatus');
 
@@ -15,6 +18,8 @@
         const marketImpactEl = document.getElementById('marketImpact');
         const netCostEl = document.getElementById('netCost');
         const makerTakerEl = document.getElementById('makerTaker');
+        const limitFillEl = document.getElementById('limitFill');
+        const calibrationInfoEl = document.getElementById('calibrationInfo');
         const internalLatencyEl = document.getElementById('internalLatency');
         const lastUpdateEl = document.getElementById('lastUpdate');
         const asksTableEl = document.getElementById('asksTable');
@@ -64,6 +69,10 @@
                 rawMessageEl.textContent = "Last message: " + new Date().toLocaleTimeString() + "\n" + JSON.stringify(JSON.parse(event.data), null, 2);
                 try {
                     const data = JSON.parse(event.data);
+                    // Typed messages (stats, metrics, ...) are not ticks; only ticks update the dashboard
+                    if (data.type && data.type !== 'tick') {
+                        return;
+                    }
                     updateUI(data);
                 } catch (e) {
                     console.error("WebSocket: Error parsing JSON from backend:", e, "\nData:", event.data);
@@ -109,7 +118,11 @@
                 const params = {
                     quantityUSD: quantityUSD,
                     volatility: volatility, // Key is 'volatility' for the backend
-                    fee_tier_data: fee_tier_data 
+                    fee_tier_data: fee_tier_data,
+                    orderType: orderTypeEl.value,
+                    limitPrice: limitPriceEl.value === '' ? null : parseFloat(limitPriceEl.value),
+                    calibration: calibrationEl.value === 'manual' ? 'manual' : 'live',
+                    liveVolatility: calibrationEl.value === 'window' ? 'window' : 'ewma'
                 };
                 try {
                     socket.send(JSON.stringify(params));
@@ -137,6 +150,17 @@
             netCostEl.textContent = data.netCost !== undefined ? `$${parseFloat(data.netCost).toFixed(2)}` : '0.00';
             
             makerTakerEl.textContent = data.makerTaker || 'N/A';
+            const limitOrder = data.limitOrder;
+            limitFillEl.textContent = limitOrder
+                ? `${(limitOrder.fillProbability * 100).toFixed(1)}% in ${limitOrder.horizonS}s / ` +
+                  (limitOrder.expectedTimeToFillS !== null ? `~${limitOrder.expectedTimeToFillS.toFixed(0)}s` : 'n/a') +
+                  ` (queue ahead: ${limitOrder.queueAhead})`
+                : 'N/A';
+            const calibration = data.calibration;
+            calibrationInfoEl.textContent = calibration
+                ? `${calibration.volatilityPct.toFixed(1)}% (${calibration.volatilitySource}) / ` +
+                  `${calibration.adv.toFixed(1)} (${calibration.advSource})`
+                : 'N/A';
             internalLatencyEl.textContent = data.internalLatency !== undefined ? `${parseFloat(data.internalLatency).toFixed(2)} ms` : '0.00 ms';
             lastUpdateEl.textContent = data.lastUpdate || 'N/A';
 
@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+"""Limit Order Fill Simulation for the Trade Simulator Backend
+
+Tracks hypothetical resting limit orders against the incremental L2 stream. The
+order book hands each side's levels to LimitOrderSimulator.on_levels() before
+applying them; only levels that hold simulated orders are looked at, and each
+level keeps its orders in one LevelQueue, so a book change costs O(log k) per
+touched level however many orders rest there (no rescans of the book or of the
+orders).
+
+Queue model (L2 data carries no trades, so this is a heuristic):
+
+    - a new order joins the back of its level: the volume ahead of it is the
+      level quantity at placement; the part that crosses the opposite side
+      fills immediately as taker
+    - when a level shrinks by d, FRONT_SHARE * d is taken to be executions at
+      the front of the queue and the rest cancellations spread evenly over it;
+      growth only adds volume behind our orders
+    - an order fills as maker once executions pass its queue position, or in
+      full when the opposite side trades through its price after placement
+      (the opposite depth its taker part crossed still shows in the book, so
+      only depth beyond that counts; it shrinks as that depth goes away)
+
+Fill estimates divide the volume an order still has to see executed (better
+levels + its queue position + its own remaining size) by the recent execution
+rate at the touch (an exponentially weighted rate of the same front-of-queue
+volume), and P(fill within horizon) = 1 - exp(-horizon / expected time).
+"""
+
+import bisect
+import math
+import time
+
+import numpy as np
+
+FRONT_SHARE = 0.5 # Share of a level decrease assumed to be executions (the rest is cancels)
+RATE_HALF_LIFE_S = 60.0 # Half-life of the execution rate estimate
+DEFAULT_FILL_HORIZON_S = 60.0
+QTY_EPSILON = 1e-12
+MIN_SCALE = 1e-9 # Rebase a queue's lazy transform before it loses precision
+
+EMPTY_FILLS = (np.empty(0, dtype=np.int64), np.empty(0))
+
+
+class LevelQueue:
+    """Simulated orders resting at one price, front of the queue first.
+
+    The volume ahead of order i is scale * q[i] + shift: level changes update
+    (scale, shift) in O(1) instead of every order. q stays ascending (later
+    orders queue behind earlier ones), so the orders reached by executions are
+    always a prefix, found with one searchsorted.
+    """
+
+    def __init__(self, price, capacity=8):
+        self.price = price
+        self.scale = 1.0
+        self.shift = 0.0
+        self.order_ids = np.empty(capacity, dtype=np.int64)
+        self.q = np.empty(capacity)
+        self.remaining = np.empty(capacity)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def add(self, order_id, queue_ahead, qty):
+        n = self.n
+        if n == len(self.q):
+            self.order_ids = np.concatenate((self.order_ids, np.empty(n, dtype=np.int64)))
+            self.q = np.concatenate((self.q, np.empty(n)))
+            self.remaining = np.concatenate((self.remaining, np.empty(n)))
+        stored = (queue_ahead - self.shift) / self.scale
+        if n and stored < self.q[n - 1]:
+            stored = self.q[n - 1] # Rounding only: nobody joins ahead of an earlier order
+        self.order_ids[n] = order_id
+        self.q[n] = stored
+        self.remaining[n] = qty
+        self.n = n + 1
+
+    def remove(self, order_id):
+        """Drops an order; returns its remaining quantity (0.0 if it is not here)."""
+        hits = np.flatnonzero(self.order_ids[:self.n] == order_id)
+        if not len(hits):
+            return 0.0
+        i = int(hits[0])
+        remaining = float(self.remaining[i])
+        for array in (self.order_ids, self.q, self.remaining):
+            array[i:self.n - 1] = array[i + 1:self.n]
+        self.n -= 1
+        return remaining
+
+    def queue_ahead(self):
+        """Volume ahead of each order, front first."""
+        return np.maximum(self.scale * self.q[:self.n] + self.shift, 0.0)
+
+    def position_of(self, order_id):
+        """Volume ahead of one order, or None if it is not here."""
+        hits = np.flatnonzero(self.order_ids[:self.n] == order_id)
+        if not len(hits):
+            return None
+        return max(self.scale * float(self.q[hits[0]]) + self.shift, 0.0)
+
+    def consume(self, old_qty, new_qty, front_share):
+        """Applies the level shrinking from old_qty to new_qty; returns (order_ids, qtys) of maker fills."""
+        if new_qty >= old_qty or self.n == 0:
+            return EMPTY_FILLS
+        n = self.n
+        executed = front_share * (old_qty - new_qty)
+        # Orders whose queue position the executions went past
+        k = int(np.searchsorted(self.q[:n], (executed - self.shift) / self.scale, side='left'))
+        fills = EMPTY_FILLS
+        if k:
+            past = executed - (self.scale * self.q[:k] + self.shift)
+            fill_qtys = np.minimum(self.remaining[:k], past)
+            self.remaining[:k] -= fill_qtys
+            fills = (self.order_ids[:k].copy(), fill_qtys)
+        # Cancels shrink everything left ahead of us proportionally: ahead' = factor * (ahead - executed)
+        left = old_qty - executed
+        factor = new_qty / left if left > QTY_EPSILON else 0.0
+        self.shift = factor * (self.shift - executed)
+        self.scale *= factor
+        if self.scale < MIN_SCALE:
+            self._rebase()
+        if k:
+            self.q[:k] = -self.shift / self.scale # Partially filled orders are now at the front
+            self._drop_filled()
+        return fills
+
+    def fill_all(self):
+        """Fills every order (the price was traded through); returns (order_ids, qtys)."""
+        fills = (self.order_ids[:self.n].copy(), self.remaining[:self.n].copy())
+        self.n = 0
+        return fills
+
+    def _rebase(self):
+        n = self.n
+        np.maximum(self.scale * self.q[:n] + self.shift, 0.0, out=self.q[:n])
+        self.scale = 1.0
+        self.shift = 0.0
+
+    def _drop_filled(self):
+        n = self.n
+        keep = self.remaining[:n] > QTY_EPSILON
+        if keep.all():
+            return
+        m = int(keep.sum())
+        for array in (self.order_ids, self.q, self.remaining):
+            array[:m] = array[:n][keep]
+        self.n = m
+
+    def copy(self):
+        queue = LevelQueue(self.price, capacity=max(self.n, 1))
+        queue.scale, queue.shift, queue.n = self.scale, self.shift, self.n
+        queue.order_ids[:self.n] = self.order_ids[:self.n]
+        queue.q[:self.n] = self.q[:self.n]
+        queue.remaining[:self.n] = self.remaining[:self.n]
+        return queue
+
+
+class LimitOrder:
+    """One simulated limit order; quantities are in base asset units."""
+
+    __slots__ = ('order_id', 'side', 'price', 'qty', 'taker_filled', 'maker_filled', 'placed_at', 'filled_at')
+
+    def __init__(self, order_id, side, price, qty, placed_at):
+        self.order_id = order_id
+        self.side = side # 'buy' or 'sell'
+        self.price = price
+        self.qty = qty
+        self.taker_filled = 0.0
+        self.maker_filled = 0.0
+        self.placed_at = placed_at # Book time (s)
+        self.filled_at = None
+
+    @property
+    def book_side(self):
+        """Name of the book side the order rests on."""
+        return 'bids' if self.side == 'buy' else 'asks'
+
+    @property
+    def remaining(self):
+        return max(self.qty - self.taker_filled - self.maker_filled, 0.0)
+
+    def is_done(self):
+        return self.filled_at is not None
+
+    def copy(self):
+        order = LimitOrder(self.order_id, self.side, self.price, self.qty, self.placed_at)
+        order.taker_filled, order.maker_filled, order.filled_at = self.taker_filled, self.maker_filled, self.filled_at
+        return order
+
+
+class LimitOrderSimulator:
+    """Simulated limit orders for one instrument, kept in step with its L2OrderBook.
+
+    Attach it as `order_book.order_tracker`; the book then drives on_levels()
+    and on_message_applied(). Book time comes from the feed timestamps, so a
+    replay reproduces the same fills.
+    """
+
+    def __init__(self, symbol=None, front_share=FRONT_SHARE, rate_half_life_s=RATE_HALF_LIFE_S):
+        self.symbol = symbol
+        self.front_share = front_share
+        self.rate_tau_s = rate_half_life_s / math.log(2)
+        self.levels = {'bids': {}, 'asks': {}} # book side -> {price: LevelQueue}
+        self.level_prices = {'bids': [], 'asks': []} # Sorted prices of the queues above
+        self.orders = {} # order_id -> LimitOrder
+        self.crossed = {} # order_id -> opposite depth at its price or better that its taker part consumed
+        self.reported_order_id = None # The order snapshot() carries (e.g. the one shown in the UI)
+        self.last_reported_fill_s = None # Time-to-fill of the last reported order that completed
+        self.execution_rate = {'bids': 0.0, 'asks': 0.0} # Asset units/s executed at the touch
+        self._pending_executed = {'bids': 0.0, 'asks': 0.0}
+        self.last_executed = 0.0 # Estimated volume executed at the touch by the last message (both sides)
+        self.now = None # Book time (s) of the last message
+        self._next_id = 1
+
+    # --- Orders ---
+    def place(self, order_book, side, price, qty, report=False):
+        """Places a simulated limit order; returns its id."""
+        if side not in ('buy', 'sell'):
+            raise ValueError(f"Unknown side '{side}'")
+        if qty <= 0:
+            raise ValueError("Limit order quantity must be positive")
+        order_id = self._next_id
+        self._next_id += 1
+        order = LimitOrder(order_id, side, float(price), float(qty), self._book_time(order_book))
+        self.orders[order_id] = order
+        if report:
+            self.reported_order_id = order_id
+        # The marketable part takes the opposite side's liquidity at our price or better
+        opposite = order_book.asks if side == 'buy' else order_book.bids
+        crossed_depth = float(opposite.depth_better_than(order.price, inclusive=True))
+        order.taker_filled = min(order.qty, crossed_depth)
+        if order.remaining <= QTY_EPSILON:
+            order.filled_at = order.placed_at
+            return order_id
+        if crossed_depth > QTY_EPSILON:
+            self.crossed[order_id] = crossed_depth # Still in the book, but no longer there for us
+        book_side = order.book_side
+        queue = self.levels[book_side].get(order.price)
+        if queue is None:
+            queue = self.levels[book_side][order.price] = LevelQueue(order.price)
+            bisect.insort(self.level_prices[book_side], order.price)
+        queue.add(order_id, getattr(order_book, book_side).qty_at(order.price), order.remaining)
+        return order_id
+
+    def cancel(self, order_id):
+        """Removes an order (resting or not) from the simulation; returns it, or None."""
+        order = self.orders.pop(order_id, None)
+        if order is None:
+            return None
+        self.crossed.pop(order_id, None)
+        queue = self.levels[order.book_side].get(order.price)
+        if queue is not None:
+            queue.remove(order_id)
+            if not len(queue):
+                self._drop_level(order.book_side, order.price)
+        if order_id == self.reported_order_id:
+            self.reported_order_id = None
+        return order
+
+    def _drop_level(self, book_side, price):
+        del self.levels[book_side][price]
+        prices = self.level_prices[book_side]
+        del prices[bisect.bisect_left(prices, price)]
+
+    def _record_fills(self, fills):
+        order_ids, qtys = fills
+        for order_id, qty in zip(order_ids.tolist(), qtys.tolist()):
+            order = self.orders[order_id]
+            order.maker_filled += qty
+            if order.remaining <= QTY_EPSILON and order.filled_at is None:
+                order.filled_at = self.now
+                self.crossed.pop(order_id, None)
+                if order_id == self.reported_order_id:
+                    self.last_reported_fill_s = self.now - order.placed_at
+
+    # --- Book events ---
+    def on_levels(self, order_book, side_name, levels, is_snapshot):
+        """Called with one side's (n, 2) levels before the book applies them."""
+        side = getattr(order_book, side_name)
+        self._observe_executions(side, side_name, levels, is_snapshot)
+        queues = self.levels[side_name]
+        if not queues:
+            return
+        if is_snapshot:
+            # Levels missing from a snapshot are gone
+            changes = dict.fromkeys(queues, 0.0)
+            for price, qty in levels.tolist():
+                if price in changes:
+                    changes[price] = qty
+        else:
+            changes = {price: qty for price, qty in levels.tolist() if price in queues}
+        for price, new_qty in changes.items():
+            fills = queues[price].consume(side.qty_at(price), new_qty, self.front_share)
+            if len(fills[0]):
+                self._record_fills(fills)
+            if not len(queues[price]):
+                self._drop_level(side_name, price)
+
+    def _observe_executions(self, side, side_name, levels, is_snapshot):
+        # Same front-of-queue share as the queues, measured on the current best level
+        best = side.best()
+        if best is None or (not is_snapshot and not len(levels)):
+            return
+        best_price, best_qty = best
+        at_best = levels[:, 0] == best_price
+        if at_best.any():
+            new_qty = float(levels[at_best, 1][-1])
+        elif is_snapshot:
+            new_qty = 0.0 # Missing from a full book: the level is gone
+        else:
+            return
+        if new_qty < best_qty:
+            self._pending_executed[side_name] += self.front_share * (best_qty - new_qty)
+
+    def on_message_applied(self, order_book):
+        """Called after every message: advances the rate estimates and fills orders traded through."""
+        now = self._book_time(order_book)
+        self.last_executed = self._pending_executed['bids'] + self._pending_executed['asks']
+        decay = math.exp(-max(now - self.now, 0.0) / self.rate_tau_s) if self.now is not None else 1.0
+        for side_name in ('bids', 'asks'):
+            self.execution_rate[side_name] = (self.execution_rate[side_name] * decay
+                                              + self._pending_executed[side_name] / self.rate_tau_s)
+            self._pending_executed[side_name] = 0.0
+        self.now = now
+        if self.crossed:
+            self._shrink_crossed(order_book)
+        best_bid, best_ask = order_book.best_bid(), order_book.best_ask()
+        bid_prices, ask_prices = self.level_prices['bids'], self.level_prices['asks']
+        if best_ask is not None and bid_prices and bid_prices[-1] >= best_ask[0]:
+            crossing = bid_prices[bisect.bisect_left(bid_prices, best_ask[0]):]
+            self._trade_through('bids', order_book.asks, crossing[::-1])
+        if best_bid is not None and ask_prices and ask_prices[0] <= best_bid[0]:
+            crossing = ask_prices[:bisect.bisect_right(ask_prices, best_bid[0])]
+            self._trade_through('asks', order_book.bids, crossing)
+
+    def _shrink_crossed(self, order_book):
+        # Crossed depth that has left the book (traded or cancelled) no longer hides anything
+        for order_id, crossed_depth in list(self.crossed.items()):
+            order = self.orders[order_id]
+            opposite = order_book.asks if order.side == 'buy' else order_book.bids
+            depth = float(opposite.depth_better_than(order.price, inclusive=True))
+            if depth <= QTY_EPSILON:
+                del self.crossed[order_id]
+            elif depth < crossed_depth:
+                self.crossed[order_id] = depth
+
+    def _trade_through(self, side_name, opposite, prices):
+        """Fills the orders at `prices` (levels the opposite side has reached) that it traded through."""
+        for price in prices:
+            queue = self.levels[side_name][price]
+            order_ids = queue.order_ids[:queue.n].tolist()
+            if not any(order_id in self.crossed for order_id in order_ids):
+                fills = queue.fill_all()
+            else:
+                # Orders that crossed on placement fill only once depth beyond what they took shows up
+                depth = float(opposite.depth_better_than(price, inclusive=True))
+                traded = [order_id for order_id in order_ids if depth - self.crossed.get(order_id, 0.0) > QTY_EPSILON]
+                fills = (np.array(traded, dtype=np.int64), np.array([queue.remove(order_id) for order_id in traded]))
+            if len(fills[0]):
+                self._record_fills(fills)
+            if not len(queue):
+                self._drop_level(side_name, price)
+
+    def _book_time(self, order_book):
+        if order_book.okx_ts is not None:
+            return int(order_book.okx_ts) / 1000.0
+        return self.now if self.now is not None else time.time()
+
+    # --- Estimates ---
+    def _fill_estimate(self, remaining, volume_ahead, side_name, horizon_s):
+        """(P(fill within horizon), expected time to fill in s); NumPy-vectorized over orders."""
+        remaining = np.asarray(remaining, dtype=np.float64)
+        rate = self.execution_rate[side_name]
+        if rate <= 0.0:
+            expected = np.full(remaining.shape, np.inf)
+        else:
+            expected = (volume_ahead + remaining) / rate
+        with np.errstate(divide='ignore'):
+            probability = np.where(remaining > QTY_EPSILON, -np.expm1(-horizon_s / expected), 1.0)
+        return probability, np.where(remaining > QTY_EPSILON, expected, 0.0)
+
+    def estimate(self, order_book, order_id, horizon_s=DEFAULT_FILL_HORIZON_S):
+        """Queue position, fills so far and fill estimates of one order, or None if it is unknown."""
+        order = self.orders.get(order_id)
+        if order is None:
+            return None
+        side_name = order.book_side
+        queue = self.levels[side_name].get(order.price)
+        position = queue.position_of(order_id) if queue is not None else None
+        queue_ahead = position or 0.0
+        remaining = order.remaining
+        volume_ahead = queue_ahead + float(getattr(order_book, side_name).depth_better_than(order.price))
+        probability, expected = self._fill_estimate(remaining, volume_ahead, side_name, horizon_s)
+        probability, expected = float(probability), float(expected)
+        maker_expected = order.maker_filled + remaining * probability
+        return {
+            "orderId": order_id,
+            "side": order.side,
+            "price": order.price,
+            "quantity": order.qty,
+            "queueAhead": round(queue_ahead, 8),
+            "volumeAhead": round(volume_ahead, 8),
+            "filledPct": round((order.taker_filled + order.maker_filled) / order.qty * 100.0, 4),
+            "takerPct": round(order.taker_filled / order.qty * 100.0, 4),
+            "makerPct": round(maker_expected / order.qty * 100.0, 4),
+            "fillProbability": round(probability, 6),
+            "expectedTimeToFillS": round(expected, 3) if math.isfinite(expected) else None,
+            "horizonS": horizon_s,
+            "lastFillTimeS": self.last_reported_fill_s,
+        }
+
+    def estimate_orders(self, order_book, horizon_s=DEFAULT_FILL_HORIZON_S):
+        """Fill estimates for every resting order, as arrays: (order_ids, volume_ahead, probability, expected_time)."""
+        results = []
+        for side_name, queues in self.levels.items():
+            if not queues:
+                continue
+            side = getattr(order_book, side_name)
+            prices = np.fromiter(queues, dtype=np.float64, count=len(queues))
+            better = side.depth_better_than(prices)
+            for queue, depth in zip(queues.values(), better.tolist()):
+                n = queue.n
+                volume_ahead = queue.queue_ahead() + depth
+                remaining = queue.remaining[:n]
+                probability, expected = self._fill_estimate(remaining, volume_ahead, side_name, horizon_s)
+                results.append((queue.order_ids[:n].copy(), volume_ahead, probability, expected))
+        if not results:
+            return EMPTY_FILLS[0], np.empty(0), np.empty(0), np.empty(0)
+        return tuple(np.concatenate(column) for column in zip(*results))
+
+    def snapshot(self):
+        """Detached copy holding only the reported order and the rate estimates (for compute workers)."""
+        view = LimitOrderSimulator(self.symbol, self.front_share, self.rate_tau_s * math.log(2))
+        view.execution_rate = dict(self.execution_rate)
+        view.now = self.now
+        view.last_reported_fill_s = self.last_reported_fill_s
+        order = self.orders.get(self.reported_order_id)
+        if order is not None:
+            view.reported_order_id = order.order_id
+            view.orders[order.order_id] = order.copy()
+            if order.order_id in self.crossed:
+                view.crossed[order.order_id] = self.crossed[order.order_id]
+            queue = self.levels[order.book_side].get(order.price)
+            position = queue.position_of(order.order_id) if queue is not None else None
+            if position is not None:
+                single = LevelQueue(order.price, capacity=1)
+                single.add(order.order_id, position, order.remaining)
+                view.levels[order.book_side][order.price] = single
+                view.level_prices[order.book_side].append(order.price)
+        return view
+
+    def stats(self):
+        return {
+            "orders": len(self.orders),
+            "restingLevels": len(self.levels['bids']) + len(self.levels['asks']),
+            "executionRate": {side: round(rate, 6) for side, rate in self.execution_rate.items()},
+        }
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""Pipeline Latency Metrics for the Trade Simulator Backend
+
+LatencyHistogram is a small HDR-style histogram: values (in microseconds) land
+in log-linear buckets with 64-128 sub-buckets per power of two, so recording is
+a couple of integer operations and any percentile is accurate to within ~1.6%.
+PipelineMetrics groups one histogram per processing stage plus queue-depth
+gauges, and renders them as Prometheus text for the local /metrics endpoint.
+Histograms merge exactly, so other processes (e.g. shard workers) can export
+their metrics and have them folded into one view (PipelineMetrics.add_source):
+histograms and counters are merged, gauges are reported per source.
+"""
+
+import asyncio
+import logging
+import time
+
+SUB_BUCKET_BITS = 7
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS # 128
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1 # 64
+# Buckets cover 0 .. 2**40 us (~12.7 days); larger values are clamped
+MAX_TRACKABLE_US = (1 << 40) - 1
+SUMMARY_QUANTILES = (0.5, 0.99, 0.999)
+
+
+def _bucket_index(value):
+    if value < SUB_BUCKET_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return shift * SUB_BUCKET_HALF + (value >> shift)
+
+
+def _bucket_upper_value(index):
+    """Highest value that maps to bucket `index`."""
+    if index < SUB_BUCKET_COUNT:
+        return index
+    shift = index // SUB_BUCKET_HALF - 1
+    mantissa = index - shift * SUB_BUCKET_HALF
+    return ((mantissa + 1) << shift) - 1
+
+
+class LatencyHistogram:
+    """Log-linear latency histogram over integer microseconds."""
+
+    def __init__(self):
+        self.counts = [0] * (_bucket_index(MAX_TRACKABLE_US) + 1)
+        self.count = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    def record_us(self, value_us):
+        value_us = int(value_us)
+        if value_us < 0:
+            value_us = 0 # e.g. exchange/local clock skew
+        elif value_us > MAX_TRACKABLE_US:
+            value_us = MAX_TRACKABLE_US
+        self.counts[_bucket_index(value_us)] += 1
+        self.count += 1
+        self.total_us += value_us
+        if value_us > self.max_us:
+            self.max_us = value_us
+
+    def record_seconds(self, seconds):
+        self.record_us(seconds * 1e6)
+
+    def percentile(self, q):
+        """Value (us) at quantile q in [0, 1]; 0 if nothing was recorded."""
+        if self.count == 0:
+            return 0
+        target = max(1, int(q * self.count + 0.5))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count:
+                seen += bucket_count
+                if seen >= target:
+                    return min(_bucket_upper_value(index), self.max_us)
+        return self.max_us
+
+    def mean_us(self):
+        return self.total_us / self.count if self.count else 0.0
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    def export(self):
+        """Compact JSON-friendly state (non-empty buckets only) for merge() in another process."""
+        return {
+            "buckets": [[index, bucket_count] for index, bucket_count in enumerate(self.counts) if bucket_count],
+            "count": self.count,
+            "total_us": self.total_us,
+            "max_us": self.max_us,
+        }
+
+    def merge(self, state):
+        """Adds the observations of an export()ed histogram."""
+        for index, bucket_count in state["buckets"]:
+            self.counts[index] += bucket_count
+        self.count += state["count"]
+        self.total_us += state["total_us"]
+        self.max_us = max(self.max_us, state["max_us"])
+
+    def summary(self):
+        """{'count', 'p50', 'p99', 'p999', 'max', 'mean'} in microseconds."""
+        return {
+            "count": self.count,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "p999": self.percentile(0.999),
+            "max": self.max_us,
+            "mean": round(self.mean_us(), 1),
+        }
+
+
+class PipelineMetrics:
+    """Per-stage latency histograms, counters and queue-depth gauges."""
+
+    def __init__(self, prefix="trade"):
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {} # name -> zero-argument callable returning a number
+        self.sources = [] # Zero-argument callables returning export()ed metrics of other processes
+
+    def histogram(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+        return histogram
+
+    def observe(self, stage, seconds):
+        """Records one duration (in seconds) for `stage`."""
+        self.histogram(stage).record_us(seconds * 1e6)
+
+    def reset(self):
+        """Clears all histograms and counters (gauges are live readings and are kept)."""
+        for histogram in self.histograms.values():
+            histogram.reset()
+        self.counters.clear()
+
+    def increment(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def register_gauge(self, name, read_fn):
+        self.gauges[name] = read_fn
+
+    def _read_gauges(self):
+        values = {}
+        for name, read_fn in self.gauges.items():
+            try:
+                values[name] = read_fn()
+            except Exception as e:
+                logging.debug(f"Metrics: gauge {name} failed: {e}")
+        return values
+
+    def add_source(self, read_fn):
+        """Folds the metrics returned by read_fn() into every summary.
+
+        read_fn returns a list of export() results, each with a "source" name
+        added (its gauges are reported under that name).
+        """
+        self.sources.append(read_fn)
+
+    def export(self):
+        """JSON-friendly state of all histograms, counters and current gauge readings."""
+        return {
+            "stages": {stage: h.export() for stage, h in self.histograms.items()},
+            "counters": dict(self.counters),
+            "gauges": self._read_gauges(),
+        }
+
+    def _combined(self):
+        """(histograms, counters, {source: gauges}) of this process (source None) merged with every source."""
+        exported = []
+        for read_fn in self.sources:
+            try:
+                exported.extend(read_fn())
+            except Exception as e:
+                logging.debug(f"Metrics: source {read_fn} failed: {e}")
+        if not exported:
+            return self.histograms, self.counters, {None: self._read_gauges()}
+        histograms, counters, gauges = {}, {}, {}
+        for state in [self.export()] + exported:
+            for stage, histogram_state in state["stages"].items():
+                histograms.setdefault(stage, LatencyHistogram()).merge(histogram_state)
+            for name, value in state["counters"].items():
+                counters[name] = counters.get(name, 0) + value
+            gauges[state.get("source")] = state["gauges"]
+        return histograms, counters, gauges
+
+    def summary(self):
+        """JSON-friendly snapshot: per-stage latency (us), counters and gauges (plus each source's gauges)."""
+        histograms, counters, gauges = self._combined()
+        summary = {
+            "stages": {stage: h.summary() for stage, h in histograms.items()},
+            "counters": dict(counters),
+            "gauges": gauges.pop(None),
+        }
+        if gauges:
+            summary["sourceGauges"] = gauges
+        return summary
+
+    def render_prometheus(self):
+        """Renders all metrics in the Prometheus text exposition format."""
+        histograms, counters, gauges = self._combined()
+        name = f"{self.prefix}_stage_latency_seconds"
+        lines = [
+            f"# HELP {name} Per-stage processing latency.",
+            f"# TYPE {name} summary",
+        ]
+        for stage, h in histograms.items():
+            for q in SUMMARY_QUANTILES:
+                lines.append(f'{name}{{stage="{stage}",quantile="{q}"}} {h.percentile(q) / 1e6:.6f}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {h.total_us / 1e6:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {h.count}')
+        max_name = f"{self.prefix}_stage_latency_max_seconds"
+        lines += [f"# HELP {max_name} Maximum observed per-stage latency.", f"# TYPE {max_name} gauge"]
+        for stage, h in histograms.items():
+            lines.append(f'{max_name}{{stage="{stage}"}} {h.max_us / 1e6:.6f}')
+        for counter, value in counters.items():
+            lines += [f"# TYPE {self.prefix}_{counter}_total counter", f"{self.prefix}_{counter}_total {value}"]
+        samples = {} # Gauge name -> its sample lines; Prometheus wants each metric's samples grouped
+        for source, source_gauges in gauges.items():
+            labels = f'{{source="{source}"}}' if source is not None else ""
+            for gauge, value in source_gauges.items():
+                samples.setdefault(gauge, []).append(f"{self.prefix}_{gauge}{labels} {value}")
+        for gauge, gauge_lines in samples.items():
+            lines += [f"# TYPE {self.prefix}_{gauge} gauge", *gauge_lines]
+        return "\n".join(lines) + "\n"
+
+
+class StageTimer:
+    """Context manager recording the elapsed time of a block into `metrics` under `stage`."""
+
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+async def serve_metrics_http(metrics, host, port):
+    """Serves `metrics` as Prometheus text on http://host:port/metrics (stdlib only)."""
+
+    async def handle(reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Drain the request headers
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split('?')[0] == "/metrics":
+                body = metrics.render_prometheus().encode('utf-8')
+                status = "200 OK"
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            else:
+                body, status, content_type = b"Not Found\n", "404 Not Found", "text/plain"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logging.debug(f"Metrics endpoint: client error: {e}")
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logging.info(f"Metrics endpoint started on http://{host}:{port}/metrics")
+    return server
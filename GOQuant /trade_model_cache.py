@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Dependency-Tracked Model Cache for the Trade Simulator Backend
+
+Each cost model output is cached per (model, symbol) together with what it was
+computed from:
+
+    key           - the scalar inputs (parameter values, mid price, ...); any
+                    difference, e.g. after the UI changes a parameter, is a miss
+    book levels   - (side, version, depth price) triples: the entry stays valid
+                    while no level at the depth price or better changed on that
+                    side (see BookSide.unchanged_through)
+    book epoch    - the L2OrderBook it was computed on; a replacement book for
+                    the same symbol restarts its side versions, so it never hits
+
+so a tick whose book change lies deeper than a model reads reuses its output.
+"""
+
+MISS = object()
+
+
+class ModelCache:
+    """Latest output per (model, symbol), reused while its inputs are unchanged."""
+
+    def __init__(self):
+        self.entries = {} # (model, symbol) -> (key, book epoch, book_dependencies, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, model, order_book, key):
+        """Returns the cached value, or MISS if the key or any book level it read has changed."""
+        entry = self.entries.get((model, order_book.symbol))
+        if entry is not None and entry[0] == key and entry[1] == order_book.epoch:
+            for side_name, version, price in entry[2]:
+                if not getattr(order_book, side_name).unchanged_through(version, price):
+                    break
+            else:
+                self.hits += 1
+                return entry[3]
+        self.misses += 1
+        return MISS
+
+    def put(self, model, order_book, key, value, book_dependencies=()):
+        """Stores `value`; book_dependencies is an iterable of (side name, side version, depth price)."""
+        self.entries[(model, order_book.symbol)] = (key, order_book.epoch, tuple(book_dependencies), value)
+        return value
+
+    def cached(self, model, order_book, key, compute, book_dependencies=None):
+        """Returns the cached value for `model`, or calls compute() and caches it.
+
+        book_dependencies, if given, is called after compute() and returns the
+        book levels the value depends on.
+        """
+        value = self.get(model, order_book, key)
+        if value is MISS:
+            value = compute()
+            self.put(model, order_book, key, value, book_dependencies() if book_dependencies else ())
+        return value
+
+    def invalidate(self, symbol=None):
+        """Drops every entry (or just `symbol`'s)."""
+        if symbol is None:
+            self.entries.clear()
+        else:
+            self.entries = {k: v for k, v in self.entries.items() if k[1] != symbol}
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return round(self.hits / total, 4) if total else 0.0
+
+    def stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses, "hitRatio": self.hit_ratio()}
@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+"""Incremental L2 Order Book for the Trade Simulator Backend
+
+Keeps both sides of an instrument's book as sorted price levels in fixed-size
+NumPy buffers and applies OKX-style snapshot/update messages in place instead
+of overwriting the book with every message.
+"""
+
+# Levels are parsed to floats once, when a message is applied. Deltas are
+# validated against the feed's seqId/prevSeqId chain and CRC32 checksum when
+# the feed provides them; any inconsistency raises OrderBookOutOfSync so the
+# caller can resubscribe/reconnect and rebuild the book from a fresh snapshot.
+
+import itertools
+import logging
+import zlib
+from collections import deque
+from decimal import Decimal
+
+import numpy as np
+
+from trade_codec import decode_levels
+
+# OKX computes its checksum over the top 25 levels of each side
+CHECKSUM_DEPTH = 25
+# Number of levels kept in the cached top-of-book views
+TOP_LEVELS_CACHED = 25
+# Max levels held per side (OKX 'books' sends up to 400); ~40 KB per side
+DEFAULT_BOOK_CAPACITY = 1000
+# Recent changes remembered per side for BookSide.unchanged_through()
+CHANGE_LOG_SIZE = 64
+
+_book_epochs = itertools.count(1)
+
+
+class OrderBookOutOfSync(Exception):
+    """Raised when a message cannot be applied and the book needs a resync."""
+
+
+class BookSide:
+    """One side of the book, stored in preallocated NumPy price/qty buffers.
+
+    Levels live in buf[:n] sorted by ascending price, so the best ask is at
+    index 0 and the best bid at index n-1; best-first views of the bid side are
+    reversed (negative-stride) slices, so no reader ever copies the book. Memory
+    is fixed at construction: five float64 buffers of `capacity` levels. When a
+    side is full, the worst levels are dropped.
+    """
+
+    def __init__(self, is_bid, capacity=DEFAULT_BOOK_CAPACITY):
+        self.is_bid = is_bid
+        self.capacity = capacity
+        self._prices = np.full(capacity, np.inf) # Unused slots hold +inf so lookups can span the buffer
+        self._qtys = np.zeros(capacity, dtype=np.float64)
+        # Scratch/cache buffers for the cumulative depth used by walk_book
+        self._cum_qty = np.zeros(capacity, dtype=np.float64)
+        self._cum_notional = np.zeros(capacity, dtype=np.float64)
+        self._notional = np.zeros(capacity, dtype=np.float64)
+        self._n = 0
+        self.version = 0 # Bumped on every change; caches compare against it
+        # (version, most aggressive price touched by that change, or None if any level may have changed)
+        self._changes = deque(maxlen=CHANGE_LOG_SIZE)
+        self._top_cache = None
+        self._depth_cache = None
+
+    @property
+    def nbytes(self):
+        return 5 * self.capacity * 8
+
+    def _invalidate(self, touched_price=None):
+        self.version += 1
+        self._changes.append((self.version, touched_price))
+        self._top_cache = None
+        self._depth_cache = None
+
+    def clear(self):
+        self._prices[:self._n] = np.inf
+        self._n = 0
+        self._invalidate()
+
+    # --- Writes ---
+    def load(self, levels):
+        """Replaces the side with `levels`, an (m, 2) [price, qty] array in any order."""
+        # Last entry for a price wins; np.unique also sorts by price
+        prices, last = np.unique(levels[::-1, 0], return_index=True)
+        qtys = levels[::-1, 1][last]
+        live = qtys > 0
+        prices, qtys = prices[live], qtys[live]
+        if len(prices) > self.capacity:
+            logging.debug(f"Book side over capacity ({len(prices)} > {self.capacity}); dropping worst levels.")
+            # Keep the best `capacity` levels
+            keep = slice(len(prices) - self.capacity, None) if self.is_bid else slice(0, self.capacity)
+            prices, qtys = prices[keep], qtys[keep]
+        n = len(prices)
+        self._prices[:n] = prices
+        self._prices[n:] = np.inf
+        self._qtys[:n] = qtys
+        self._n = n
+        self._invalidate()
+
+    def apply_levels(self, levels):
+        """Applies an (m, 2) [price, qty] delta: updates, inserts, and deletes (qty <= 0)."""
+        m = len(levels)
+        if m == 0:
+            return
+        n = self._n
+        if n + m > self.capacity:
+            self._merge_levels(levels)
+            return
+        prices = self._prices
+        qtys = self._qtys
+        levels = levels[levels[:, 0].argsort(kind='stable')]
+        # One lookup against the current book; applying from the highest price
+        # down keeps every lower index valid while levels are shifted in place.
+        idx = prices.searchsorted(levels[:, 0])
+        found = prices.take(idx) == levels[:, 0]
+        level_list = levels.tolist()
+        last_price = None
+        for (price, qty), i, hit in zip(reversed(level_list), reversed(idx.tolist()), reversed(found.tolist())):
+            if price == last_price:
+                continue # Repeated price: the later update (seen first here) wins
+            last_price = price
+            if hit:
+                if qty > 0:
+                    qtys[i] = qty
+                else:
+                    prices[i:n - 1] = prices[i + 1:n]
+                    qtys[i:n - 1] = qtys[i + 1:n]
+                    n -= 1
+                    prices[n] = np.inf
+            elif qty > 0:
+                prices[i + 1:n + 1] = prices[i:n]
+                qtys[i + 1:n + 1] = qtys[i:n]
+                prices[i] = price
+                qtys[i] = qty
+                n += 1
+        self._n = n
+        self._invalidate(level_list[-1][0] if self.is_bid else level_list[0][0])
+
+    def _merge_levels(self, levels):
+        # Vectorized path for deltas that may overflow the side: rebuild the
+        # levels in one merge, then keep the best `capacity`.
+        n = self._n
+        merged = np.concatenate((np.column_stack((self._prices[:n], self._qtys[:n])), levels))
+        self.load(merged)
+
+    def set_level(self, price, qty):
+        """Inserts, updates or (qty <= 0) deletes the level at `price`."""
+        self.apply_levels(np.array([[price, qty]], dtype=np.float64))
+
+    # --- Reads ---
+    def unchanged_through(self, version, price):
+        """True if no level at `price` or better has changed since `version` (price None = any level)."""
+        if version == self.version:
+            return True
+        if not self._changes or self._changes[0][0] > version + 1:
+            return False # Changes older than the log may have touched anything
+        for change_version, touched in reversed(self._changes):
+            if change_version <= version:
+                break
+            if price is None or touched is None or (touched >= price if self.is_bid else touched <= price):
+                return False
+        return True
+
+    def prices_view(self):
+        """Zero-copy view of the level prices, best first."""
+        view = self._prices[:self._n]
+        return view[::-1] if self.is_bid else view
+
+    def qtys_view(self):
+        """Zero-copy view of the level quantities, best first."""
+        view = self._qtys[:self._n]
+        return view[::-1] if self.is_bid else view
+
+    def best(self):
+        """Returns (price, qty) of the best level, or None if the side is empty."""
+        if self._n == 0:
+            return None
+        i = self._n - 1 if self.is_bid else 0
+        return float(self._prices[i]), float(self._qtys[i])
+
+    def top(self, n):
+        """Returns up to `n` best levels as [[price, qty], ...], best first."""
+        if n <= TOP_LEVELS_CACHED:
+            if self._top_cache is None:
+                k = min(TOP_LEVELS_CACHED, self._n)
+                self._top_cache = np.column_stack((self.prices_view()[:k], self.qtys_view()[:k])).tolist()
+            return self._top_cache[:n]
+        k = min(n, self._n)
+        return np.column_stack((self.prices_view()[:k], self.qtys_view()[:k])).tolist()
+
+    def depth_arrays(self):
+        """Returns (prices, cum_qty, cum_notional) arrays, best level first.
+
+        All three are views into this side's buffers, recomputed at most once
+        per book change; callers must not mutate them or hold them across updates.
+        """
+        if self._depth_cache is None:
+            n = self._n
+            prices = self.prices_view()
+            qtys = self.qtys_view()
+            np.cumsum(qtys, out=self._cum_qty[:n])
+            np.multiply(prices, qtys, out=self._notional[:n])
+            np.cumsum(self._notional[:n], out=self._cum_notional[:n])
+            self._depth_cache = (prices, self._cum_qty[:n], self._cum_notional[:n])
+        return self._depth_cache
+
+    def qty_at(self, price):
+        """Returns the quantity resting at exactly `price` (0.0 if there is no such level)."""
+        i = int(np.searchsorted(self._prices[:self._n], price))
+        if i < self._n and self._prices[i] == price:
+            return float(self._qtys[i])
+        return 0.0
+
+    def depth_better_than(self, prices, inclusive=False):
+        """Total quantity at levels strictly better than each of `prices` (at or better if inclusive)."""
+        prices = np.asarray(prices, dtype=np.float64)
+        n = self._n
+        if n == 0:
+            return np.zeros(prices.shape)
+        ascending = self._prices[:n]
+        if self.is_bid:
+            # Better bids are the highest prices, i.e. the tail of the ascending buffer
+            count = n - np.searchsorted(ascending, prices, side='left' if inclusive else 'right')
+        else:
+            count = np.searchsorted(ascending, prices, side='right' if inclusive else 'left')
+        cum_qty = self.depth_arrays()[1]
+        return np.where(count > 0, cum_qty[np.maximum(count - 1, 0)], 0.0)
+
+    def copy(self, capacity=None):
+        """Returns an independent copy holding the same levels (capacity defaults to the current depth)."""
+        n = self._n
+        side = BookSide(self.is_bid, capacity=max(capacity or n, n, 1))
+        side._prices[:n] = self._prices[:n]
+        side._qtys[:n] = self._qtys[:n]
+        side._n = n
+        # Versions carry over so dependency checks keep working across snapshots
+        side.version = self.version
+        side._changes = self._changes.copy()
+        return side
+
+    def __len__(self):
+        return self._n
+
+
+def walk_book(side, quantities):
+    """Fills each of `quantities` (asset units) against `side`, best level first.
+
+    Returns (vwap, filled_qty) arrays shaped like `quantities`. Each lookup is a
+    searchsorted over the cached cumulative depth, so a whole slippage curve
+    costs one vectorized pass. If the book is too thin, filled_qty is capped at
+    the total depth; vwap is NaN where nothing could be filled.
+    """
+    quantities = np.asarray(quantities, dtype=np.float64)
+    prices, cum_qty, cum_notional = side.depth_arrays()
+    if len(prices) == 0:
+        return np.full(quantities.shape, np.nan), np.zeros(quantities.shape)
+
+    filled = np.clip(quantities, 0.0, cum_qty[-1])
+    # Index of the level that completes each fill
+    idx = np.minimum(np.searchsorted(cum_qty, filled, side='left'), len(prices) - 1)
+    qty_before = np.where(idx > 0, cum_qty[idx - 1], 0.0)
+    notional_before = np.where(idx > 0, cum_notional[idx - 1], 0.0)
+    notional = notional_before + (filled - qty_before) * prices[idx]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vwap = np.where(filled > 0, notional / filled, np.nan)
+    return vwap, filled
+
+
+def fill_depth_price(side, quantity):
+    """Price of the deepest level a fill of `quantity` reads, or None if it exceeds the visible depth."""
+    prices, cum_qty, _ = side.depth_arrays()
+    if len(prices) == 0 or quantity > cum_qty[-1]:
+        return None
+    return float(prices[np.searchsorted(cum_qty, quantity, side='left')])
+
+
+def _checksum_str(value):
+    """Formats a float the way OKX prints prices/sizes (no exponent, no trailing zeros)."""
+    s = format(Decimal(repr(value)), 'f')
+    if '.' in s:
+        s = s.rstrip('0').rstrip('.')
+    return s
+
+
+def okx_checksum(bids, asks):
+    """Computes the OKX order book checksum (signed CRC32) from top levels."""
+    parts = []
+    for i in range(max(len(bids), len(asks))):
+        if i < len(bids):
+            parts.append(_checksum_str(bids[i][0]))
+            parts.append(_checksum_str(bids[i][1]))
+        if i < len(asks):
+            parts.append(_checksum_str(asks[i][0]))
+            parts.append(_checksum_str(asks[i][1]))
+    crc = zlib.crc32(':'.join(parts).encode('ascii'))
+    return crc - (1 << 32) if crc >= (1 << 31) else crc
+
+
+class L2OrderBook:
+    """Incrementally maintained L2 order book for a single instrument."""
+
+    def __init__(self, symbol=None, capacity=DEFAULT_BOOK_CAPACITY):
+        self.symbol = symbol
+        # Distinguishes this book from earlier ones of the same symbol (whose side versions also start at 0)
+        self.epoch = next(_book_epochs)
+        self.bids = BookSide(is_bid=True, capacity=capacity)
+        self.asks = BookSide(is_bid=False, capacity=capacity)
+        self.okx_ts = None
+        self.seq_id = None
+        self.has_snapshot = False
+        # Optional listener (e.g. LimitOrderSimulator) told about each side's levels
+        # before they are applied (on_levels) and after every message (on_message_applied)
+        self.order_tracker = None
+        # Feed-derived model inputs (e.g. trade_tick_store.LiveEstimates), carried into snapshots
+        self.live_estimates = None
+
+    def reset(self):
+        """Drops all levels; the next message applied must be a snapshot."""
+        self.bids.clear()
+        self.asks.clear()
+        self.seq_id = None
+        self.has_snapshot = False
+
+    # --- Reads ---
+    def best_bid(self):
+        return self.bids.best()
+
+    def best_ask(self):
+        return self.asks.best()
+
+    def top_bids(self, n=5):
+        return self.bids.top(n)
+
+    def top_asks(self, n=5):
+        return self.asks.top(n)
+
+    @property
+    def nbytes(self):
+        """Fixed memory held by the level buffers of both sides."""
+        return self.asks.nbytes + self.bids.nbytes
+
+    def is_ready(self):
+        """True once a snapshot has been applied and both sides have levels."""
+        return self.has_snapshot and len(self.bids) > 0 and len(self.asks) > 0
+
+    def snapshot(self):
+        """Returns a detached copy sized to the current depth (safe to pickle to a worker process)."""
+        book = L2OrderBook(self.symbol, capacity=1)
+        book.epoch = self.epoch
+        book.bids = self.bids.copy()
+        book.asks = self.asks.copy()
+        book.okx_ts = self.okx_ts
+        book.seq_id = self.seq_id
+        book.has_snapshot = self.has_snapshot
+        book.live_estimates = self.live_estimates
+        if self.order_tracker is not None:
+            book.order_tracker = self.order_tracker.snapshot()
+        return book
+
+    # --- Writes ---
+    def apply_snapshot(self, asks, bids, ts=None, seq_id=None, checksum=None):
+        """Replaces the whole book with the given levels."""
+        asks, bids = decode_levels(asks), decode_levels(bids)
+        if self.order_tracker is not None:
+            self.order_tracker.on_levels(self, 'asks', asks, True)
+            self.order_tracker.on_levels(self, 'bids', bids, True)
+        self.asks.load(asks)
+        self.bids.load(bids)
+        self.has_snapshot = True
+        self._finish_message(ts, seq_id, checksum)
+
+    def apply_update(self, asks, bids, ts=None, seq_id=None, prev_seq_id=None, checksum=None):
+        """Applies a delta; levels with qty 0 are removed."""
+        if not self.has_snapshot:
+            raise OrderBookOutOfSync("Received update before any snapshot")
+        if prev_seq_id is not None and self.seq_id is not None and int(prev_seq_id) != self.seq_id:
+            raise OrderBookOutOfSync(f"Sequence gap: expected prevSeqId {self.seq_id}, got {prev_seq_id}")
+        self._apply_levels(asks, bids)
+        self._finish_message(ts, seq_id, checksum)
+
+    def apply_message(self, action, payload):
+        """Applies an OKX-style data payload ('asks', 'bids', 'ts', 'seqId', ...)."""
+        fields = dict(
+            ts=payload.get('ts'),
+            seq_id=payload.get('seqId'),
+            checksum=payload.get('checksum'),
+        )
+        if action == "snapshot":
+            self.apply_snapshot(payload.get('asks', []), payload.get('bids', []), **fields)
+        elif action == "update":
+            self.apply_update(payload.get('asks', []), payload.get('bids', []),
+                              prev_seq_id=payload.get('prevSeqId'), **fields)
+        else:
+            raise ValueError(f"Unknown order book action '{action}'")
+
+    def _apply_levels(self, asks, bids):
+        # Levels are [price, qty, ...] with numeric strings (OKX) or numbers, or
+        # already-decoded (n, 2) arrays; either way they are parsed exactly once here
+        asks, bids = decode_levels(asks), decode_levels(bids)
+        if self.order_tracker is not None:
+            self.order_tracker.on_levels(self, 'asks', asks, False)
+            self.order_tracker.on_levels(self, 'bids', bids, False)
+        self.asks.apply_levels(asks)
+        self.bids.apply_levels(bids)
+
+    def _finish_message(self, ts, seq_id, checksum):
+        if ts is not None:
+            self.okx_ts = ts
+        if seq_id is not None:
+            self.seq_id = int(seq_id)
+        if checksum is not None:
+            expected = int(checksum)
+            actual = okx_checksum(self.bids.top(CHECKSUM_DEPTH), self.asks.top(CHECKSUM_DEPTH))
+            if actual != expected:
+                raise OrderBookOutOfSync(f"Checksum mismatch: expected {expected}, computed {actual}")
+        best_bid, best_ask = self.bids.best(), self.asks.best()
+        if best_bid and best_ask and best_bid[0] >= best_ask[0]:
+            logging.debug(f"Order book for {self.symbol} is crossed: bid {best_bid[0]} >= ask {best_ask[0]}")
+        if self.order_tracker is not None:
+            self.order_tracker.on_message_applied(self)
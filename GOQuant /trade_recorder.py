@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""L2 Feed Record-and-Replay for the Trade Simulator Backend
+
+FeedRecorder appends raw feed messages, stamped with their receive time, to a
+compact append-only file; replay_feed() reads them back either at wall-clock
+speed or as fast as possible, so a session can be reproduced or backtested
+without any network.
+
+File layout (all integers little-endian):
+  <path>       b"L2REC1\\n" header, then chunks of [uint32 length][zlib data].
+               Decompressed chunk = records of
+               [int64 recv_ts_ns][uint16 symbol_len][uint32 msg_len][symbol][msg].
+  <path>.idx   one entry per chunk: [int64 first_ts_ns][int64 last_ts_ns]
+               [uint64 chunk_offset][uint32 record_count]. Rebuilt by scanning
+               the data file if it is missing or shorter than the data.
+"""
+
+import asyncio
+import logging
+import os
+import struct
+import time
+import zlib
+
+FILE_MAGIC = b"L2REC1\n"
+CHUNK_HEADER = struct.Struct('<I')
+RECORD_HEADER = struct.Struct('<qHI')
+INDEX_ENTRY = struct.Struct('<qqQI')
+
+# Flush a chunk once it holds this many records/bytes or is this old
+DEFAULT_CHUNK_RECORDS = 2000
+DEFAULT_CHUNK_BYTES = 1 << 20
+DEFAULT_FLUSH_INTERVAL_S = 1.0
+DEFAULT_COMPRESS_LEVEL = 3
+
+
+class FeedRecorder:
+    """Appends raw feed messages to a chunked, compressed, time-indexed recording."""
+
+    def __init__(self, path, chunk_records=DEFAULT_CHUNK_RECORDS, chunk_bytes=DEFAULT_CHUNK_BYTES,
+                 flush_interval_s=DEFAULT_FLUSH_INTERVAL_S, compress_level=DEFAULT_COMPRESS_LEVEL):
+        self.path = path
+        self.chunk_records = chunk_records
+        self.chunk_bytes = chunk_bytes
+        self.flush_interval_s = flush_interval_s
+        self.compress_level = compress_level
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._data_file = open(path, 'ab')
+        if is_new:
+            self._data_file.write(FILE_MAGIC)
+        self._index_file = open(path + '.idx', 'ab')
+        self._buffer = bytearray()
+        self._buffer_records = 0
+        self._first_ts_ns = None
+        self._last_ts_ns = None
+        self._last_flush = time.monotonic()
+        self.records_written = 0
+        logging.info(f"Recording L2 feed messages to {path}")
+
+    def record(self, symbol, message_raw, recv_ts_ns=None):
+        """Buffers one raw message; flushes a chunk when size/count/age limits are hit."""
+        if recv_ts_ns is None:
+            recv_ts_ns = time.time_ns()
+        symbol_bytes = symbol.encode('utf-8')
+        message_bytes = message_raw.encode('utf-8') if isinstance(message_raw, str) else message_raw
+        self._buffer += RECORD_HEADER.pack(recv_ts_ns, len(symbol_bytes), len(message_bytes))
+        self._buffer += symbol_bytes
+        self._buffer += message_bytes
+        self._buffer_records += 1
+        if self._first_ts_ns is None:
+            self._first_ts_ns = recv_ts_ns
+        self._last_ts_ns = recv_ts_ns
+        if (self._buffer_records >= self.chunk_records or len(self._buffer) >= self.chunk_bytes
+                or time.monotonic() - self._last_flush >= self.flush_interval_s):
+            self.flush()
+
+    def flush(self):
+        """Compresses the buffered records into one chunk and indexes it."""
+        self._last_flush = time.monotonic()
+        if not self._buffer_records:
+            return
+        compressed = zlib.compress(bytes(self._buffer), self.compress_level)
+        offset = self._data_file.tell()
+        self._data_file.write(CHUNK_HEADER.pack(len(compressed)))
+        self._data_file.write(compressed)
+        self._data_file.flush()
+        self._index_file.write(INDEX_ENTRY.pack(self._first_ts_ns, self._last_ts_ns, offset, self._buffer_records))
+        self._index_file.flush()
+        self.records_written += self._buffer_records
+        self._buffer.clear()
+        self._buffer_records = 0
+        self._first_ts_ns = None
+        self._last_ts_ns = None
+
+    def close(self):
+        self.flush()
+        self._data_file.close()
+        self._index_file.close()
+        logging.info(f"Closed feed recording {self.path} ({self.records_written} messages)")
+
+
+class FeedRecording:
+    """Read access to a recording written by FeedRecorder."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+                raise ValueError(f"{path} is not an L2 feed recording")
+        self.index = self._load_index()
+
+    def _load_index(self):
+        entries = []
+        try:
+            with open(self.path + '.idx', 'rb') as f:
+                data = f.read()
+            usable = len(data) - len(data) % INDEX_ENTRY.size
+            entries = [INDEX_ENTRY.unpack_from(data, pos) for pos in range(0, usable, INDEX_ENTRY.size)]
+        except FileNotFoundError:
+            pass
+        # The index is only trusted if it covers the data file exactly
+        expected_end = len(FILE_MAGIC)
+        if entries:
+            with open(self.path, 'rb') as f:
+                f.seek(entries[-1][2])
+                header = f.read(CHUNK_HEADER.size)
+                if len(header) == CHUNK_HEADER.size:
+                    expected_end = entries[-1][2] + CHUNK_HEADER.size + CHUNK_HEADER.unpack(header)[0]
+        if not entries or expected_end != os.path.getsize(self.path):
+            logging.warning(f"Index for {self.path} missing or stale; rebuilding from chunks.")
+            entries = self._rebuild_index()
+        return entries
+
+    def _rebuild_index(self):
+        entries = []
+        for offset, records in self._scan_chunks():
+            if records:
+                entries.append((records[0][0], records[-1][0], offset, len(records)))
+        return entries
+
+    def _scan_chunks(self, start_offset=None):
+        """Yields (offset, records) for each complete chunk from `start_offset` on."""
+        with open(self.path, 'rb') as f:
+            f.seek(start_offset if start_offset is not None else len(FILE_MAGIC))
+            while True:
+                offset = f.tell()
+                header = f.read(CHUNK_HEADER.size)
+                if len(header) < CHUNK_HEADER.size:
+                    return
+                (length,) = CHUNK_HEADER.unpack(header)
+                compressed = f.read(length)
+                if len(compressed) < length:
+                    logging.warning(f"Truncated chunk at offset {offset} in {self.path}; stopping.")
+                    return
+                yield offset, _decode_chunk(zlib.decompress(compressed))
+
+    @property
+    def start_ns(self):
+        return self.index[0][0] if self.index else None
+
+    @property
+    def end_ns(self):
+        return self.index[-1][1] if self.index else None
+
+    def iter_records(self, start_ns=None, end_ns=None):
+        """Yields (recv_ts_ns, symbol, message_raw) in file order, optionally bounded by receive time."""
+        first_offset = None
+        for first_ts, last_ts, offset, _ in self.index:
+            if start_ns is None or last_ts >= start_ns:
+                first_offset = offset
+                break
+        if first_offset is None:
+            return
+        for _, records in self._scan_chunks(first_offset):
+            for recv_ts_ns, symbol, message_raw in records:
+                if start_ns is not None and recv_ts_ns < start_ns:
+                    continue
+                if end_ns is not None and recv_ts_ns > end_ns:
+                    return
+                yield recv_ts_ns, symbol, message_raw
+
+
+def _decode_chunk(data):
+    records = []
+    pos = 0
+    end = len(data)
+    while pos < end:
+        recv_ts_ns, symbol_len, msg_len = RECORD_HEADER.unpack_from(data, pos)
+        pos += RECORD_HEADER.size
+        symbol = data[pos:pos + symbol_len].decode('utf-8')
+        pos += symbol_len
+        message_raw = data[pos:pos + msg_len].decode('utf-8')
+        pos += msg_len
+        records.append((recv_ts_ns, symbol, message_raw))
+    return records
+
+
+async def replay_feed(path, speed=1.0, start_ns=None, end_ns=None, yield_every=500):
+    """Async generator over a recording's (recv_ts_ns, symbol, message_raw).
+
+    speed > 0 paces messages by their recorded receive times (2.0 = twice as fast);
+    speed <= 0/None replays as fast as possible, yielding to the event loop every
+    `yield_every` messages so other tasks are not starved.
+    """
+    recording = FeedRecording(path)
+    wall_start = time.monotonic()
+    first_ts_ns = None
+    for count, (recv_ts_ns, symbol, message_raw) in enumerate(recording.iter_records(start_ns, end_ns)):
+        if speed and speed > 0:
+            if first_ts_ns is None:
+                first_ts_ns = recv_ts_ns
+            delay = (recv_ts_ns - first_ts_ns) / 1e9 / speed - (time.monotonic() - wall_start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif count % yield_every == 0:
+            await asyncio.sleep(0)
+        yield recv_ts_ns, symbol, message_raw
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""Sharded Multi-Process Mode for the Trade Simulator Backend
+
+With --shards N the instruments are split across N worker processes. Each
+worker runs the normal pipeline (feed -> order book -> cost models, from
+trade_backend) for its own instruments only, and publishes per instrument
+into shared memory:
+
+    ticks  - the encoded UI tick frame, forwarded to clients as-is
+    book   - the top BOOK_LEVELS levels of each side, the live volatility/ADV
+             estimates, and the simulated UI limit order while order_type is
+             'limit' (for scenario grids)
+
+and per worker its exported pipeline metrics, which the front merges into its
+own /metrics endpoint and UI latency summary.
+
+The front process (ShardFront) serves the UI websocket: it polls the rings and
+forwards new ticks to subscribed clients, rebuilds a book from shared memory
+when a client asks for a scenario grid, and pushes parameter changes to the
+workers through a shared parameter slot. It never parses feed messages or runs
+the models, so the system scales with cores, and a hot instrument only loads
+the worker it lives on.
+
+Shared memory layout (SeqlockRing, little-endian):
+
+    header   [uint64 published][uint32 slots][uint32 slot_bytes]
+    slot i   [uint64 sequence][uint32 length][slot_bytes payload]
+
+One writer per ring. The writer makes a slot's sequence odd, writes the
+payload, and makes it even again; readers copy the payload and retry if the
+sequence changed meanwhile, so readers never block the writer (or each other).
+"""
+
+import asyncio
+import logging
+import pickle
+import signal
+import struct
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from trade_codec import dumps, loads
+from trade_compute import ComputeStage, spawn_context
+from trade_order_book import L2OrderBook
+
+RING_HEADER = struct.Struct('<QII')
+SLOT_HEADER = struct.Struct('<QI')
+SEQUENCE = struct.Struct('<Q')
+MAX_READ_RETRIES = 100
+
+TICK_SLOTS = 4
+TICK_SLOT_BYTES = 64 * 1024
+BOOK_LEVELS = 400 # Levels per side published for scenario grids
+BOOK_HEADER = struct.Struct('<qIII') # ts (ms, -1 if unknown), bid levels, ask levels, extras bytes
+BOOK_EXTRAS_BYTES = 16 * 1024 # Room for the pickled (LimitOrderSimulator snapshot, live estimates)
+BOOK_SLOT_BYTES = BOOK_HEADER.size + 4 * BOOK_LEVELS * 8 + BOOK_EXTRAS_BYTES
+PARAMS_SLOT_BYTES = 64 * 1024
+METRICS_SLOT_BYTES = 256 * 1024
+METRICS_PUBLISH_INTERVAL_S = 1.0
+# How often workers check for parameter changes and the front checks its workers (seconds)
+PARAMS_POLL_INTERVAL_S = 0.05
+SUPERVISE_INTERVAL_S = 1.0
+# How long a stopping worker gets to flush its tick stores before it is terminated (seconds)
+WORKER_STOP_TIMEOUT_S = 5.0
+
+
+class SeqlockRing:
+    """Ring of fixed-size message slots in shared memory; one writer, any number of readers."""
+
+    def __init__(self, name=None, slots=TICK_SLOTS, slot_bytes=TICK_SLOT_BYTES, create=False):
+        if create:
+            size = RING_HEADER.size + slots * (SLOT_HEADER.size + slot_bytes)
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self.shm.buf[:size] = bytes(size)
+            RING_HEADER.pack_into(self.shm.buf, 0, 0, slots, slot_bytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        _, self.slots, self.slot_bytes = RING_HEADER.unpack_from(self.shm.buf, 0)
+        self.created = create
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def _slot_offset(self, index):
+        return RING_HEADER.size + (index % self.slots) * (SLOT_HEADER.size + self.slot_bytes)
+
+    def published(self):
+        """Number of messages written so far (changes whenever a new one is available)."""
+        return SEQUENCE.unpack_from(self.shm.buf, 0)[0]
+
+    def publish(self, payload):
+        """Writes `payload` (bytes-like) into the next slot; returns the new published count.
+
+        Raises ValueError if the payload is larger than a slot (writers check slot_bytes first).
+        """
+        length = len(payload)
+        if length > self.slot_bytes:
+            raise ValueError(f"Message of {length} bytes exceeds the {self.slot_bytes}-byte slot of {self.name}")
+        buf = self.shm.buf
+        published = SEQUENCE.unpack_from(buf, 0)[0]
+        offset = self._slot_offset(published)
+        sequence = SEQUENCE.unpack_from(buf, offset)[0]
+        SLOT_HEADER.pack_into(buf, offset, sequence + 1, length) # Odd: being written
+        start = offset + SLOT_HEADER.size
+        buf[start:start + length] = payload
+        SEQUENCE.pack_into(buf, offset, sequence + 2)
+        SEQUENCE.pack_into(buf, 0, published + 1)
+        return published + 1
+
+    def read_latest(self):
+        """Returns (published count, payload bytes) of the newest message, or (0, None) if there is none."""
+        buf = self.shm.buf
+        for _ in range(MAX_READ_RETRIES):
+            published = SEQUENCE.unpack_from(buf, 0)[0]
+            if not published:
+                return 0, None
+            offset = self._slot_offset(published - 1)
+            sequence, length = SLOT_HEADER.unpack_from(buf, offset)
+            if sequence & 1:
+                continue # Being overwritten (the writer lapped the ring); the newer one is coming
+            start = offset + SLOT_HEADER.size
+            payload = bytes(buf[start:start + length])
+            if SEQUENCE.unpack_from(buf, offset)[0] == sequence:
+                return published, payload
+        return 0, None
+
+    def close(self):
+        self.shm.close()
+        if self.created:
+            self.shm.unlink()
+
+
+# --- Book Encoding ---
+def encode_book(order_book, levels=BOOK_LEVELS, tracker=None):
+    """Packs the top `levels` of each side (best first) with the book timestamp.
+
+    `tracker` (a LimitOrderSimulator snapshot) and the book's live estimates are
+    pickled after the levels; the tracker is left out if they don't fit in
+    BOOK_EXTRAS_BYTES.
+    """
+    bids, asks = order_book.bids, order_book.asks
+    n_bids, n_asks = min(levels, len(bids)), min(levels, len(asks))
+    try:
+        ts = int(order_book.okx_ts) if order_book.okx_ts is not None else -1
+    except (ValueError, TypeError):
+        ts = -1
+    extras_bytes = b''
+    if tracker is not None or order_book.live_estimates is not None:
+        extras_bytes = pickle.dumps((tracker, order_book.live_estimates), protocol=pickle.HIGHEST_PROTOCOL)
+        if len(extras_bytes) > BOOK_EXTRAS_BYTES:
+            extras_bytes = pickle.dumps((None, order_book.live_estimates), protocol=pickle.HIGHEST_PROTOCOL)
+    return b''.join((
+        BOOK_HEADER.pack(ts, n_bids, n_asks, len(extras_bytes)),
+        bids.prices_view()[:n_bids].tobytes(), bids.qtys_view()[:n_bids].tobytes(),
+        asks.prices_view()[:n_asks].tobytes(), asks.qtys_view()[:n_asks].tobytes(),
+        extras_bytes,
+    ))
+
+
+def decode_book(symbol, payload):
+    """Rebuilds a detached L2OrderBook from encode_book() output."""
+    ts, n_bids, n_asks, extras_size = BOOK_HEADER.unpack_from(payload, 0)
+    values = np.frombuffer(payload, dtype=np.float64, count=2 * (n_bids + n_asks), offset=BOOK_HEADER.size)
+    bid_prices, bid_qtys = values[:n_bids], values[n_bids:2 * n_bids]
+    ask_prices, ask_qtys = values[2 * n_bids:2 * n_bids + n_asks], values[2 * n_bids + n_asks:]
+    book = L2OrderBook(symbol, capacity=max(n_bids, n_asks, 1))
+    book.apply_snapshot(np.column_stack((ask_prices, ask_qtys)), np.column_stack((bid_prices, bid_qtys)),
+                        ts=str(ts) if ts >= 0 else None)
+    if extras_size:
+        # Attached after the snapshot, so the tracker's state is not re-derived from these levels
+        book.order_tracker, book.live_estimates = pickle.loads(payload[len(payload) - extras_size:])
+    return book
+
+
+# --- Worker Process ---
+def run_shard_worker(shard_id, feeds, ring_names, params_ring_name, metrics_ring_name, stop_event,
+                     compute_rate_hz=0.0, tick_store_dir=None):
+    """Entry point of a shard worker process: streams `feeds` and publishes into the shared rings.
+
+    ring_names maps symbol -> (tick ring name, book ring name). The worker shuts
+    down cleanly (flushing its tick stores) when `stop_event` is set or on SIGTERM.
+    """
+    # Imported here: the front process runs trade_backend as __main__, and only workers need it
+    import trade_backend as backend
+    try:
+        asyncio.run(_shard_worker_loop(backend, shard_id, feeds, ring_names, params_ring_name, metrics_ring_name,
+                                       stop_event, compute_rate_hz, tick_store_dir))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _shard_worker_loop(backend, shard_id, feeds, ring_names, params_ring_name, metrics_ring_name, stop_event,
+                             compute_rate_hz, tick_store_dir):
+    tick_rings = {symbol: SeqlockRing(names[0]) for symbol, names in ring_names.items()}
+    book_rings = {symbol: SeqlockRing(names[1]) for symbol, names in ring_names.items()}
+    params_ring = SeqlockRing(params_ring_name)
+    metrics_ring = SeqlockRing(metrics_ring_name)
+    backend.tick_store_dir = tick_store_dir
+
+    def compute(order_book, params, start_time):
+        tick = backend.compute_tick_output(order_book, params, start_time)
+        if tick is not None and order_book.symbol in book_rings:
+            # The UI limit order only exists here; grids in the front need it for the fee split
+            tracker = order_book.order_tracker
+            snapshot = tracker.snapshot() if params['order_type'] == 'limit' and tracker is not None else None
+            book_rings[order_book.symbol].publish(encode_book(order_book, tracker=snapshot))
+        return tick
+
+    oversized = dict.fromkeys(tick_rings, 0) # Frames dropped per symbol for not fitting a slot
+
+    def publish(tick, symbol):
+        ring = tick_rings.get(symbol)
+        if ring is None: # Feeds may carry other instruments; only configured ones have rings
+            return
+        frame = backend.tick_frame_encoder.encode(tick).encode('utf-8')
+        if len(frame) > ring.slot_bytes:
+            oversized[symbol] += 1
+            if oversized[symbol] == 1 or oversized[symbol] % 1000 == 0:
+                logging.warning(f"Shard {shard_id}: dropped {oversized[symbol]} {symbol} tick frame(s) larger "
+                                f"than the {ring.slot_bytes}-byte slot (latest {len(frame)} bytes)")
+            return
+        ring.publish(frame)
+
+    stopping = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+    except (NotImplementedError, RuntimeError): # No signal handlers on this platform/thread
+        pass
+
+    async def follow_front():
+        seen = 0
+        while not stop_event.is_set():
+            published, payload = params_ring.read_latest()
+            if published != seen and payload is not None:
+                seen = published
+                backend.simulation_params.update(loads(payload))
+            await asyncio.sleep(PARAMS_POLL_INTERVAL_S)
+        stopping.set()
+
+    async def publish_metrics():
+        while True:
+            await asyncio.sleep(METRICS_PUBLISH_INTERVAL_S)
+            payload = dumps(backend.pipeline_metrics.export()).encode('utf-8')
+            if len(payload) > metrics_ring.slot_bytes:
+                logging.warning(f"Shard {shard_id}: metrics export of {len(payload)} bytes does not fit its slot")
+                continue
+            metrics_ring.publish(payload)
+
+    # The worker process is the isolation boundary: models run on its own event loop
+    backend.compute_stage = ComputeStage(compute, publish, backend.simulation_params, mode='loop',
+                                         max_rate_hz=compute_rate_hz, metrics=backend.pipeline_metrics)
+    backend.compute_stage.start()
+    tasks = [asyncio.create_task(follow_front()), asyncio.create_task(backend.flush_tick_stores()),
+             asyncio.create_task(publish_metrics())]
+    feed_manager = backend.FeedManager(dict(feeds))
+    feed_manager.start()
+    logging.info(f"Shard {shard_id}: streaming {', '.join(feeds)}")
+    feeds_task = asyncio.create_task(feed_manager.wait())
+    stop_task = asyncio.create_task(stopping.wait())
+    try:
+        await asyncio.wait((feeds_task, stop_task), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        logging.info(f"Shard {shard_id}: stopping")
+        for task in (*tasks, feeds_task, stop_task):
+            task.cancel()
+        await feed_manager.stop()
+        await backend.compute_stage.stop()
+        backend.close_tick_stores()
+        for ring in (*tick_rings.values(), *book_rings.values(), params_ring, metrics_ring):
+            ring.close()
+
+
+# --- Front Process ---
+class ShardFront:
+    """Owns the shared rings and shard worker processes; the front process reads ticks and books from them."""
+
+    def __init__(self, feeds, shard_count, compute_rate_hz=0.0, tick_store_dir=None):
+        self.feeds = dict(feeds) # symbol -> endpoint
+        self.shard_count = max(1, min(shard_count, len(self.feeds)))
+        self.compute_rate_hz = compute_rate_hz
+        self.tick_store_dir = tick_store_dir
+        symbols = list(self.feeds)
+        self.assignments = [symbols[i::self.shard_count] for i in range(self.shard_count)] # Round-robin
+        self.tick_rings = {s: SeqlockRing(create=True) for s in symbols}
+        self.book_rings = {s: SeqlockRing(slots=2, slot_bytes=BOOK_SLOT_BYTES, create=True) for s in symbols}
+        self.params_ring = SeqlockRing(slots=2, slot_bytes=PARAMS_SLOT_BYTES, create=True)
+        self.metrics_rings = [SeqlockRing(slots=2, slot_bytes=METRICS_SLOT_BYTES, create=True)
+                              for _ in range(self.shard_count)]
+        self._metrics_cache = [(0, None)] * self.shard_count # (published count, decoded export) per shard
+        self.processes = [None] * self.shard_count
+        self.restarts = 0
+        self._seen = dict.fromkeys(symbols, 0)
+        self._params_json = None
+        self._book_cache = {} # symbol -> (published count, L2OrderBook)
+        self._last_supervised = 0.0
+        self._context = spawn_context()
+        self.stop_events = [self._context.Event() for _ in range(self.shard_count)]
+
+    def _start_worker(self, shard_id):
+        symbols = self.assignments[shard_id]
+        process = self._context.Process(
+            target=run_shard_worker, name=f"shard-{shard_id}", daemon=True,
+            args=(shard_id, {s: self.feeds[s] for s in symbols},
+                  {s: (self.tick_rings[s].name, self.book_rings[s].name) for s in symbols},
+                  self.params_ring.name, self.metrics_rings[shard_id].name, self.stop_events[shard_id],
+                  self.compute_rate_hz, self.tick_store_dir))
+        process.start()
+        self.processes[shard_id] = process
+
+    def start(self, params):
+        self.push_params(params) # Workers read the current parameters as soon as they start
+        for shard_id in range(self.shard_count):
+            self._start_worker(shard_id)
+        logging.info(f"Started {self.shard_count} shard workers: "
+                     + "; ".join(f"{i}: {', '.join(s)}" for i, s in enumerate(self.assignments)))
+
+    def push_params(self, params):
+        """Publishes the parameters to the workers if they changed since the last push."""
+        params_json = dumps(params)
+        if params_json != self._params_json:
+            self.params_ring.publish(params_json.encode('utf-8'))
+            self._params_json = params_json
+
+    def poll(self):
+        """Returns [(symbol, encoded tick frame)] for every instrument with a tick newer than the last poll."""
+        updates = []
+        for symbol, ring in self.tick_rings.items():
+            if ring.published() != self._seen[symbol]:
+                published, payload = ring.read_latest()
+                if payload is not None:
+                    self._seen[symbol] = published
+                    updates.append((symbol, payload.decode('utf-8')))
+        return updates
+
+    def book(self, symbol):
+        """Latest published book for `symbol` as a detached L2OrderBook, or None."""
+        ring = self.book_rings.get(symbol)
+        if ring is None:
+            return None
+        published = ring.published()
+        cached = self._book_cache.get(symbol)
+        if cached is not None and cached[0] == published:
+            return cached[1]
+        published, payload = ring.read_latest()
+        if payload is None:
+            return None
+        book = decode_book(symbol, payload)
+        self._book_cache[symbol] = (published, book)
+        return book
+
+    def worker_metrics(self):
+        """Latest exported PipelineMetrics of every worker that has published one (see PipelineMetrics.add_source)."""
+        exported = []
+        for shard_id, ring in enumerate(self.metrics_rings):
+            published = ring.published()
+            if published != self._metrics_cache[shard_id][0]:
+                published, payload = ring.read_latest()
+                if payload is not None:
+                    self._metrics_cache[shard_id] = (published, {**loads(payload), "source": f"shard-{shard_id}"})
+            if self._metrics_cache[shard_id][1] is not None:
+                exported.append(self._metrics_cache[shard_id][1])
+        return exported
+
+    def supervise(self):
+        """Restarts workers that died (at most once per SUPERVISE_INTERVAL_S)."""
+        now = time.monotonic()
+        if now - self._last_supervised < SUPERVISE_INTERVAL_S:
+            return
+        self._last_supervised = now
+        for shard_id, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                logging.error(f"Shard worker {shard_id} exited (code {process.exitcode}); restarting it.")
+                self.restarts += 1
+                self._start_worker(shard_id)
+
+    def alive_count(self):
+        return sum(1 for p in self.processes if p is not None and p.is_alive())
+
+    def stop(self):
+        """Asks every worker to shut down cleanly; terminates the ones still running after the timeout."""
+        for stop_event in self.stop_events:
+            stop_event.set()
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT_S
+        for shard_id, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(timeout=max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.warning(f"Shard worker {shard_id} did not stop in time; terminating it.")
+                process.terminate()
+                process.join(timeout=WORKER_STOP_TIMEOUT_S)
+        for ring in (*self.tick_rings.values(), *self.book_rings.values(), self.params_ring, *self.metrics_rings):
+            ring.close()
+
+    def stats(self):
+        return {
+            "shards": self.shard_count,
+            "alive": self.alive_count(),
+            "restarts": self.restarts,
+            "assignments": {i: symbols for i, symbols in enumerate(self.assignments)},
+        }
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""Rolling Tick Store and Live Market Estimators for the Trade Simulator Backend
+
+TickStore keeps one row per sample interval for an instrument (last mid price
+and traded volume in the interval) in fixed-size ring buffers, and maintains
+streaming estimators on top of them, each O(1) per row:
+
+    ewma_daily_volatility      time-weighted EWMA of squared log returns
+    realized_daily_volatility  realized volatility over a trailing window
+    average_daily_volume       traded volume over a trailing window, per day
+
+Returns across gaps longer than MAX_RETURN_GAP_S (feed outages, restarts) are
+skipped. Volatilities are per day; annualize them the same way the models do.
+
+With a directory the ring buffers are memory-mapped columnar files, so the
+history survives restarts and the estimators warm up from it straight away:
+
+    <directory>/<symbol>/ts.f64       float64 sample time (s since epoch)
+    <directory>/<symbol>/mid.f64      float64 mid price
+    <directory>/<symbol>/volume.f64   float64 traded volume (base asset units)
+    <directory>/<symbol>/state.json   capacity, rows written, sample interval
+"""
+
+import collections
+import json
+import logging
+import math
+import os
+
+import numpy as np
+
+SAMPLE_INTERVAL_S = 1.0
+VOLATILITY_WINDOW_S = 3600.0
+EWMA_HALF_LIFE_S = 1800.0
+VOLUME_WINDOW_S = 86400.0
+MAX_RETURN_GAP_S = 300.0
+# Estimates are reported once they rest on this much data (None before)
+MIN_VOLATILITY_RETURNS = 30
+MIN_VOLUME_SPAN_S = 600.0
+SECONDS_PER_DAY = 86400.0
+
+COLUMNS = ('ts', 'mid', 'volume')
+STATE_FILE = 'state.json'
+
+# Detached, picklable view of a store's estimates (None = not enough data yet)
+LiveEstimates = collections.namedtuple(
+    'LiveEstimates', ('ewma_daily_volatility', 'realized_daily_volatility', 'average_daily_volume', 'rows'))
+
+
+class TickStore:
+    """Sampled mid/volume history for one instrument with streaming volatility and volume estimators."""
+
+    def __init__(self, symbol, directory=None, capacity=None, sample_interval_s=SAMPLE_INTERVAL_S,
+                 volatility_window_s=VOLATILITY_WINDOW_S, ewma_half_life_s=EWMA_HALF_LIFE_S,
+                 volume_window_s=VOLUME_WINDOW_S):
+        """capacity is the number of rows kept; by default just enough for the longest estimator window."""
+        self.symbol = symbol
+        self.path = os.path.join(directory, symbol) if directory else None
+        self.sample_interval_s = sample_interval_s
+        self.volatility_window_s = volatility_window_s
+        self.ewma_tau_s = ewma_half_life_s / math.log(2)
+        self.volume_window_s = volume_window_s
+        if capacity is None:
+            capacity = math.ceil(self._longest_window_s() / sample_interval_s)
+        if capacity * sample_interval_s < self._longest_window_s():
+            raise ValueError("Tick store capacity must cover the longest estimator window")
+        self.total = 0 # Rows ever written (the next row's absolute index)
+        self.columns = self._open_columns(capacity)
+        self.capacity = len(self.columns['ts'])
+        # Per-row return terms (0 where there is no usable return); derived, never persisted
+        self._r2 = np.zeros(self.capacity)
+        self._dt = np.zeros(self.capacity)
+        # Streaming estimator state
+        self.ewma_variance_rate = 0.0 # Per second
+        self.ewma_returns = 0
+        self._volatility_start = 0 # Absolute index of the oldest row in each window
+        self._sum_r2 = 0.0
+        self._sum_dt = 0.0
+        self._window_returns = 0
+        self._volume_start = 0
+        self._sum_volume = 0.0
+        # Sample being accumulated for the current interval
+        self._bucket = None
+        self._bucket_ts = 0.0
+        self._bucket_mid = 0.0
+        self._bucket_volume = 0.0
+        if self.total:
+            self._warm_up()
+
+    # --- Storage ---
+    def _open_columns(self, capacity):
+        if self.path is None:
+            return {name: np.zeros(capacity) for name in COLUMNS}
+        os.makedirs(self.path, exist_ok=True)
+        files = {name: os.path.join(self.path, f"{name}.f64") for name in COLUMNS}
+        state = self._load_state()
+        if state is not None:
+            stored_capacity = int(state.get('capacity', 0))
+            if (state.get('sample_interval_s') == self.sample_interval_s
+                    and stored_capacity * self.sample_interval_s >= self._longest_window_s()
+                    and all(os.path.exists(p) and os.path.getsize(p) == stored_capacity * 8 for p in files.values())):
+                self.total = int(state.get('total', 0))
+                logging.info(f"Tick store for {self.symbol}: {min(self.total, stored_capacity)} rows in {self.path}")
+                if stored_capacity != capacity:
+                    return self._resize_columns(files, stored_capacity, capacity)
+                return {name: np.memmap(p, dtype=np.float64, mode='r+') for name, p in files.items()}
+            logging.warning(f"Tick store files in {self.path} don't match this configuration; starting empty.")
+        return {name: np.memmap(p, dtype=np.float64, mode='w+', shape=(capacity,)) for name, p in files.items()}
+
+    def _resize_columns(self, files, stored_capacity, capacity):
+        """Rewrites stored files for a new capacity, keeping the newest rows in their ring positions."""
+        n = min(self.total, stored_capacity, capacity)
+        absolute = np.arange(self.total - n, self.total)
+        columns = {}
+        for name, path in files.items():
+            newest = np.fromfile(path, dtype=np.float64)[absolute % stored_capacity]
+            column = np.memmap(path + '.tmp', dtype=np.float64, mode='w+', shape=(capacity,))
+            column[absolute % capacity] = newest
+            column.flush()
+            del column
+            os.replace(path + '.tmp', path)
+            columns[name] = np.memmap(path, dtype=np.float64, mode='r+')
+        logging.info(f"Tick store for {self.symbol} resized from {stored_capacity} to {capacity} rows")
+        self._write_state(capacity)
+        return columns
+
+    def _load_state(self):
+        state_path = os.path.join(self.path, STATE_FILE)
+        if not os.path.exists(state_path):
+            return None
+        try:
+            with open(state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Tick store state {state_path} unreadable ({e}); starting empty.")
+            return None
+
+    def _longest_window_s(self):
+        return max(self.volatility_window_s, self.volume_window_s) + self.sample_interval_s
+
+    def flush(self):
+        """Writes buffered rows and the store state to disk (no-op without a directory)."""
+        if self.path is None:
+            return
+        for column in self.columns.values():
+            column.flush()
+        self._write_state(self.capacity)
+
+    def _write_state(self, capacity):
+        state_path = os.path.join(self.path, STATE_FILE)
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump({"capacity": capacity, "total": self.total,
+                       "sample_interval_s": self.sample_interval_s}, f)
+        os.replace(state_path + '.tmp', state_path) # Atomic: a crash never leaves a torn state file
+
+    def close(self):
+        self.flush()
+
+    @property
+    def last_ts(self):
+        """Time of the newest stored row, or None."""
+        return float(self.columns['ts'][(self.total - 1) % self.capacity]) if self.total else None
+
+    def rows(self):
+        """Stored rows, oldest first, as a dict of column arrays."""
+        n = min(self.total, self.capacity)
+        index = np.arange(self.total - n, self.total) % self.capacity
+        return {name: column[index] for name, column in self.columns.items()}
+
+    # --- Updates ---
+    def update(self, ts, mid, volume=0.0):
+        """Adds an observation (ts in seconds); returns True when it closed a sample row.
+
+        Observations older than the stored history (e.g. replaying an old
+        recording into a persisted store) are ignored.
+        """
+        bucket = int(ts // self.sample_interval_s)
+        committed = False
+        if self._bucket is not None and bucket > self._bucket:
+            self._append(self._bucket_ts, self._bucket_mid, self._bucket_volume)
+            self._bucket = None
+            committed = True
+        if self._bucket is None:
+            if self.total and ts <= self.last_ts:
+                return committed
+            self._bucket = bucket
+            self._bucket_ts = ts
+            self._bucket_volume = 0.0
+        self._bucket_ts = max(self._bucket_ts, ts)
+        self._bucket_mid = mid
+        self._bucket_volume += volume
+        return committed
+
+    def _append(self, ts, mid, volume):
+        i = self.total % self.capacity
+        r2 = dt = 0.0
+        if self.total:
+            j = (self.total - 1) % self.capacity
+            gap = ts - self.columns['ts'][j]
+            previous_mid = self.columns['mid'][j]
+            if gap > 0.0:
+                # The EWMA ages across gaps too, even when the return itself is skipped
+                decay = math.exp(-gap / self.ewma_tau_s)
+                self.ewma_variance_rate *= decay
+                if gap <= MAX_RETURN_GAP_S and previous_mid > 0.0 and mid > 0.0:
+                    r2 = math.log(mid / previous_mid) ** 2
+                    dt = float(gap)
+                    self.ewma_variance_rate += (1.0 - decay) * r2 / dt
+                    self.ewma_returns += 1
+        self.columns['ts'][i] = ts
+        self.columns['mid'][i] = mid
+        self.columns['volume'][i] = volume
+        self._r2[i] = r2
+        self._dt[i] = dt
+        self.total += 1
+        self._sum_r2 += r2
+        self._sum_dt += dt
+        self._window_returns += dt > 0.0
+        self._sum_volume += volume
+        self._advance_windows(ts)
+
+    def _advance_windows(self, now):
+        # Each row enters and leaves each window once: amortized O(1) per append
+        ts, cap = self.columns['ts'], self.capacity
+        while ts[self._volatility_start % cap] <= now - self.volatility_window_s:
+            k = self._volatility_start % cap
+            self._sum_r2 -= self._r2[k]
+            self._sum_dt -= self._dt[k]
+            self._window_returns -= int(self._dt[k] > 0.0)
+            self._volatility_start += 1
+        while ts[self._volume_start % cap] <= now - self.volume_window_s:
+            self._sum_volume -= self.columns['volume'][self._volume_start % cap]
+            self._volume_start += 1
+
+    def _warm_up(self):
+        """Rebuilds every estimator from the stored rows in one vectorized pass."""
+        rows = self.rows()
+        ts, mid, volume = rows['ts'], rows['mid'], rows['volume']
+        n = len(ts)
+        first = self.total - n
+        index = np.arange(first, self.total) % self.capacity
+        gaps = np.diff(ts)
+        valid = (gaps > 0.0) & (gaps <= MAX_RETURN_GAP_S) & (mid[:-1] > 0.0) & (mid[1:] > 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r2 = np.where(valid, np.log(mid[1:] / mid[:-1]) ** 2, 0.0)
+            dt = np.where(valid, gaps, 0.0)
+            # Closed form of the recursive EWMA: each return decays from its own time to the last row
+            terms = np.where(valid, -np.expm1(-dt / self.ewma_tau_s) * r2 / dt, 0.0)
+        weights = np.exp(-(ts[-1] - ts[1:]) / self.ewma_tau_s)
+        self.ewma_variance_rate = float(np.dot(terms, weights))
+        self.ewma_returns = int(valid.sum())
+        self._r2[index] = np.concatenate(([0.0], r2))
+        self._dt[index] = np.concatenate(([0.0], dt))
+        start = int(np.searchsorted(ts, ts[-1] - self.volatility_window_s, side='right'))
+        self._volatility_start = first + start
+        self._sum_r2 = float(self._r2[index[start:]].sum())
+        self._sum_dt = float(self._dt[index[start:]].sum())
+        self._window_returns = int((self._dt[index[start:]] > 0.0).sum())
+        start = int(np.searchsorted(ts, ts[-1] - self.volume_window_s, side='right'))
+        self._volume_start = first + start
+        self._sum_volume = float(volume[start:].sum())
+        logging.info(f"Tick store for {self.symbol} warmed up from {n} rows: {self.estimates()}")
+
+    # --- Estimates ---
+    def ewma_daily_volatility(self):
+        if self.ewma_returns < MIN_VOLATILITY_RETURNS:
+            return None
+        return math.sqrt(self.ewma_variance_rate * SECONDS_PER_DAY)
+
+    def realized_daily_volatility(self):
+        if self._window_returns < MIN_VOLATILITY_RETURNS or self._sum_dt <= 0.0:
+            return None
+        return math.sqrt(max(self._sum_r2, 0.0) / self._sum_dt * SECONDS_PER_DAY)
+
+    def average_daily_volume(self):
+        if not self.total:
+            return None
+        ts = self.columns['ts']
+        span = ts[(self.total - 1) % self.capacity] - ts[self._volume_start % self.capacity] + self.sample_interval_s
+        if span < MIN_VOLUME_SPAN_S:
+            return None
+        return max(float(self._sum_volume), 0.0) * SECONDS_PER_DAY / min(float(span), self.volume_window_s)
+
+    def estimates(self):
+        return LiveEstimates(self.ewma_daily_volatility(), self.realized_daily_volatility(),
+                             self.average_daily_volume(), min(self.total, self.capacity))
+
+    def stats(self):
+        return {"symbol": self.symbol, "rows": min(self.total, self.capacity), "persisted": self.path is not None,
+                **self.estimates()._asdict()}